@@ -9,15 +9,19 @@ Please note this model is updated version of the paper.
 If you want to check original source code and results of the paper, please see https://github.com/jiny2001/dcscn-super-resolution/tree/ver1.
 """
 
+import collections
 import logging
 import math
 import os
+import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import tensorflow as tf
 
-from helper import loader, tf_graph, utilty as util
+from helper import layer_profile, loader, memory_planner, metrics, profiler, tf_graph, tracer, utilty as util
 
 BICUBIC_METHOD_STRING = "bicubic"
 
@@ -41,6 +45,12 @@ class SuperResolution(tf_graph.TensorflowGraph):
 		self.resampling_method = BICUBIC_METHOD_STRING
 		self.pixel_shuffler = flags.pixel_shuffler
 		self.self_ensemble = flags.self_ensemble
+		self.validation_ensemble = flags.validation_ensemble if flags.validation_ensemble > 0 else flags.self_ensemble
+		self.validation_images = flags.validation_images
+		self.validation_crop = flags.validation_crop
+		self.validation_batch_num = flags.validation_batch_num
+		self.eval_threads = flags.eval_threads
+		self.inference_tile_size = flags.inference_tile_size
 
 		# Training Parameters
 		self.l2_decay = flags.l2_decay
@@ -50,11 +60,26 @@ class SuperResolution(tf_graph.TensorflowGraph):
 		self.momentum = flags.momentum
 		self.batch_num = flags.batch_num
 		self.batch_image_size = flags.batch_image_size
+		self.patch_size = flags.batch_image_size
+		self.patch_curriculum = [int(size) for size in flags.patch_curriculum.split(",")] \
+			if flags.patch_curriculum != "" else []
 		if flags.stride_size == 0:
 			self.stride_size = flags.batch_image_size // 2
 		else:
 			self.stride_size = flags.stride_size
 		self.clipping_norm = flags.clipping_norm
+		self.gradient_accumulation = max(flags.gradient_accumulation, 1)
+		self.loss_scale = flags.loss_scale if flags.precision == "fp16" else 1.0
+		self.apply_accumulated_ops = {}
+		self.accumulation_counts = {}
+		self.accumulators = {}
+		self.fused_steps = max(flags.fused_steps, 1)
+		self.fused_training_op = None
+		self.batch_augment = flags.batch_augment
+		self.area_weighted_sampling = flags.area_weighted_sampling
+		self.texture_sampling = flags.texture_sampling
+		self.texture_threshold = flags.texture_threshold
+		self.hard_example_half_life = flags.hard_example_half_life
 
 		# Learning Rate Control for Training
 		self.initial_lr = flags.initial_lr
@@ -65,6 +90,16 @@ class SuperResolution(tf_graph.TensorflowGraph):
 		self.training_images = int(math.ceil(flags.training_images / flags.batch_num) * flags.batch_num)
 		self.train = None
 		self.test = None
+		self.validation_set = []
+		self.input_batch = None
+		self.use_input_pipeline = False
+		# loader's index is shared by the generator of the pipeline and the main thread (see build_input_pipeline())
+		self.input_lock = threading.Lock()
+		self.input_generation = 0
+		self.input_positions = collections.deque()
+		self.input_position = None
+		self.input_restart_needed = False
+		self.sample_mse = None
 
 		# Image Processing Parameters
 		self.max_value = flags.max_value
@@ -77,6 +112,10 @@ class SuperResolution(tf_graph.TensorflowGraph):
 		# Environment (all directory name should not contain tailing '/'  )
 		self.batch_dir = flags.batch_dir
 
+		if any(size > self.batch_image_size for size in self.patch_curriculum):
+			logging.error("Patch sizes of patch_curriculum should not be larger than batch_image_size.")
+			exit(-1)
+
 		# initialize variables
 		self.name = self.get_model_name(model_name)
 		self.total_epochs = 0
@@ -95,6 +134,11 @@ class SuperResolution(tf_graph.TensorflowGraph):
 		                 tf_log_level=tf.logging.WARN)
 		logging.info("\nDCSCN v2-------------------------------------")
 		logging.info("%s [%s]" % (util.get_now_date(), self.name))
+		profiler.set_enabled(flags.profile)
+		tracer.configure(flags.trace_file, flags.trace_interval, flags.trace_max_steps)
+		metrics.configure(flags.metrics_jsonl, flags.metrics_prometheus, {"model": self.name})
+		self.memory_planner = memory_planner.MemoryPlanner(self, flags.memory_budget_mb)
+		self.ignore_memory_budget = flags.ignore_memory_budget
 
 		self.init_train_step()
 
@@ -140,31 +184,69 @@ class SuperResolution(tf_graph.TensorflowGraph):
 		"""
 
 		self.train = loader.DynamicDataSets(self.scale, batch_image_size, channels=self.channels,
-		                                    resampling_method=self.resampling_method)
+		                                    resampling_method=self.resampling_method,
+		                                    augment_level=self.batch_augment,
+		                                    area_weighted=self.area_weighted_sampling,
+		                                    texture_sampling=self.texture_sampling,
+		                                    texture_threshold=self.texture_threshold,
+		                                    hard_example_half_life=self.hard_example_half_life)
 		self.train.set_data_dir(data_dir)
+		self.check_training_memory(0)
 
-	def load_datasets(self, data_dir, batch_dir, batch_image_size, stride_size=0):
+	def load_datasets(self, data_dir, batch_dir, batch_image_size, stride_size=0, memory_map=False):
 		""" build input patch images and loads as a datasets
 		Opens image directory as a datasets.
 		Each images are splitted into patch images and converted to input image. Since loading
 		(especially from PNG/JPG) and building input-LR images needs much computation in the
 		training phase, building pre-processed images makes training much faster. However, images
 		are limited by divided grids.
+		If memory_map, patches are read-only memory maps shared by processes (for data parallel workers).
 		"""
 
 		batch_dir += "/scale%d" % self.scale
 
 		self.train = loader.BatchDataSets(self.scale, batch_dir, batch_image_size, stride_size, channels=self.channels,
-		                                  resampling_method=self.resampling_method)
+		                                  resampling_method=self.resampling_method,
+		                                  augment_level=self.batch_augment, texture_sampling=self.texture_sampling,
+		                                  texture_threshold=self.texture_threshold,
+		                                  hard_example_half_life=self.hard_example_half_life)
 
 		if not self.train.is_batch_exist():
 			self.train.build_batch(data_dir)
 		else:
 			self.train.load_batch_counts()
-		self.train.load_all_batch_images()
+		self.check_training_memory(self.train.count)
+		self.train.load_all_batch_images(memory_map=memory_map)
+
+	def check_training_memory(self, count):
+		""" log predicted peak memory of the training and exit if it doesn't fit --memory_budget_mb
+		(unless --ignore_memory_budget). count is the number of patches in the patch store (0 for DynamicDataSets).
+		"""
+
+		planner = self.memory_planner
+		predictions = planner.predict_training(count, self.batch_num, self.batch_image_size)
+		logging.info("Predicted training memory: %s" % memory_planner.format_bytes(predictions))
+		if planner.budget <= 0 or sum(predictions.values()) <= planner.get_available_bytes():
+			return
+
+		message = "Training doesn't fit memory_budget_mb:%d (%s[MB] is available)." % (
+			planner.budget // memory_planner.MB, "{:,.1f}".format(planner.get_available_bytes() / memory_planner.MB))
+		if self.ignore_memory_budget:
+			logging.warning(message + " Continue by --ignore_memory_budget.")
+			return
+
+		logging.error(message)
+		batch_num = planner.get_max_batch_num(count, self.batch_image_size)
+		if batch_num > 0:
+			logging.error("Use --batch_num %d --gradient_accumulation %d to keep the effective batch size." % (
+				batch_num, (self.batch_num * self.gradient_accumulation + batch_num - 1) // batch_num))
+		elif count > 0:
+			logging.error("Patch store doesn't fit. Use --build_batch False or larger --stride_size.")
+		exit(-1)
 
 	def init_epoch_index(self):
 
+		self.update_patch_curriculum()
 		self.batch_input = self.batch_num * [None]
 		self.batch_input_bicubic = self.batch_num * [None]
 		self.batch_true = self.batch_num * [None]
@@ -172,31 +254,166 @@ class SuperResolution(tf_graph.TensorflowGraph):
 		self.training_psnr_sum = 0
 		self.training_mse_sum = 0
 		self.training_step = 0
-		self.train.init_batch_index()
+		if not self.use_input_pipeline:
+			# with tf.data pipeline, the generator continues to the next permutation of the index by itself
+			self.train.init_batch_index()
+
+	def get_loaders(self):
+		return [self.train]
+
+	def update_patch_curriculum(self):
+		"""
+		set patch size of the current learning rate stage. n-th stage uses [patch_curriculum][n] (then batch_image_size).
+		batch_num and steps of each epoch are not changed, so steps with smaller patches are faster.
+		The graph is shared by all patch sizes since the placeholders have dynamic shapes.
+		"""
+
+		stage = self.epochs_completed // self.lr_decay_epoch
+		patch_size = self.patch_curriculum[stage] if stage < len(self.patch_curriculum) else self.batch_image_size
+		if patch_size == self.patch_size:
+			return
+
+		self.patch_size = patch_size
+		for train in self.get_loaders():
+			train.set_patch_size(patch_size)
+		# prefetched mini-batches of the old patch size are discarded
+		self.input_restart_needed = self.use_input_pipeline
+		logging.info("Patch curriculum: %dx%d patches" % (patch_size, patch_size))
 
 	def build_input_batch(self):
 
-		for i in range(self.batch_num):
-			self.batch_input[i], self.batch_input_bicubic[i], self.batch_true[i] = self.train.load_batch_image()
+		if self.use_input_pipeline:
+			# mini-batches are supplied by tf.data pipeline
+			if self.input_restart_needed:
+				self.restart_input_pipeline()
+			return
+		with profiler.scope("batch"):
+			self.batch_input, self.batch_input_bicubic, self.batch_true = self.train.load_batch_images(self.batch_num)
+
+	def build_input_pipeline(self, threads=4, prefetch_batches=2):
+		""" build tf.data pipeline for training batches. should be called before build_graph().
+		Patch numbers are taken from the loader's shuffled index by a generator, and mini-batches are built
+		from them by the loader in parallel map calls and prefetched. x, x2 and y read from the pipeline
+		unless they are fed.
+		While the pipeline runs, only the generator advances the loader's index (under input_lock). The loader's
+		position after each generated mini-batch is queued, so the position after the last trained mini-batch
+		is known. The pipeline is (re)started from that position by restart_input_pipeline().
+		"""
+
+		if self.hard_example_half_life > 0:
+			logging.warning("Hard example mining doesn't update losses with tf.data pipeline since patch numbers "
+			                "of each step are not known.")
+
+		def generate_numbers(generation):
+			while True:
+				with self.input_lock:
+					if generation != self.input_generation:
+						# the pipeline has been restarted
+						return
+					numbers = self.train.get_next_image_numbers(self.batch_num)
+					self.input_positions.append(self.train.get_position())
+					patch_size = self.patch_size
+				yield np.array(numbers, dtype=np.int64), patch_size
+
+		def build_batch_images(numbers, patch_size):
+			with profiler.scope("loader"):
+				input_images, input_bicubic_images, true_images = self.train.build_batch_images(numbers,
+				                                                                               int(patch_size))
+			return input_images.astype(np.float32), input_bicubic_images.astype(np.float32), \
+			       true_images.astype(np.float32)
+
+		def load_batch(numbers, patch_size):
+			images = tf.py_func(build_batch_images, [numbers, patch_size], [tf.float32, tf.float32, tf.float32],
+			                    stateful=True)
+			images[0].set_shape([None, None, None, self.channels])
+			images[1].set_shape([None, None, None, self.output_channels])
+			images[2].set_shape([None, None, None, self.output_channels])
+			return tuple(images)
+
+		with tf.variable_scope("Input"):
+			self.input_generation_input = tf.placeholder(tf.int64, shape=[], name="generation")
+			dataset = tf.data.Dataset.from_generator(generate_numbers, (tf.int64, tf.int64),
+			                                         (tf.TensorShape([None]), tf.TensorShape([])),
+			                                         args=(self.input_generation_input,))
+			dataset = dataset.map(load_batch, num_parallel_calls=threads)
+			dataset = dataset.prefetch(prefetch_batches)
+
+			self.input_iterator = dataset.make_initializable_iterator()
+			self.input_batch = self.input_iterator.get_next()
+		self.train.init_batch_index()
+		self.use_input_pipeline = True
+		self.input_restart_needed = True
+
+	def restart_input_pipeline(self):
+		"""
+		(re)start tf.data pipeline from the loader's position after the last trained mini-batch.
+		Prefetched mini-batches which are not trained yet are discarded and generated again (with the current patch size).
+		"""
+
+		with self.input_lock:
+			self.input_generation += 1
+			if self.input_position is not None:
+				self.train.set_position(self.input_position)
+			self.input_position = self.train.get_position()
+			self.input_positions.clear()
+		self.sess.run(self.input_iterator.initializer, feed_dict={self.input_generation_input: self.input_generation})
+		self.input_restart_needed = False
+
+	def pop_input_positions(self, steps):
+		""" [steps] mini-batches from the pipeline are trained. update the position after the last trained one. """
+
+		for _ in range(steps):
+			self.input_position = self.input_positions.popleft()
 
 	def build_graph(self):
 
-		self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
-		self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
-		self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
+		self.build_input_placeholders()
+
+		if self.save_weights:
+			with tf.name_scope("X"):
+				util.add_summaries("output", self.name, self.x, save_stddev=True, save_mean=True,
+				                   save_histogram=self.telemetry == "full")
+
+		self.y_ = self.build_network(self.x, self.x2)
+
+		if self.save_weights:
+			with tf.name_scope("Y_"):
+				util.add_summaries("output", self.name, self.y_, save_stddev=True, save_mean=True,
+				                   save_histogram=self.telemetry == "full")
+
+		logging.info("Feature:%s Complexity:%s Receptive Fields:%d" % (
+			self.features, "{:,}".format(self.complexity), self.receptive_fields))
+
+	def build_input_placeholders(self):
+
+		if self.input_batch is not None:
+			input_x, input_x2, input_y = self.input_batch
+			self.x = tf.placeholder_with_default(input_x, shape=[None, None, None, self.channels], name="x")
+			self.y = tf.placeholder_with_default(input_y, shape=[None, None, None, self.output_channels], name="y")
+			self.x2 = tf.placeholder_with_default(input_x2, shape=[None, None, None, self.output_channels], name="x2")
+		else:
+			self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
+			self.y = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="y")
+			self.x2 = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels], name="x2")
 		self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
 		self.is_training = tf.placeholder(tf.bool, name="is_training")
 
-		# building feature extraction layers
+	def is_fused_training(self):
+		return self.use_input_pipeline and self.fused_steps > 1
+
+	def build_network(self, x, x2):
+		""" build all layers on input x (and bicubic x2 for the skip connection). returns output (y_) tensor. """
+
+		input_channels = self.build_feature_extraction(x)
+		return self.build_reconstruction(self.H[-1], input_channels, self.scale, x2)
+
+	def build_feature_extraction(self, x):
+		""" build feature extraction layers and NIN layers. returns number of channels of the output (self.H[-1]). """
 
 		output_feature_num = self.filters
 		total_output_feature_num = 0
 		input_feature_num = self.channels
-		input_tensor = self.x
-
-		if self.save_weights:
-			with tf.name_scope("X"):
-				util.add_summaries("output", self.name, self.x, save_stddev=True, save_mean=True)
+		input_tensor = self.to_compute_dtype(x)
 
 		for i in range(self.layers):
 			if self.min_filters != 0 and i > 0:
@@ -229,20 +446,22 @@ class SuperResolution(tf_graph.TensorflowGraph):
 			                dropout_rate=self.dropout_rate, use_bias=True, activator=self.activator)
 
 			self.H.append(tf.concat([self.H[-1], self.H[-3]], 3, name="Concat2"))
-			input_channels = self.nin_filters + self.nin_filters2
+			return self.nin_filters + self.nin_filters2
 		else:
 			self.H.append(self.H_concat)
-			input_channels = total_output_feature_num
+			return total_output_feature_num
+
+	def build_reconstruction(self, input_tensor, input_channels, scale, x2):
+		""" build upsampling and reconstruction layers for the scale on input_tensor. returns output (y_) tensor. """
 
-		# building upsampling layer
 		if self.pixel_shuffler:
-			if self.scale == 4:
-				self.build_pixel_shuffler_layer("Up-PS", self.H[-1], 2, input_channels)
+			if scale == 4:
+				self.build_pixel_shuffler_layer("Up-PS", input_tensor, 2, input_channels)
 				self.build_pixel_shuffler_layer("Up-PS2", self.H[-1], 2, input_channels)
 			else:
-				self.build_pixel_shuffler_layer("Up-PS", self.H[-1], self.scale, input_channels)
+				self.build_pixel_shuffler_layer("Up-PS", input_tensor, scale, input_channels)
 		else:
-			self.build_transposed_conv("Up-TCNN", self.H[-1], self.scale, input_channels)
+			self.build_transposed_conv("Up-TCNN", input_tensor, scale, input_channels)
 
 		for i in range(self.reconstruct_layers - 1):
 			self.build_conv("R-CNN%d" % (i + 1), self.H[-1], self.cnn_size, input_channels, self.reconstruct_filters,
@@ -252,49 +471,119 @@ class SuperResolution(tf_graph.TensorflowGraph):
 		self.build_conv("R-CNN%d" % self.reconstruct_layers, self.H[-1], self.cnn_size, input_channels,
 		                self.output_channels)
 
-		self.y_ = self.H[-1] + self.x2
+		# skip connection and the loss are computed in float32
+		return self.to_float32(self.H[-1]) + x2
 
-		if self.save_weights:
-			with tf.name_scope("Y_"):
-				util.add_summaries("output", self.name, self.y_, save_stddev=True, save_mean=True)
-
-		logging.info("Feature:%s Complexity:%s Receptive Fields:%d" % (
-			self.features, "{:,}".format(self.complexity), self.receptive_fields))
-
-	def build_optimizer(self):
+	def build_optimizer(self, data_parallel=False):
 		"""
 		Build loss function. We use 6+scale as a border	and we don't calculate MSE on the border.
+		If data_parallel, build ops to compute gradients and to apply all-reduced gradients separately.
 		"""
 
 		self.lr_input = tf.placeholder(tf.float32, shape=[], name="LearningRate")
+		self.mse, self.loss = self.build_loss(self.y_, self.y, self.Weights)
+		loss = self.loss
+		if self.hard_example_half_life > 0:
+			self.sample_mse = tf.reduce_mean(tf.square(self.y_ - self.y), axis=[1, 2, 3], name="sample_mse")
+
+		optimizer = self.create_optimizer(self.lr_input)
+		if data_parallel:
+			self.add_data_parallel_optimizer_op(loss, self.lr_input)
+		elif self.batch_norm:
+			update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+			with tf.control_dependencies(update_ops):
+				self.training_optimizer = self.add_optimizer_op(loss, self.lr_input, optimizer)
+		else:
+			self.training_optimizer = self.add_optimizer_op(loss, self.lr_input, optimizer)
 
-		diff = self.y_ - self.y
+		if self.is_fused_training() and not data_parallel:
+			self.build_fused_training(optimizer)
+		elif self.fused_steps > 1:
+			logging.warning("fused_steps is used only with --use_tf_data (and not in data parallel training).")
 
-		self.mse = tf.reduce_mean(tf.square(diff), name="mse")
-		loss = self.mse
+		util.print_num_of_total_parameters(output_detail=True)
+
+	def build_loss(self, y_, y, weights, name_postfix=""):
+		""" returns MSE and loss (MSE + l2 decay of weights) tensors """
+
+		diff = y_ - y
+
+		mse = tf.reduce_mean(tf.square(diff), name="mse" + name_postfix)
+		loss = mse
 
 		if self.l2_decay > 0:
-			l2_losses = [tf.nn.l2_loss(w) for w in self.Weights]
+			l2_losses = [tf.nn.l2_loss(w) for w in weights]
 			# l1_losses = [tf.reduce_sum(tf.abs(w)) for w in self.weights]  # l1 loss
 			l2_loss = self.l2_decay * tf.add_n(l2_losses)
 			if self.save_loss:
-				tf.summary.scalar("loss_l2/" + self.name, l2_loss)
+				tf.summary.scalar("loss_l2" + name_postfix + "/" + self.name, l2_loss,
+				                  collections=[tf.GraphKeys.SUMMARIES, util.SCALAR_SUMMARIES])
 
 			loss += l2_loss
 
 		if self.save_loss:
-			tf.summary.scalar("loss/" + self.name, loss)
+			tf.summary.scalar("loss" + name_postfix + "/" + self.name, loss,
+			                  collections=[tf.GraphKeys.SUMMARIES, util.SCALAR_SUMMARIES])
 
-		self.loss = loss
+		return mse, loss
 
-		if self.batch_norm:
-			update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+	def build_fused_training(self, optimizer):
+		"""
+		Build a tf.while_loop which runs [fused_steps_input] training steps in one session call. Each iteration takes a
+		mini-batch from the tf.data iterator, builds the layers again on it with the same variables and applies its
+		gradients by the optimizer (and the slots) of training_optimizer. With gradient_accumulation, gradients are added
+		to the same accumulators and applied on every [gradient_accumulation] steps counted from
+		accumulation_start_input. fused_training_op returns MSE / PSNR sums of the steps.
+		"""
+
+		self.fused_steps_input = tf.placeholder(tf.int32, shape=[], name="FusedSteps")
+		self.accumulation_start_input = tf.placeholder_with_default(0, shape=[], name="AccumulationStart")
+		accumulators = self.accumulators.get(self.training_optimizer)
+
+		def apply_gradients(grad_var_pairs):
+			grads = [grad for grad, _ in grad_var_pairs]
+			if self.clipping_norm > 0:
+				grads, _ = tf.clip_by_global_norm(grads, clip_norm=self.clipping_norm)
+			return optimizer.apply_gradients(zip(grads, [var for _, var in grad_var_pairs]))
+
+		def apply_accumulated_gradients():
+			apply_op = apply_gradients([(accumulator.read_value(), var) for accumulator, var in accumulators])
+			with tf.control_dependencies([apply_op]):
+				reset_op = tf.group(*[accumulator.assign(tf.zeros_like(accumulator)) for accumulator, _ in accumulators])
+			with tf.control_dependencies([reset_op]):
+				return tf.constant(True)
+
+		def train_step(step, mse_sum, psnr_sum):
+			x, x2, y = self.input_iterator.get_next()
+			update_ops_count = len(tf.get_collection(tf.GraphKeys.UPDATE_OPS))
+			with self.reuse_layers():
+				y_ = self.build_network(x, x2)
+				mse, loss = self.build_loss(y_, y, self.Weights)
+			update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)[update_ops_count:]
+
+			trainables = tf.trainable_variables()
 			with tf.control_dependencies(update_ops):
-				self.training_optimizer = self.add_optimizer_op(loss, self.lr_input)
-		else:
-			self.training_optimizer = self.add_optimizer_op(loss, self.lr_input)
+				grad_var_pairs = [(grad, var) for grad, var in zip(self.compute_gradients(loss, trainables), trainables)
+				                  if grad is not None]
 
-		util.print_num_of_total_parameters(output_detail=True)
+			if accumulators is None:
+				training_op = apply_gradients(grad_var_pairs)
+			else:
+				accumulate_op = tf.group(*[accumulator.assign_add(grad / self.gradient_accumulation)
+				                           for (accumulator, _), (grad, _) in zip(accumulators, grad_var_pairs)])
+				with tf.control_dependencies([accumulate_op]):
+					is_apply_step = tf.equal((self.accumulation_start_input + step + 1) % self.gradient_accumulation, 0)
+					training_op = tf.cond(is_apply_step, apply_accumulated_gradients, lambda: tf.constant(False))
+
+			with tf.control_dependencies([training_op]):
+				psnr = tf.where(mse > 0, self.get_psnr_tensor(mse), 0.0)
+				return step + 1, mse_sum + mse, psnr_sum + psnr
+
+		with tf.name_scope("FusedTraining"):
+			_, mse_sum, psnr_sum = tf.while_loop(lambda step, mse_sum, psnr_sum: step < self.fused_steps_input,
+			                                     train_step, [tf.constant(0), tf.constant(0.0), tf.constant(0.0)],
+			                                     parallel_iterations=1, back_prop=False)
+			self.fused_training_op = tf.stack([mse_sum, psnr_sum])
 
 	def get_psnr_tensor(self, mse):
 
@@ -304,7 +593,7 @@ class SuperResolution(tf_graph.TensorflowGraph):
 			denominator = tf.log(tf.constant(10, dtype=mse.dtype))
 			return tf.constant(20, dtype=mse.dtype) * numerator / denominator
 
-	def add_optimizer_op(self, loss, lr_input):
+	def create_optimizer(self, lr_input):
 
 		if self.optimizer == "gd":
 			optimizer = tf.train.GradientDescentOptimizer(lr_input)
@@ -322,34 +611,219 @@ class SuperResolution(tf_graph.TensorflowGraph):
 			print("Optimizer arg should be one of [gd, adadelta, adagrad, adam, momentum, rmsprop].")
 			return None
 
+		return optimizer
+
+	def add_optimizer_op(self, loss, lr_input, optimizer=None):
+
+		if optimizer is None:
+			optimizer = self.create_optimizer(lr_input)
+		if optimizer is None:
+			return None
+
+		if self.gradient_accumulation > 1:
+			return self.add_accumulation_optimizer_op(loss, optimizer)
+
 		if self.clipping_norm > 0:
 			trainables = tf.trainable_variables()
-			grads = tf.gradients(loss, trainables)
+			grads = self.compute_gradients(loss, trainables)
 			grads, _ = tf.clip_by_global_norm(grads, clip_norm=self.clipping_norm)
 			grad_var_pairs = zip(grads, trainables)
 
 			training_optimizer = optimizer.apply_gradients(grad_var_pairs)
+		elif self.loss_scale != 1:
+			trainables = tf.trainable_variables()
+			grad_var_pairs = [(grad, var) for grad, var in zip(self.compute_gradients(loss, trainables), trainables)
+			                  if grad is not None]
+			training_optimizer = optimizer.apply_gradients(grad_var_pairs)
 		else:
 			training_optimizer = optimizer.minimize(loss)
 
 		return training_optimizer
 
+	def compute_gradients(self, loss, variables):
+		"""
+		returns gradients of loss for variables. In fp16 precision, the loss is multiplied by loss_scale so that small
+		gradients don't underflow in half precision backprop, and gradients are divided by it in float32.
+		"""
+
+		if self.loss_scale == 1:
+			return tf.gradients(loss, variables)
+
+		grads = tf.gradients(loss * self.loss_scale, variables)
+		return [None if grad is None else grad / self.loss_scale for grad in grads]
+
+	def add_accumulation_optimizer_op(self, loss, optimizer):
+		"""
+		Gradients of [gradient_accumulation] mini-batches are accumulated and their mean is clipped and applied at once,
+		so the effective batch is batch_num x gradient_accumulation while activations of only one mini-batch are kept.
+		returns the op to accumulate. The op to accumulate, apply and reset is kept in self.apply_accumulated_ops and
+		(accumulator, variable) pairs are kept in self.accumulators.
+		Accumulators are local variables so that they are not saved in checkpoints of the model. The training state
+		saves them (see save_training_state()).
+		"""
+
+		trainables = tf.trainable_variables()
+		grad_var_pairs = [(grad, var) for grad, var in zip(self.compute_gradients(loss, trainables), trainables)
+		                  if grad is not None]
+
+		with tf.variable_scope("Accumulation"):
+			accumulators = [tf.Variable(tf.zeros(var.get_shape()), trainable=False, name="accumulator",
+			                            collections=[tf.GraphKeys.LOCAL_VARIABLES]) for _, var in grad_var_pairs]
+			accumulate_op = tf.group(*[accumulator.assign_add(grad / self.gradient_accumulation)
+			                           for accumulator, (grad, _) in zip(accumulators, grad_var_pairs)])
+
+			with tf.control_dependencies([accumulate_op]):
+				grads = [accumulator.read_value() for accumulator in accumulators]
+
+		# optimizer is applied out of the scope so that its slots have the same names as gradient_accumulation=1
+		if self.clipping_norm > 0:
+			grads, _ = tf.clip_by_global_norm(grads, clip_norm=self.clipping_norm)
+		apply_op = optimizer.apply_gradients(zip(grads, [var for _, var in grad_var_pairs]))
+
+		with tf.control_dependencies([apply_op]):
+			reset_op = tf.group(*[accumulator.assign(tf.zeros_like(accumulator)) for accumulator in accumulators])
+
+		self.apply_accumulated_ops[accumulate_op] = reset_op
+		self.accumulators[accumulate_op] = list(zip(accumulators, [var for _, var in grad_var_pairs]))
+		return accumulate_op
+
+	def add_data_parallel_optimizer_op(self, loss, lr_input):
+		"""
+		self.gradients are computed by each worker. After they are all-reduced, averaged gradients are fed to
+		self.gradient_inputs and self.apply_gradients_op clips (by clipping_norm) and applies them.
+		"""
+
+		optimizer = self.create_optimizer(lr_input)
+		if optimizer is None:
+			return
+
+		trainables = tf.trainable_variables()
+		# batch norm moving averages are updated by each worker when its gradients are computed
+		with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
+			self.gradients = self.compute_gradients(loss, trainables)
+		self.gradient_inputs = [tf.placeholder(tf.float32, shape=var.get_shape(), name="gradient_input")
+		                        for var in trainables]
+
+		grads = self.gradient_inputs
+		if self.clipping_norm > 0:
+			grads, _ = tf.clip_by_global_norm(grads, clip_norm=self.clipping_norm)
+		self.apply_gradients_op = optimizer.apply_gradients(zip(grads, trainables))
+
+	def get_training_op(self):
+		""" returns the training op of this step. gradients are applied on every [gradient_accumulation] mini-batches """
+
+		training_op = self.training_optimizer
+		if training_op in self.apply_accumulated_ops:
+			count = self.accumulation_counts.get(training_op, 0) + 1
+			if count >= self.gradient_accumulation:
+				training_op = self.apply_accumulated_ops[training_op]
+				count = 0
+			self.accumulation_counts[self.training_optimizer] = count
+		return training_op
+
 	def train_batch(self):
 
-		feed_dict = {self.x: self.batch_input, self.x2: self.batch_input_bicubic, self.y: self.batch_true,
-		             self.lr_input: self.lr, self.dropout: self.dropout_rate, self.is_training: 1}
+		feed_dict = {self.lr_input: self.lr, self.dropout: self.dropout_rate, self.is_training: 1}
+		if not self.use_input_pipeline:
+			feed_dict[self.x] = self.batch_input
+			feed_dict[self.x2] = self.batch_input_bicubic
+			feed_dict[self.y] = self.batch_true
+
+		training_op = self.get_training_op()
+		if self.sample_mse is not None and not self.use_input_pipeline:
+			# update loss table of the loader for hard example mining
+			with profiler.scope("run"):
+				_, mse, sample_mse = self.run([training_op, self.mse, self.sample_mse], feed_dict, "train")
+			self.train.update_losses(sample_mse, self.step)
+		else:
+			with profiler.scope("run"):
+				_, mse = self.run([training_op, self.mse], feed_dict, "train")
 
-		_, mse = self.sess.run([self.training_optimizer, self.mse], feed_dict=feed_dict)
+		if self.use_input_pipeline:
+			self.pop_input_positions(1)
 
 		self.training_mse_sum += mse
 		self.training_psnr_sum += util.get_psnr(mse, max_value=self.max_value)
 		self.training_step += 1
 		self.step += 1
 
-	def log_to_tensorboard(self, test_filename, psnr, save_meta_data=True):
+	def train_steps(self, steps):
+		"""
+		train up to [steps] mini-batches but not over the end of the epoch. returns the number of trained steps.
+		With tf.data pipeline and fused_steps > 1, all the steps are run by one session call of the training loop built
+		by build_fused_training(), which returns their MSE / PSNR sums.
+		Otherwise each step is build_input_batch() and train_batch().
+		"""
+
+		remaining = (self.training_images - self.training_step * self.batch_num + self.batch_num - 1) // self.batch_num
+		steps = max(1, min(steps, remaining))
+
+		if self.fused_training_op is None:
+			for _ in range(steps):
+				self.build_input_batch()
+				self.train_batch()
+			return steps
+
+		self.build_input_batch()
+		feed_dict = {self.lr_input: self.lr, self.dropout: self.dropout_rate, self.is_training: 1,
+		             self.fused_steps_input: steps}
+		if self.training_optimizer in self.apply_accumulated_ops:
+			count = self.accumulation_counts.get(self.training_optimizer, 0)
+			feed_dict[self.accumulation_start_input] = count
+			self.accumulation_counts[self.training_optimizer] = (count + steps) % self.gradient_accumulation
+
+		with profiler.scope("run"):
+			mse_sum, psnr_sum = self.run(self.fused_training_op, feed_dict, "train")
+		self.pop_input_positions(steps)
+		self.training_mse_sum += float(mse_sum)
+		self.training_psnr_sum += float(psnr_sum)
+		self.training_step += steps
+		self.step += steps
+		return steps
+
+	def train_batch_with_all_reduce(self, all_reduce):
+		"""
+		train_batch() for data parallel training. all_reduce(values) should return the mean of values of all workers.
+		Gradients and MSE of this worker's shard are all-reduced together and the mean gradients are applied.
+		"""
 
-		# todo
-		save_meta_data = False
+		feed_dict = {self.dropout: self.dropout_rate, self.is_training: 1}
+		if not self.use_input_pipeline:
+			feed_dict[self.x] = self.batch_input
+			feed_dict[self.x2] = self.batch_input_bicubic
+			feed_dict[self.y] = self.batch_true
+
+		gradients, mse = self.sess.run([self.gradients, self.mse], feed_dict=feed_dict)
+		if self.use_input_pipeline:
+			self.pop_input_positions(1)
+
+		values = np.concatenate([gradient.ravel() for gradient in gradients] + [[mse]]).astype(np.float32)
+		values = all_reduce(values)
+
+		feed_dict = {self.lr_input: self.lr}
+		offset = 0
+		for gradient_input, gradient in zip(self.gradient_inputs, gradients):
+			feed_dict[gradient_input] = values[offset:offset + gradient.size].reshape(gradient.shape)
+			offset += gradient.size
+		self.sess.run(self.apply_gradients_op, feed_dict=feed_dict)
+
+		mse = float(values[-1])
+		self.training_mse_sum += mse
+		self.training_psnr_sum += util.get_psnr(mse, max_value=self.max_value)
+		self.training_step += 1
+		self.step += 1
+
+	def get_trainable_values(self):
+		return np.concatenate([value.ravel() for value in self.sess.run(tf.trainable_variables())])
+
+	def set_trainable_values(self, values):
+		offset = 0
+		for var in tf.trainable_variables():
+			size = int(np.prod(var.get_shape().as_list()))
+			var.load(values[offset:offset + size].reshape(var.get_shape().as_list()), self.sess)
+			offset += size
+
+	def get_test_feed_dict(self, test_filename):
 
 		org_image = util.set_image_alignment(util.load_image(test_filename, print_console=False), self.scale)
 
@@ -359,48 +833,63 @@ class SuperResolution(tf_graph.TensorflowGraph):
 		input_image = util.resize_image_by_pil(org_image, 1.0 / self.scale, resampling_method=self.resampling_method)
 		bicubic_image = util.resize_image_by_pil(input_image, self.scale, resampling_method=self.resampling_method)
 
-		feed_dict = {self.x: input_image.reshape([1, input_image.shape[0], input_image.shape[1], input_image.shape[2]]),
-		             self.x2: bicubic_image.reshape(
-			             [1, bicubic_image.shape[0], bicubic_image.shape[1], bicubic_image.shape[2]]),
-		             self.y: org_image.reshape([1, org_image.shape[0], org_image.shape[1], org_image.shape[2]]),
-		             self.dropout: 1.0,
-		             self.is_training: 0}
-
-		if save_meta_data:
-			# profiler = tf.profiler.Profile(self.sess.graph)
-
-			run_metadata = tf.RunMetadata()
-			run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
-			summary_str, _ = self.sess.run([self.summary_op, self.mse], feed_dict=feed_dict, options=run_options,
-			                               run_metadata=run_metadata)
-			self.test_writer.add_run_metadata(run_metadata, "step%d" % self.epochs_completed)
-
-			filename = self.checkpoint_dir + "/" + self.name + "_metadata.txt"
-			with open(filename, "w") as out:
-				out.write(str(run_metadata))
-
-			# filename = self.checkpoint_dir + "/" + self.name + "_memory.txt"
-			# tf.profiler.write_op_log(
-			# 	tf.get_default_graph(),
-			# 	log_dir=self.checkpoint_dir,
-			# 	#op_log=op_log,
-			# 	run_meta=run_metadata)
-
-			tf.contrib.tfprof.model_analyzer.print_model_analysis(
-				tf.get_default_graph(), run_meta=run_metadata,
-				tfprof_options=tf.contrib.tfprof.model_analyzer.PRINT_ALL_TIMING_MEMORY)
+		return {self.x: input_image.reshape([1, input_image.shape[0], input_image.shape[1], input_image.shape[2]]),
+		        self.x2: bicubic_image.reshape([1, bicubic_image.shape[0], bicubic_image.shape[1], bicubic_image.shape[2]]),
+		        self.y: org_image.reshape([1, org_image.shape[0], org_image.shape[1], org_image.shape[2]]),
+		        self.dropout: 1.0,
+		        self.is_training: 0}
 
-		else:
-			summary_str, _ = self.sess.run([self.summary_op, self.mse], feed_dict=feed_dict)
+	def log_to_tensorboard(self, test_filename, psnr, save_meta_data=True, full_evaluation=True):
+		"""
+		log summaries and training PSNR / LR. If psnr is None, test PSNR is not logged (evaluated elsewhere).
+		PSNR of evaluate_validation_set() (full_evaluation=False) is logged as PSNR_validation, separated from PSNR.
+		Summaries (and histograms in background telemetry mode) are logged only every [summary_interval] epochs.
+		"""
+
+		if self.train_writer is None:
+			return
+
+		if self.summary_op is not None and self.is_summary_epoch(self.epochs_completed):
+			start_time = time.time()
+			feed_dict = self.get_test_feed_dict(test_filename)
+
+			if save_meta_data and self.save_meta_data:
+				(summary_str, _), run_metadata = self.run_with_trace([self.summary_op, self.mse], feed_dict)
+				self.test_writer.add_run_metadata(run_metadata, "step%d" % self.epochs_completed)
+
+				filename = self.checkpoint_dir + "/" + self.name + "_metadata.txt"
+				with open(filename, "w") as out:
+					out.write(str(run_metadata))
+
+				self.log_model_analysis(run_metadata, feed_dict[self.x].shape,
+				                        "Layers at Epoch:%d [%s]" % (self.epochs_completed, test_filename))
+
+			else:
+				summary_str, _ = self.sess.run([self.summary_op, self.mse], feed_dict=feed_dict)
+
+			self.train_writer.add_summary(summary_str, self.epochs_completed)
+			self.add_telemetry_time("summary_op(%s)" % self.telemetry, time.time() - start_time)
 
-		self.train_writer.add_summary(summary_str, self.epochs_completed)
+		if self.telemetry_worker is not None and self.is_summary_epoch(self.epochs_completed):
+			start_time = time.time()
+			self.log_weight_histograms_in_background(self.epochs_completed)
+			self.add_telemetry_time("weight_fetch", time.time() - start_time)
+
+		start_time = time.time()
 		util.log_scalar_value(self.train_writer, 'PSNR', self.training_psnr_sum / self.training_step,
 		                      self.epochs_completed)
 		util.log_scalar_value(self.train_writer, 'LR', self.lr, self.epochs_completed)
 		self.train_writer.flush()
 
-		util.log_scalar_value(self.test_writer, 'PSNR', psnr, self.epochs_completed)
-		self.test_writer.flush()
+		if psnr is not None:
+			util.log_scalar_value(self.test_writer, 'PSNR' if full_evaluation else 'PSNR_validation', psnr,
+			                      self.epochs_completed)
+			self.test_writer.flush()
+		self.add_telemetry_time("scalar", time.time() - start_time)
+
+	def is_lr_decay_epoch(self):
+		""" True if the learning rate will be decayed (or the training will be finished) after this epoch. """
+		return self.epochs_completed_in_stage + 1 >= self.lr_decay_epoch
 
 	def update_epoch_and_lr(self):
 
@@ -421,8 +910,13 @@ class SuperResolution(tf_graph.TensorflowGraph):
 			logging.info("Initial MSE:%f PSNR:%f" % (mse, psnr))
 		else:
 			processing_time = (time.time() - self.start_time) / self.step
-			line_a = "%s Step:%s MSE:%f PSNR:%f (Training PSNR:%0.3f)" % (
-				util.get_now_date(), "{:,}".format(self.step), mse, psnr, self.training_psnr_sum / self.training_step)
+			if mse is None:
+				line_a = "%s Step:%s (Training PSNR:%0.3f)" % (
+					util.get_now_date(), "{:,}".format(self.step), self.training_psnr_sum / self.training_step)
+			else:
+				line_a = "%s Step:%s MSE:%f PSNR:%f (Training PSNR:%0.3f)" % (
+					util.get_now_date(), "{:,}".format(self.step), mse, psnr,
+					self.training_psnr_sum / self.training_step)
 			estimated = processing_time * (self.total_epochs - self.epochs_completed) * (
 				self.training_images // self.batch_num)
 			h = estimated // (60 * 60)
@@ -452,45 +946,160 @@ class SuperResolution(tf_graph.TensorflowGraph):
 		if len(test_filenames) == 0:
 			return 0, 0
 
-		for filename in test_filenames:
-			mse = self.do_for_evaluate(filename, print_console=False)
+		for mse in self.evaluate_files(test_filenames):
 			total_mse += mse
 			total_psnr += util.get_psnr(mse, max_value=self.max_value)
 
 		return total_mse / len(test_filenames), total_psnr / len(test_filenames)
 
-	def do(self, input_image, bicubic_input_image=None):
+	def for_each_scale(self):
+		""" yields each scale of the model after switching to it. (only [scale] for single scale model) """
+
+		yield self.scale
+
+	def evaluate_files(self, test_filenames, output_directory=None, writer=None):
+		"""
+		returns MSE of each file in the order of test_filenames. Files are evaluated by [eval_threads] threads so that
+		loading, color conversion and MSE calculation overlap with sess.run of other files.
+		If output_directory is given, result images are saved there (by writer if it's given).
+		"""
+
+		if output_directory is None:
+			evaluate_file = self.do_for_evaluate
+		else:
+			def evaluate_file(filename):
+				return self.do_for_evaluate_with_output(filename, output_directory, writer=writer)
+
+		if self.eval_threads <= 1:
+			return list(map(evaluate_file, test_filenames))
+
+		with ThreadPoolExecutor(max_workers=self.eval_threads) as executor:
+			return list(executor.map(evaluate_file, test_filenames))
+
+	def build_validation_set(self, test_filenames):
+		"""
+		Build and keep input / bicubic / true images for fast per-epoch validation. Only first [validation_images]
+		images are used and they are center-cropped to [validation_crop] if they are specified.
+		"""
+
+		if self.validation_images > 0:
+			test_filenames = test_filenames[:self.validation_images]
+
+		self.validation_set = []
+		for filename in test_filenames:
+			image_set = self.build_evaluation_image_set(filename, crop_size=self.validation_crop)
+			if image_set is not None:
+				self.validation_set.append(image_set)
+
+		logging.info("Validation set: %d images, crop:%d, self ensemble:%d" % (
+			len(self.validation_set), self.validation_crop, self.validation_ensemble))
+
+	def evaluate_validation_set(self):
+		""" evaluate validation set built by build_validation_set(). Same-sized images are processed as a batch. """
+
+		total_mse = total_psnr = 0
+		if len(self.validation_set) == 0:
+			return 0, 0
+
+		groups = {}
+		for i, (input_image, _, _) in enumerate(self.validation_set):
+			groups.setdefault(input_image.shape, []).append(i)
+
+		for indexes in groups.values():
+			for start in range(0, len(indexes), self.validation_batch_num):
+				image_sets = [self.validation_set[i] for i in indexes[start:start + self.validation_batch_num]]
+				output_images = self.do_batch(np.stack([image_set[0] for image_set in image_sets]),
+				                              np.stack([image_set[1] for image_set in image_sets]),
+				                              self_ensemble=self.validation_ensemble)
+
+				for (_, _, true_image), output_image in zip(image_sets, output_images):
+					mse = util.compute_mse(true_image, output_image, border_size=self.psnr_calc_border_size)
+					total_mse += mse
+					total_psnr += util.get_psnr(mse, max_value=self.max_value)
+
+		return total_mse / len(self.validation_set), total_psnr / len(self.validation_set)
+
+	def do_batch(self, input_images, bicubic_input_images, self_ensemble=1):
+		""" do() for same-sized images [N, H, W, C]. Each pattern of self ensemble is processed by one sess.run. """
+
+		if self.max_value != 255.0:
+			input_images = np.multiply(input_images, self.max_value / 255.0)
+
+		output = 0
+		with profiler.scope("ensemble"):
+			for i in range(self_ensemble):
+				images = np.stack([util.flip(image, i) for image in input_images])
+				bicubic_images = np.stack([util.flip(image, i) for image in bicubic_input_images])
+				with profiler.scope("forward"):
+					y = self.run(self.y_, {self.x: images, self.x2: bicubic_images, self.dropout: 1.0,
+					                       self.is_training: 0})
+				output += np.stack([util.flip(image, i, invert=True) for image in y])
+			output /= self_ensemble
+
+		if self.max_value != 255.0:
+			output = np.multiply(output, 255.0 / self.max_value)
+
+		return output
+
+	def get_inference_tile_size(self, height, width):
+		""" returns --inference_tile_size, or a tile size which fits --memory_budget_mb (0 if no tiles are needed) """
+
+		if self.inference_tile_size > 0:
+			return self.inference_tile_size
+
+		tile_size = self.memory_planner.get_tile_size(height, width, self.get_tile_margin())
+		if tile_size < 0:
+			logging.error("Inference of %dx%d image doesn't fit memory_budget_mb:%d even with %dx%d tiles." % (
+				width, height, self.memory_planner.budget // memory_planner.MB, memory_planner.MIN_TILE_SIZE,
+				memory_planner.MIN_TILE_SIZE))
+			exit(-1)
+		return tile_size
+
+	def get_tile_margin(self):
+		""" LR pixels around each tile which affect the tile output """
+
+		return (self.receptive_fields + 1) // 2
+
+	def do(self, input_image, bicubic_input_image=None, tile_size=None):
+		""" tile_size: None is get_inference_tile_size(). 0 applies SR to the whole image by one sess.run. """
 
 		h, w = input_image.shape[:2]
 		ch = input_image.shape[2] if len(input_image.shape) > 2 else 1
 
+		if tile_size is None:
+			tile_size = self.get_inference_tile_size(h, w)
+		if 0 < tile_size < max(h, w):
+			return self.do_tiles(input_image, bicubic_input_image, tile_size)
+
 		if self.max_value != 255.0:
 			input_image = np.multiply(input_image, self.max_value / 255.0)  # type: np.ndarray
 
 		if bicubic_input_image is None:
-			bicubic_input_image = util.resize_image_by_pil(input_image, self.scale,
-			                                               resampling_method=self.resampling_method)
+			with profiler.scope("resize"):
+				bicubic_input_image = util.resize_image_by_pil(input_image, self.scale,
+				                                               resampling_method=self.resampling_method)
 
 		if self.self_ensemble > 1:
 			output = np.zeros([self.scale * h, self.scale * w, 1])
 
-			for i in range(self.self_ensemble):
-				image = util.flip(input_image, i)
-				bicubic_image = util.flip(bicubic_input_image, i)
-				y = self.sess.run(self.y_, feed_dict={self.x: image.reshape(1, image.shape[0], image.shape[1], ch),
-				                                      self.x2: bicubic_image.reshape(1, self.scale * image.shape[0],
-				                                                                     self.scale * image.shape[1],
-				                                                                     ch),
-				                                      self.dropout: 1.0, self.is_training: 0})
-				restored = util.flip(y[0], i, invert=True)
-				output += restored
-
-			output /= self.self_ensemble
+			with profiler.scope("ensemble"):
+				for i in range(self.self_ensemble):
+					image = util.flip(input_image, i)
+					bicubic_image = util.flip(bicubic_input_image, i)
+					with profiler.scope("forward"):
+						y = self.run(self.y_, {
+							self.x: image.reshape(1, image.shape[0], image.shape[1], ch),
+							self.x2: bicubic_image.reshape(1, self.scale * image.shape[0], self.scale * image.shape[1], ch),
+							self.dropout: 1.0, self.is_training: 0})
+					restored = util.flip(y[0], i, invert=True)
+					output += restored
+
+				output /= self.self_ensemble
 		else:
-			y = self.sess.run(self.y_, feed_dict={self.x: input_image.reshape(1, h, w, ch),
-			                                      self.x2: bicubic_input_image.reshape(1, self.scale * h,
-			                                                                           self.scale * w, ch),
-			                                      self.dropout: 1.0, self.is_training: 0})
+			with profiler.scope("forward"):
+				y = self.run(self.y_, {self.x: input_image.reshape(1, h, w, ch),
+				                       self.x2: bicubic_input_image.reshape(1, self.scale * h, self.scale * w, ch),
+				                       self.dropout: 1.0, self.is_training: 0})
 			output = y[0]
 
 		if self.max_value != 255.0:
@@ -500,48 +1109,113 @@ class SuperResolution(tf_graph.TensorflowGraph):
 
 		return hr_image
 
+	def do_tiles(self, input_image, bicubic_input_image, tile_size):
+		"""
+		do() for each [tile_size x tile_size] tile of the image. Each tile is processed with a margin of
+		get_tile_margin() pixels so that the stitched output is the same as the output of the whole image.
+		"""
+
+		h, w = input_image.shape[:2]
+		scale = self.scale
+		margin = self.get_tile_margin()
+
+		if bicubic_input_image is None:
+			# same as do(): bicubic image is built from the input scaled to max_value and is used as it is for tiles
+			scaled_input_image = input_image
+			if self.max_value != 255.0:
+				scaled_input_image = np.multiply(input_image, self.max_value / 255.0)
+			with profiler.scope("resize"):
+				bicubic_input_image = util.resize_image_by_pil(scaled_input_image, scale,
+				                                               resampling_method=self.resampling_method)
+
+		# tiles of the same size cover the whole image. the last tiles are aligned to the edges and overlap the others.
+		tile_h, tile_w = min(tile_size, h), min(tile_size, w)
+		ys = util.get_patch_positions(h, tile_h, tile_h, enable_duplicate=True)
+		xs = util.get_patch_positions(w, tile_w, tile_w, enable_duplicate=True)
+
+		output = np.zeros([scale * h, scale * w, self.output_channels])
+		with profiler.scope("tiles"):
+			for y in ys:
+				for x in xs:
+					y0, x0 = max(y - margin, 0), max(x - margin, 0)
+					y1, x1 = min(y + tile_h + margin, h), min(x + tile_w + margin, w)
+
+					hr_tile = self.do(input_image[y0:y1, x0:x1],
+					                  bicubic_input_image[scale * y0:scale * y1, scale * x0:scale * x1], tile_size=0)
+					hr_tile = hr_tile.reshape(scale * (y1 - y0), scale * (x1 - x0), -1)
+					top, left = scale * (y - y0), scale * (x - x0)
+					output[scale * y:scale * (y + tile_h), scale * x:scale * (x + tile_w)] = \
+						hr_tile[top:top + scale * tile_h, left:left + scale * tile_w]
+
+		return output
+
+	@profiler.profile("inference")
 	def do_for_file(self, file_path, output_folder="output"):
 
-		org_image = util.load_image(file_path)
+		with profiler.scope("load"):
+			org_image = util.load_image(file_path)
 
 		filename, extension = os.path.splitext(os.path.basename(file_path))
 		output_folder += "/" + self.name + "/"
-		util.save_image(output_folder + filename + extension, org_image)
+		with profiler.scope("save"):
+			util.save_image(output_folder + filename + extension, org_image)
 
 		if len(org_image.shape) >= 3 and org_image.shape[2] == 3 and self.channels == 1:
-			input_y_image = util.convert_rgb_to_y(org_image)
-			scaled_image = util.resize_image_by_pil(input_y_image, self.scale, resampling_method=self.resampling_method)
-			util.save_image(output_folder + filename + "_bicubic_y" + extension, scaled_image)
+			with profiler.scope("colour"):
+				input_y_image = util.convert_rgb_to_y(org_image)
+			with profiler.scope("resize"):
+				scaled_image = util.resize_image_by_pil(input_y_image, self.scale,
+				                                        resampling_method=self.resampling_method)
+			with profiler.scope("save"):
+				util.save_image(output_folder + filename + "_bicubic_y" + extension, scaled_image)
 			output_y_image = self.do(input_y_image)
-			util.save_image(output_folder + filename + "_result_y" + extension, output_y_image)
-
-			scaled_ycbcr_image = util.convert_rgb_to_ycbcr(
-				util.resize_image_by_pil(org_image, self.scale, self.resampling_method))
-			image = util.convert_y_and_cbcr_to_rgb(output_y_image, scaled_ycbcr_image[:, :, 1:3])
+			with profiler.scope("save"):
+				util.save_image(output_folder + filename + "_result_y" + extension, output_y_image)
+
+			with profiler.scope("resize"):
+				scaled_rgb_image = util.resize_image_by_pil(org_image, self.scale, self.resampling_method)
+			with profiler.scope("colour"):
+				scaled_ycbcr_image = util.convert_rgb_to_ycbcr(scaled_rgb_image)
+				image = util.convert_y_and_cbcr_to_rgb(output_y_image, scaled_ycbcr_image[:, :, 1:3])
 		else:
-			scaled_image = util.resize_image_by_pil(org_image, self.scale, resampling_method=self.resampling_method)
-			util.save_image(output_folder + filename + "_bicubic_y" + extension, scaled_image)
+			with profiler.scope("resize"):
+				scaled_image = util.resize_image_by_pil(org_image, self.scale, resampling_method=self.resampling_method)
+			with profiler.scope("save"):
+				util.save_image(output_folder + filename + "_bicubic_y" + extension, scaled_image)
 			image = self.do(org_image)
 
-		util.save_image(output_folder + filename + "_result" + extension, image)
+		with profiler.scope("save"):
+			util.save_image(output_folder + filename + "_result" + extension, image)
 
-	def do_for_evaluate_with_output(self, file_path, output_directory, print_console=False):
+	@profiler.profile("inference")
+	def do_for_evaluate_with_output(self, file_path, output_directory, print_console=False, writer=None):
+		""" evaluate the file and save result images. If writer (util.BackgroundWorker) is given, it saves them. """
 
 		filename, extension = os.path.splitext(file_path)
 		output_directory += "/" + self.name + "/"
 		util.make_dir(output_directory)
 
-		true_image = util.set_image_alignment(util.load_image(file_path, print_console=False), self.scale)
+		def save_image(path, image):
+			with profiler.scope("save"):
+				if writer is None:
+					util.save_image(path, image)
+				else:
+					writer.submit(util.save_image, path, image)
+
+		with profiler.scope("load"):
+			true_image = util.set_image_alignment(util.load_image(file_path, print_console=False), self.scale)
 
 		if true_image.shape[2] == 3 and self.channels == 1:
 
 			# for color images
-			input_y_image = loader.build_input_image(true_image, channels=self.channels, scale=self.scale,
-			                                         alignment=self.scale, convert_ycbcr=True)
-			input_bicubic_y_image = util.resize_image_by_pil(input_y_image, self.scale,
-			                                                 resampling_method=self.resampling_method)
+			with profiler.scope("resize"):
+				input_y_image = loader.build_input_image(true_image, channels=self.channels, scale=self.scale,
+				                                         alignment=self.scale, convert_ycbcr=True)
+				input_bicubic_y_image = util.resize_image_by_pil(input_y_image, self.scale,
+				                                                 resampling_method=self.resampling_method)
 
-			true_ycbcr_image = util.convert_rgb_to_ycbcr(true_image)
+			with profiler.scope("colour"):
+				true_ycbcr_image = util.convert_rgb_to_ycbcr(true_image)
 
 			output_y_image = self.do(input_y_image, input_bicubic_y_image)
 			mse = util.compute_mse(true_ycbcr_image[:, :, 0:1], output_y_image,
@@ -549,27 +1223,29 @@ class SuperResolution(tf_graph.TensorflowGraph):
 			loss_image = util.get_loss_image(true_ycbcr_image[:, :, 0:1], output_y_image,
 			                                 border_size=self.psnr_calc_border_size)
 
-			output_color_image = util.convert_y_and_cbcr_to_rgb(output_y_image, true_ycbcr_image[:, :, 1:3])
+			with profiler.scope("colour"):
+				output_color_image = util.convert_y_and_cbcr_to_rgb(output_y_image, true_ycbcr_image[:, :, 1:3])
 
-			util.save_image(output_directory + file_path, true_image)
-			util.save_image(output_directory + filename + "_input" + extension, input_y_image)
-			util.save_image(output_directory + filename + "_input_bicubic" + extension, input_bicubic_y_image)
-			util.save_image(output_directory + filename + "_true_y" + extension, true_ycbcr_image[:, :, 0:1])
-			util.save_image(output_directory + filename + "_result" + extension, output_y_image)
-			util.save_image(output_directory + filename + "_result_c" + extension, output_color_image)
-			util.save_image(output_directory + filename + "_loss" + extension, loss_image)
+			save_image(output_directory + file_path, true_image)
+			save_image(output_directory + filename + "_input" + extension, input_y_image)
+			save_image(output_directory + filename + "_input_bicubic" + extension, input_bicubic_y_image)
+			save_image(output_directory + filename + "_true_y" + extension, true_ycbcr_image[:, :, 0:1])
+			save_image(output_directory + filename + "_result" + extension, output_y_image)
+			save_image(output_directory + filename + "_result_c" + extension, output_color_image)
+			save_image(output_directory + filename + "_loss" + extension, loss_image)
 
 		elif true_image.shape[2] == 1 and self.channels == 1:
 
 			# for monochrome images
-			input_image = loader.build_input_image(true_image, channels=self.channels, scale=self.scale,
-			                                       alignment=self.scale)
-			input_bicubic_y_image = util.resize_image_by_pil(input_image, self.scale,
-			                                                 resampling_method=self.resampling_method)
+			with profiler.scope("resize"):
+				input_image = loader.build_input_image(true_image, channels=self.channels, scale=self.scale,
+				                                       alignment=self.scale)
+				input_bicubic_y_image = util.resize_image_by_pil(input_image, self.scale,
+				                                                 resampling_method=self.resampling_method)
 			output_image = self.do(input_image, input_bicubic_y_image)
 			mse = util.compute_mse(true_image, output_image, border_size=self.psnr_calc_border_size)
-			util.save_image(output_directory + file_path, true_image)
-			util.save_image(output_directory + filename + "_result" + extension, output_image)
+			save_image(output_directory + file_path, true_image)
+			save_image(output_directory + filename + "_result" + extension, output_image)
 		else:
 			mse = 0
 
@@ -578,29 +1254,51 @@ class SuperResolution(tf_graph.TensorflowGraph):
 
 		return mse
 
-	def do_for_evaluate(self, file_path, print_console=False):
+	def build_evaluation_image_set(self, file_path, crop_size=0):
+		"""
+		returns (input, input bicubic, true) images to evaluate the file or None if its channels are not supported.
+		If crop_size > 0, the image is center-cropped to crop_size x crop_size (at most) before building them.
+		"""
 
-		true_image = util.set_image_alignment(util.load_image(file_path, print_console=False), self.scale)
+		with profiler.scope("load"):
+			true_image = util.load_image(file_path, print_console=False)
+		if crop_size > 0:
+			height, width = min(crop_size, true_image.shape[0]), min(crop_size, true_image.shape[1])
+			y, x = (true_image.shape[0] - height) // 2, (true_image.shape[1] - width) // 2
+			true_image = true_image[y:y + height, x:x + width, :]
+		true_image = util.set_image_alignment(true_image, self.scale)
 
 		if true_image.shape[2] == 3 and self.channels == 1:
 
 			# for color images
-			input_y_image = loader.build_input_image(true_image, channels=self.channels, scale=self.scale,
-			                                         alignment=self.scale, convert_ycbcr=True)
-			true_y_image = util.convert_rgb_to_y(true_image)
-			input_bicubic_y_image = util.resize_image_by_pil(input_y_image, self.scale,
-			                                                 resampling_method=self.resampling_method)
-			output_y_image = self.do(input_y_image, input_bicubic_y_image)
-			mse = util.compute_mse(true_y_image, output_y_image, border_size=self.psnr_calc_border_size)
+			with profiler.scope("resize"):
+				input_image = loader.build_input_image(true_image, channels=self.channels, scale=self.scale,
+				                                       alignment=self.scale, convert_ycbcr=True)
+			with profiler.scope("colour"):
+				true_image = util.convert_rgb_to_y(true_image)
 
 		elif true_image.shape[2] == 1 and self.channels == 1:
 
 			# for monochrome images
-			input_image = loader.build_input_image(true_image, channels=self.channels, scale=self.scale,
-			                                       alignment=self.scale)
-			input_bicubic_y_image = util.resize_image_by_pil(input_image, self.scale,
-			                                                 resampling_method=self.resampling_method)
-			output_image = self.do(input_image, input_bicubic_y_image)
+			with profiler.scope("resize"):
+				input_image = loader.build_input_image(true_image, channels=self.channels, scale=self.scale,
+				                                       alignment=self.scale)
+		else:
+			return None
+
+		with profiler.scope("resize"):
+			input_bicubic_image = util.resize_image_by_pil(input_image, self.scale,
+			                                               resampling_method=self.resampling_method)
+		return input_image, input_bicubic_image, true_image
+
+	@profiler.profile("inference")
+	def do_for_evaluate(self, file_path, print_console=False):
+
+		image_set = self.build_evaluation_image_set(file_path)
+
+		if image_set is not None:
+			input_image, input_bicubic_image, true_image = image_set
+			output_image = self.do(input_image, input_bicubic_image)
 			mse = util.compute_mse(true_image, output_image, border_size=self.psnr_calc_border_size)
 		else:
 			mse = 0
@@ -617,12 +1315,88 @@ class SuperResolution(tf_graph.TensorflowGraph):
 		self.min_validation_mse = -1
 		self.min_validation_epoch = -1
 		self.step = 0
+		# accumulators are reset by init_all_variables()
+		self.accumulation_counts = {}
 
 		self.start_time = time.time()
 
 	def end_train_step(self):
+		if self.telemetry_worker is not None:
+			self.telemetry_worker.wait()
 		self.total_time = time.time() - self.start_time
 
+	def save_training_state(self, trial=0, writer=None):
+		"""
+		Save everything to resume the training at this step: variables with optimizer slots, learning rate
+		and epoch / step counters, loader's index and random states of python and numpy.
+		With gradient_accumulation, partially accumulated gradients and the number of accumulated mini-batches are
+		saved too. With tf.data pipeline, the loader's position after the last trained mini-batch is saved, so
+		mini-batches which are prefetched but not trained yet are generated again after resume.
+		Please note random states of tensorflow ops (dropout) can't be saved.
+		"""
+
+		accumulators = [accumulator for pairs in self.accumulators.values() for accumulator, _ in pairs]
+		state = {"lr": self.lr, "epochs_completed": self.epochs_completed,
+		         "epochs_completed_in_stage": self.epochs_completed_in_stage, "step": self.step,
+		         "training_step": self.training_step, "training_mse_sum": self.training_mse_sum,
+		         "training_psnr_sum": self.training_psnr_sum, "elapsed_time": time.time() - self.start_time,
+		         "loader": self.get_loader_state(), "python_random": random.getstate(),
+		         "numpy_random": np.random.get_state(),
+		         "accumulators": dict(zip([accumulator.name for accumulator in accumulators],
+		                                  self.sess.run(accumulators))),
+		         "accumulation_counts": {op.name: count for op, count in self.accumulation_counts.items()}}
+		self.save_state(state, trial=trial, writer=writer)
+
+	def get_loader_state(self):
+		if not self.use_input_pipeline:
+			return self.train.get_state()
+
+		with self.input_lock:
+			# mini-batches prefetched but not trained yet are generated again after resume
+			return self.train.get_state(self.input_position)
+
+	def set_loader_state(self, state):
+		with self.input_lock:
+			# stop the generator and restart the pipeline from the state
+			self.input_generation += 1
+			self.train.set_state(state)
+			self.input_position = None
+		self.input_restart_needed = self.use_input_pipeline
+
+	def load_training_state(self, trial=0):
+		""" restore the state saved by save_training_state(). should be called after init_epoch_index(). """
+
+		state = self.load_state(trial=trial)
+		if state is None:
+			return False
+
+		self.lr = state["lr"]
+		self.epochs_completed = state["epochs_completed"]
+		self.epochs_completed_in_stage = state["epochs_completed_in_stage"]
+		self.step = state["step"]
+		self.training_step = state["training_step"]
+		self.training_mse_sum = state["training_mse_sum"]
+		self.training_psnr_sum = state["training_psnr_sum"]
+		self.start_time = time.time() - state["elapsed_time"]
+		self.set_loader_state(state["loader"])
+		self.update_patch_curriculum()
+		random.setstate(state["python_random"])
+		np.random.set_state(state["numpy_random"])
+		self.load_accumulation_state(state.get("accumulators", {}), state.get("accumulation_counts", {}))
+
+		logging.info("Resumed from Epoch:%d Step:%s LR:%f" % (self.epochs_completed, "{:,}".format(self.step), self.lr))
+		return True
+
+	def load_accumulation_state(self, accumulators, accumulation_counts):
+		""" restore accumulated gradients and counts saved by save_training_state() (by the names of ops) """
+
+		for pairs in self.accumulators.values():
+			for accumulator, _ in pairs:
+				if accumulator.name in accumulators:
+					accumulator.load(accumulators[accumulator.name], self.sess)
+		self.accumulation_counts = {op: accumulation_counts[op.name] for op in self.apply_accumulated_ops
+		                            if op.name in accumulation_counts}
+
 	def print_steps_completed(self, output_to_logging=False):
 
 		if self.step == 0:
@@ -642,19 +1416,305 @@ class SuperResolution(tf_graph.TensorflowGraph):
 		else:
 			print(status)
 
-	def log_model_analysis(self):
+	def run(self, fetches, feed_dict=None, kind="inference"):
+		""" sess.run() which is run with full trace and recorded to the tracer when it's sampled """
+
+		if not tracer.sample(kind):
+			return self.sess.run(fetches, feed_dict=feed_dict)
+
+		result, run_metadata = self.run_with_trace(fetches, feed_dict)
+		tracer.add_run_metadata(run_metadata, kind)
+		return result
+
+	def run_with_trace(self, fetches, feed_dict=None):
+		""" returns (result, RunMetadata) of sess.run() with full trace """
+
 		run_metadata = tf.RunMetadata()
 		run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+		result = self.sess.run(fetches, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+		return result, run_metadata
+
+	def trace_training_step(self):
+		""" run one training step on the current mini-batch with full trace and returns RunMetadata """
+
+		feed_dict = {self.lr_input: self.lr, self.dropout: self.dropout_rate, self.is_training: 1}
+		if not self.use_input_pipeline:
+			feed_dict[self.x] = self.batch_input
+			feed_dict[self.x2] = self.batch_input_bicubic
+			feed_dict[self.y] = self.batch_true
+
+		_, run_metadata = self.run_with_trace([self.training_optimizer, self.mse], feed_dict)
+		if self.use_input_pipeline:
+			self.pop_input_positions(1)
+		return run_metadata
+
+	def trace_inference(self, test_filename):
+		""" run forward pass of the test image with full trace and returns (RunMetadata, input image shape) """
+
+		feed_dict = self.get_test_feed_dict(test_filename)
+		del feed_dict[self.y]
+
+		_, run_metadata = self.run_with_trace(self.y_, feed_dict)
+		return run_metadata, feed_dict[self.x].shape
+
+	def log_model_analysis(self, run_metadata, input_shape, title):
+		"""
+		log measured time / memory of each layer in the traced step with analytic GFLOPs, ranked by the time.
+		input_shape is [N, H, W, C] of the LR input of the step.
+		"""
+
+		costs = layer_profile.aggregate_run_metadata(run_metadata, self.layer_complexities)
+		input_pixels = int(input_shape[0] * input_shape[1] * input_shape[2])
+		logging.info("\n".join(layer_profile.format_hotspot_table(costs, input_pixels, title)))
+
+
+class MultiScaleSuperResolution(SuperResolution):
+	"""
+	DCSCN for multiple scales. One feature extraction (and NIN) network is shared by the upsampling / reconstruction
+	networks of each scale, so all scales are served by one model and one feature extraction pass.
+	set_scale() switches the scale used by the methods of SuperResolution (training, evaluation and do()).
+	"""
+
+	def __init__(self, flags, model_name=""):
+
+		self.scales = [int(scale) for scale in flags.scales.split(",")]
+		self.psnr_calc_border_size_arg = flags.psnr_calc_border_size
+
+		self.trains = {}
+		self.validation_sets = {}
+		self.x2s = {}
+		self.ys = {}
+		self.y_s = {}
+		self.mses = {}
+		self.losses = {}
+		self.training_optimizers = {}
+
+		super().__init__(flags, model_name)
+		self.set_scale(self.scales[0])
+
+		# loss summaries need inputs of all scales while summaries are run on one scale
+		self.save_loss = False
+
+	def get_model_name(self, model_name, name_postfix=""):
+		name = super().get_model_name(model_name, name_postfix)
+		if model_name == "":
+			name += "_MS%s" % "".join(str(scale) for scale in self.scales)
+		return name
+
+	def set_scale(self, scale):
+
+		self.scale = scale
+		if self.psnr_calc_border_size_arg < 0:
+			self.psnr_calc_border_size = 2 + scale
+		if scale in self.trains:
+			self.train = self.trains[scale]
+		self.validation_set = self.validation_sets.get(scale, [])
+		if scale in self.y_s:
+			self.x2, self.y, self.y_ = self.x2s[scale], self.ys[scale], self.y_s[scale]
+		if scale in self.training_optimizers:
+			self.mse, self.loss = self.mses[scale], self.losses[scale]
+			self.training_optimizer = self.training_optimizers[scale]
+
+	def load_dynamic_datasets(self, data_dir, batch_image_size):
+		for scale in self.scales:
+			self.scale = scale
+			super().load_dynamic_datasets(data_dir, batch_image_size)
+			self.trains[scale] = self.train
+		self.set_scale(self.scales[0])
+
+	def load_datasets(self, data_dir, batch_dir, batch_image_size, stride_size=0):
+		for scale in self.scales:
+			self.scale = scale
+			super().load_datasets(data_dir, batch_dir, batch_image_size, stride_size)
+			self.trains[scale] = self.train
+		self.set_scale(self.scales[0])
+
+	def build_input_pipeline(self, threads=4, prefetch_batches=2):
+		logging.warning("tf.data input pipeline is not supported for multi-scale model. Use feed_dict.")
+
+	def get_loaders(self):
+		return list(self.trains.values())
+
+	def init_epoch_index(self):
+		super().init_epoch_index()
+		for train in self.trains.values():
+			if train is not self.train:
+				train.init_batch_index()
+
+	def build_input_batch(self):
+		""" each training step uses the next scale. """
+
+		self.set_scale(self.scales[self.step % len(self.scales)])
+		super().build_input_batch()
+
+	def get_loader_state(self):
+		return {scale: train.get_state() for scale, train in self.trains.items()}
+
+	def set_loader_state(self, state):
+		for scale, train in self.trains.items():
+			train.set_state(state[scale])
+
+	def build_graph(self):
+
+		self.x = tf.placeholder(tf.float32, shape=[None, None, None, self.channels], name="x")
+		for scale in self.scales:
+			self.x2s[scale] = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels],
+			                                 name="x2_%d" % scale)
+			self.ys[scale] = tf.placeholder(tf.float32, shape=[None, None, None, self.output_channels],
+			                                name="y_%d" % scale)
+		self.dropout = tf.placeholder(tf.float32, shape=[], name="dropout_keep_rate")
+		self.is_training = tf.placeholder(tf.bool, name="is_training")
+
+		input_channels = self.build_feature_extraction(self.x)
+		trunk = self.H[-1]
+		self.trunk_weights = list(self.Weights)
+		self.head_weights = {}
+
+		pix_per_input = self.pix_per_input
+		receptive_fields = self.receptive_fields
+		for scale in self.scales:
+			self.pix_per_input = pix_per_input
+			self.receptive_fields = receptive_fields
+			head_start = len(self.Weights)
+			with tf.variable_scope("Scale%d" % scale):
+				self.y_s[scale] = self.build_reconstruction(trunk, input_channels, scale, self.x2s[scale])
+			self.head_weights[scale] = self.Weights[head_start:]
+
+		self.set_scale(self.scale)
+
+		logging.info("Feature:%s Complexity:%s Receptive Fields:%d Scales:%s" % (
+			self.features, "{:,}".format(self.complexity), self.receptive_fields, self.scales))
+
+	def build_optimizer(self, data_parallel=False):
+		""" build loss and training op for each scale. They share one optimizer (and its slots of trunk weights). """
+
+		if data_parallel:
+			logging.error("Data parallel training is not supported for multi-scale model.")
+			exit(-1)
+
+		if self.fused_steps > 1:
+			logging.warning("fused_steps is not supported for multi-scale model since it needs tf.data pipeline.")
+
+		self.lr_input = tf.placeholder(tf.float32, shape=[], name="LearningRate")
+		optimizer = self.create_optimizer(self.lr_input)
+
+		for scale in self.scales:
+			self.mses[scale], self.losses[scale] = self.build_loss(self.y_s[scale], self.ys[scale],
+			                                                       self.trunk_weights + self.head_weights[scale],
+			                                                       name_postfix="_x%d" % scale)
+			if self.batch_norm:
+				with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
+					self.training_optimizers[scale] = self.add_optimizer_op(self.losses[scale], self.lr_input, optimizer)
+			else:
+				self.training_optimizers[scale] = self.add_optimizer_op(self.losses[scale], self.lr_input, optimizer)
+
+		self.set_scale(self.scale)
+		util.print_num_of_total_parameters(output_detail=True)
+
+	def build_validation_set(self, test_filenames):
+		for scale in self.scales:
+			self.set_scale(scale)
+			super().build_validation_set(test_filenames)
+			self.validation_sets[scale] = self.validation_set
+
+	def evaluate_for_all_scales(self, evaluate):
+		""" run evaluate() for each scale and returns means of MSE and PSNR """
+
+		total_mse = total_psnr = 0
+
+		for scale in self.for_each_scale():
+			mse, psnr = evaluate()
+			logging.info("Scale:%d MSE:%f PSNR:%f" % (scale, mse, psnr))
+			total_mse += mse
+			total_psnr += psnr
+
+		return total_mse / len(self.scales), total_psnr / len(self.scales)
+
+	def for_each_scale(self):
+		""" yields each scale after set_scale(). the current scale is restored at the end. """
+
+		current_scale = self.scale
+		for scale in self.scales:
+			self.set_scale(scale)
+			yield scale
+		self.set_scale(current_scale)
+
+	def evaluate(self, test_filenames):
+		evaluate = super().evaluate
+		return self.evaluate_for_all_scales(lambda: evaluate(test_filenames))
+
+	def evaluate_validation_set(self):
+		return self.evaluate_for_all_scales(super().evaluate_validation_set)
+
+	def do_multi_scale(self, input_image, scales=None):
+		""" returns {scale: HR image} for scales (all scales if None). feature extraction runs once for each flip. """
+
+		if scales is None:
+			scales = self.scales
+
+		h, w = input_image.shape[:2]
+		ch = input_image.shape[2] if len(input_image.shape) > 2 else 1
+		input_image = input_image.reshape(h, w, ch)
+
+		if self.max_value != 255.0:
+			input_image = np.multiply(input_image, self.max_value / 255.0)  # type: np.ndarray
+
+		with profiler.scope("resize"):
+			bicubic_images = {scale: util.resize_image_by_pil(input_image, scale,
+			                                                  resampling_method=self.resampling_method)
+			                  for scale in scales}
+		outputs = {scale: 0 for scale in scales}
+
+		with profiler.scope("ensemble"):
+			for i in range(max(self.self_ensemble, 1)):
+				image = util.flip(input_image, i)
+				feed_dict = {self.x: image.reshape(1, image.shape[0], image.shape[1], ch), self.dropout: 1.0,
+				             self.is_training: 0}
+				for scale in scales:
+					bicubic_image = util.flip(bicubic_images[scale], i)
+					feed_dict[self.x2s[scale]] = bicubic_image.reshape(1, bicubic_image.shape[0],
+					                                                   bicubic_image.shape[1], ch)
+
+				with profiler.scope("forward"):
+					ys = self.run([self.y_s[scale] for scale in scales], feed_dict)
+				for scale, y in zip(scales, ys):
+					outputs[scale] += util.flip(y[0], i, invert=True)
+
+		for scale in scales:
+			outputs[scale] /= max(self.self_ensemble, 1)
+			if self.max_value != 255.0:
+				outputs[scale] = np.multiply(outputs[scale], 255.0 / self.max_value)
+
+		return outputs
+
+	@profiler.profile("inference")
+	def do_for_file(self, file_path, output_folder="output"):
+		""" save result images of all scales as [filename]_result_x[scale] """
+
+		with profiler.scope("load"):
+			org_image = util.load_image(file_path)
+
+		filename, extension = os.path.splitext(os.path.basename(file_path))
+		output_folder += "/" + self.name + "/"
+		util.save_image(output_folder + filename + extension, org_image)
+
+		if len(org_image.shape) >= 3 and org_image.shape[2] == 3 and self.channels == 1:
+			output_y_images = self.do_multi_scale(util.convert_rgb_to_y(org_image))
+
+			for scale, output_y_image in output_y_images.items():
+				util.save_image(output_folder + filename + "_result_y_x%d" % scale + extension, output_y_image)
+				scaled_ycbcr_image = util.convert_rgb_to_ycbcr(
+					util.resize_image_by_pil(org_image, scale, self.resampling_method))
+				image = util.convert_y_and_cbcr_to_rgb(output_y_image, scaled_ycbcr_image[:, :, 1:3])
+				util.save_image(output_folder + filename + "_result_x%d" % scale + extension, image)
+		else:
+			for scale, image in self.do_multi_scale(org_image).items():
+				util.save_image(output_folder + filename + "_result_x%d" % scale + extension, image)
+
+
+def create_model(flags, model_name=""):
+	""" returns MultiScaleSuperResolution if --scales is given, otherwise SuperResolution of --scale """
 
-		_, mse = self.sess.run([self.optimizer, self.mse], feed_dict={self.x: self.batch_input,
-		                                                              self.x2: self.batch_input_bicubic,
-		                                                              self.y: self.batch_true,
-		                                                              self.lr_input: self.lr,
-		                                                              self.dropout: self.dropout_rate},
-		                       options=run_options, run_metadata=run_metadata)
-
-		# tf.contrib.tfprof.model_analyzer.print_model_analysis(
-		#   tf.get_default_graph(),
-		#   run_meta=run_metadata,
-		#   tfprof_options=tf.contrib.tfprof.model_analyzer.PRINT_ALL_TIMING_MEMORY)
-		self.first_training = False
+	if flags.scales != "":
+		return MultiScaleSuperResolution(flags, model_name=model_name)
+	return SuperResolution(flags, model_name=model_name)
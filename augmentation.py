@@ -14,7 +14,7 @@ import numpy as np
 import os
 import tensorflow as tf
 
-from helper import args, utilty as util
+from helper import args, image_index, utilty as util
 
 args.flags.DEFINE_integer("augment_level", 4, "Augmentation level. 4:+LR/UD/LR-UD flipped, 7:+rotated")
 
@@ -28,7 +28,7 @@ def main(not_parsed_args):
 
 	print("Building x%d augmented data." % FLAGS.augment_level)
 
-	training_filenames = util.get_files_in_directory(FLAGS.data_dir + "/" + FLAGS.dataset + "/")
+	training_filenames = image_index.get_image_files(FLAGS.data_dir + "/" + FLAGS.dataset + "/")
 	target_dir = FLAGS.data_dir + "/" + FLAGS.dataset + ("_%d/" % FLAGS.augment_level)
 	util.make_dir(target_dir)
 
@@ -0,0 +1,476 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Author: Jin Yamanaka
+Github: https://github.com/jiny2001/dcscn-image-super-resolution
+
+Benchmarks for training / inference components.
+
+--benchmark resize: compare batched bicubic resampling with per-image PIL resampling
+--benchmark input_pipeline: compare training steps/sec of feed_dict and tf.data input
+--benchmark fused_steps: training steps/sec of tf.data input with one train_batch() per step and with --fused_steps
+--benchmark data_parallel: training steps/sec of data parallel training with --benchmark_workers processes
+--benchmark telemetry: overhead of each summary category (scalar, histogram, image) and background histograms
+--benchmark multi_scale: serving all --scales by one multi-scale model pass compared with one pass for each scale
+--benchmark texture_sampling: PSNR on set5 / set14 by training time with uniform, weighted and threshold texture sampling
+--benchmark precision: PSNR and evaluation time on set5 / set14 / bsd100 of the trained model in each --benchmark_precisions
+--benchmark curriculum: training time to reach the target validation PSNR with fixed patch size and --patch_curriculum
+--benchmark memory: predicted memory of the memory planner compared with measured peak RSS of training and inference
+"""
+
+import random
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import DCSCN
+from helper import args, data_parallel, image_index, memory_planner, utilty as util
+
+args.flags.DEFINE_string("benchmark", "resize", "Benchmark to run [resize, input_pipeline, fused_steps, data_parallel, telemetry, multi_scale, texture_sampling, curriculum, precision, memory]")
+args.flags.DEFINE_integer("benchmark_iterations", 50, "Number of iterations for each benchmark")
+args.flags.DEFINE_string("benchmark_workers", "1,2,4,8", "Numbers of worker processes for data_parallel benchmark")
+args.flags.DEFINE_string("benchmark_precisions", "fp16", "Precisions compared with fp32 in precision benchmark. bf16 needs a tensorflow build with bfloat16 Conv2D kernels")
+args.flags.DEFINE_string("benchmark_image_sizes", "128,256,512,1024", "LR image sizes for memory benchmark")
+args.flags.DEFINE_float("benchmark_target_psnr", 0, "Target validation PSNR for curriculum benchmark. 0: final PSNR of the fixed patch size training")
+
+FLAGS = args.get()
+
+
+def main(not_parsed_args):
+	if len(not_parsed_args) > 1:
+		print("Unknown args:%s" % not_parsed_args)
+		exit()
+
+	# benchmarks shouldn't clear tensorboard log of the training
+	FLAGS.initialize_tf_log = False
+
+	if FLAGS.benchmark == "resize":
+		benchmark_resize()
+	elif FLAGS.benchmark == "input_pipeline":
+		benchmark_input_pipeline()
+	elif FLAGS.benchmark == "fused_steps":
+		benchmark_fused_steps()
+	elif FLAGS.benchmark == "data_parallel":
+		data_parallel.benchmark(FLAGS.flag_values_dict(), [int(n) for n in FLAGS.benchmark_workers.split(",")],
+		                        FLAGS.benchmark_iterations)
+	elif FLAGS.benchmark == "telemetry":
+		benchmark_telemetry()
+	elif FLAGS.benchmark == "multi_scale":
+		benchmark_multi_scale()
+	elif FLAGS.benchmark == "texture_sampling":
+		benchmark_texture_sampling()
+	elif FLAGS.benchmark == "curriculum":
+		benchmark_curriculum()
+	elif FLAGS.benchmark == "precision":
+		benchmark_precision()
+	elif FLAGS.benchmark == "memory":
+		benchmark_memory()
+	else:
+		print("Unknown benchmark [%s]" % FLAGS.benchmark)
+
+
+def benchmark_resize():
+	""" Build input / bicubic images of mini-batch patches by both per-image PIL path and batched path. """
+
+	size = FLAGS.batch_image_size * FLAGS.scale
+
+	for dtype in [np.uint8, np.float64]:
+		true_images = (np.random.rand(FLAGS.batch_num, size, size, 1) * 255).astype(dtype)
+
+		start = time.time()
+		for _ in range(FLAGS.benchmark_iterations):
+			pil_input = [util.resize_image_by_pil(image, 1 / FLAGS.scale) for image in true_images]
+			pil_bicubic = [util.resize_image_by_pil(image, FLAGS.scale) for image in pil_input]
+		pil_time = (time.time() - start) / FLAGS.benchmark_iterations
+
+		start = time.time()
+		for _ in range(FLAGS.benchmark_iterations):
+			batch_input = util.resize_images_by_bicubic(true_images, 1 / FLAGS.scale)
+			batch_bicubic = util.resize_images_by_bicubic(batch_input, FLAGS.scale)
+		batch_time = (time.time() - start) / FLAGS.benchmark_iterations
+
+		input_diff = np.max(np.abs(np.stack(pil_input).astype(np.float64) - batch_input))
+		bicubic_diff = np.max(np.abs(np.stack(pil_bicubic).astype(np.float64) - batch_bicubic))
+
+		print("[%s] %d x %dx%d patches, scale:%d" % (np.dtype(dtype).name, FLAGS.batch_num, size, size, FLAGS.scale))
+		print("  PIL per-image: %2.3f[ms/batch] %s patches/sec" % (
+			pil_time * 1000, "{:,.0f}".format(FLAGS.batch_num / pil_time)))
+		print("  Batched      : %2.3f[ms/batch] %s patches/sec (x%2.2f)" % (
+			batch_time * 1000, "{:,.0f}".format(FLAGS.batch_num / batch_time), pil_time / batch_time))
+		print("  Max diff from PIL: input %f, bicubic %f" % (input_diff, bicubic_diff))
+
+
+def build_training_model(flags, use_tf_data=False):
+	model = DCSCN.SuperResolution(flags, model_name=flags.model_name)
+
+	if flags.build_batch:
+		model.load_datasets(flags.data_dir + "/" + flags.dataset, flags.batch_dir + "/" + flags.dataset,
+		                    flags.batch_image_size, flags.stride_size)
+	else:
+		model.load_dynamic_datasets(flags.data_dir + "/" + flags.dataset, flags.batch_image_size)
+	if use_tf_data:
+		model.build_input_pipeline(threads=flags.input_threads)
+	model.build_graph()
+	model.build_optimizer()
+	model.init_all_variables()
+	model.init_epoch_index()
+
+	return model
+
+
+def measure_training_steps(model, steps):
+	for _ in range(2):
+		model.build_input_batch()
+		model.train_batch()
+
+	start = time.time()
+	for _ in range(steps):
+		model.build_input_batch()
+		model.train_batch()
+	return steps / (time.time() - start)
+
+
+def benchmark_input_pipeline():
+	""" Train same model with feed_dict and tf.data pipeline. fed x, x2 and y override the pipeline. """
+
+	model = build_training_model(FLAGS, use_tf_data=True)
+
+	model.use_input_pipeline = False
+	feed_dict_steps = measure_training_steps(model, FLAGS.benchmark_iterations)
+
+	model.use_input_pipeline = True
+	tf_data_steps = measure_training_steps(model, FLAGS.benchmark_iterations)
+
+	print("%s, batch:%d x %dx%d, input threads:%d" % (
+		"build_batch" if FLAGS.build_batch else "dynamic", FLAGS.batch_num, FLAGS.batch_image_size,
+		FLAGS.batch_image_size, FLAGS.input_threads))
+	print("  feed_dict: %2.3f steps/sec" % feed_dict_steps)
+	print("  tf.data  : %2.3f steps/sec (x%2.2f)" % (tf_data_steps, tf_data_steps / feed_dict_steps))
+
+
+def benchmark_fused_steps():
+	""" Train same model by train_batch() on each step and by train_steps() with fused steps. """
+
+	if FLAGS.fused_steps <= 1:
+		FLAGS.fused_steps = 10
+	model = build_training_model(FLAGS, use_tf_data=True)
+
+	per_step = measure_training_steps(model, FLAGS.benchmark_iterations)
+
+	model.init_epoch_index()
+	model.train_steps(FLAGS.fused_steps)
+	steps = 0
+	start = time.time()
+	while steps < FLAGS.benchmark_iterations:
+		if model.training_step * model.batch_num >= model.training_images:
+			model.init_epoch_index()
+		steps += model.train_steps(FLAGS.fused_steps)
+	fused = steps / (time.time() - start)
+
+	print("tf.data input, batch:%d x %dx%d, fused steps:%d" % (
+		FLAGS.batch_num, FLAGS.batch_image_size, FLAGS.batch_image_size, FLAGS.fused_steps))
+	print("  train_batch() : %2.3f steps/sec" % per_step)
+	print("  train_steps() : %2.3f steps/sec (x%2.2f)" % (fused, fused / per_step))
+
+
+def measure_run(model, fetches, feed_dict, iterations):
+	model.sess.run(fetches, feed_dict=feed_dict)
+
+	start = time.time()
+	for _ in range(iterations):
+		model.sess.run(fetches, feed_dict=feed_dict)
+	return (time.time() - start) / iterations
+
+
+def benchmark_telemetry():
+	""" Time each summary category on the first test image as log_to_tensorboard() does in full telemetry mode. """
+
+	FLAGS.telemetry = "full"
+	FLAGS.save_loss = FLAGS.save_weights = FLAGS.save_images = True
+
+	model = DCSCN.SuperResolution(FLAGS, model_name=FLAGS.model_name)
+	model.build_graph()
+	model.build_optimizer()
+	model.init_all_variables()
+
+	test_filename = image_index.get_image_files(FLAGS.data_dir + "/" + FLAGS.test_dataset)[0]
+	feed_dict = model.get_test_feed_dict(test_filename)
+	iterations = FLAGS.benchmark_iterations
+
+	base_time = measure_run(model, model.mse, feed_dict, iterations)
+	print("Summary overhead on [%s] (forward pass only: %2.3f[ms])" % (test_filename, base_time * 1000))
+
+	for category in [util.SCALAR_SUMMARIES, util.HISTOGRAM_SUMMARIES, util.IMAGE_SUMMARIES]:
+		summaries = tf.get_collection(category)
+		if len(summaries) == 0:
+			continue
+		summary_time = measure_run(model, [tf.summary.merge(summaries), model.mse], feed_dict, iterations)
+		print("  %-20s: %3d ops, +%2.3f[ms]" % (category, len(summaries), (summary_time - base_time) * 1000))
+
+	summary_time = measure_run(model, [tf.summary.merge_all(), model.mse], feed_dict, iterations)
+	print("  %-20s: +%2.3f[ms]" % ("all (full)", (summary_time - base_time) * 1000))
+
+	# background mode: training thread only fetches weights, histograms are built by numpy in background
+	variables = model.Weights + model.Biases
+	fetch_time = measure_run(model, variables, None, iterations)
+	values = model.sess.run(variables)
+	start = time.time()
+	for _ in range(iterations):
+		for value in values:
+			np.histogram(value, bins=30)
+	histogram_time = (time.time() - start) / iterations
+	print("  %-20s: %2.3f[ms] in training thread, %2.3f[ms] in background" % (
+		"background histogram", fetch_time * 1000, histogram_time * 1000))
+
+
+def benchmark_multi_scale():
+	""" Compare one do_multi_scale() pass with do() for each scale (separate feature extraction for each scale). """
+
+	if FLAGS.scales == "":
+		FLAGS.scales = "2,3,4"
+	FLAGS.save_loss = FLAGS.save_weights = FLAGS.save_images = False
+
+	model = DCSCN.MultiScaleSuperResolution(FLAGS, model_name=FLAGS.model_name)
+	model.build_graph()
+	model.init_all_variables()
+
+	trunk_parameters = sum(int(np.prod(w.get_shape().as_list())) for w in model.trunk_weights)
+	head_parameters = {scale: sum(int(np.prod(w.get_shape().as_list())) for w in weights)
+	                   for scale, weights in model.head_weights.items()}
+
+	test_filename = image_index.get_image_files(FLAGS.data_dir + "/" + FLAGS.test_dataset)[0]
+	input_image = util.convert_rgb_to_y(util.load_image(test_filename, print_console=False))
+
+	model.do_multi_scale(input_image)
+	start = time.time()
+	for _ in range(FLAGS.benchmark_iterations):
+		model.do_multi_scale(input_image)
+	multi_scale_time = (time.time() - start) / FLAGS.benchmark_iterations
+
+	start = time.time()
+	for _ in range(FLAGS.benchmark_iterations):
+		for scale in model.scales:
+			model.set_scale(scale)
+			model.do(input_image)
+	single_scale_time = (time.time() - start) / FLAGS.benchmark_iterations
+
+	single_parameters = sum(trunk_parameters + parameters for parameters in head_parameters.values())
+	print("Scales %s on [%s] %dx%d, self ensemble:%d" % (
+		model.scales, test_filename, input_image.shape[1], input_image.shape[0], model.self_ensemble))
+	print("  weights (conv): shared model %s, separate models %s (x%2.2f)" % (
+		"{:,}".format(trunk_parameters + sum(head_parameters.values())), "{:,}".format(single_parameters),
+		single_parameters / (trunk_parameters + sum(head_parameters.values()))))
+	print("  one pass for all scales : %2.3f[ms]" % (multi_scale_time * 1000))
+	print("  one pass for each scale : %2.3f[ms] (x%2.2f)" % (
+		single_scale_time * 1000, single_scale_time / multi_scale_time))
+
+
+def train_and_evaluate(model, steps, evaluations, test_filenames):
+	""" train steps and returns [(steps, training time, {test dataset: PSNR})] at evaluations points. """
+
+	results = []
+	training_time = 0
+	for i in range(evaluations):
+		start = time.time()
+		for _ in range(steps // evaluations):
+			model.build_input_batch()
+			model.train_batch()
+		training_time += time.time() - start
+
+		psnrs = {test_data: model.evaluate(filenames)[1] for test_data, filenames in test_filenames.items()}
+		results.append((model.step, training_time, psnrs))
+	return results
+
+
+def benchmark_texture_sampling():
+	""" Train the same model with each texture sampling mode. """
+
+	FLAGS.self_ensemble = 1
+	FLAGS.save_loss = FLAGS.save_weights = FLAGS.save_images = False
+	test_filenames = {test_data: image_index.get_image_files(FLAGS.data_dir + "/" + test_data)
+	                  for test_data in ["set5", "set14"]}
+
+	for texture_sampling in ["", "weighted", "threshold"]:
+		FLAGS.texture_sampling = texture_sampling
+		random.seed(0)
+		np.random.seed(0)
+
+		model = build_training_model(FLAGS)
+		results = train_and_evaluate(model, FLAGS.benchmark_iterations, 5, test_filenames)
+		model.sess.close()
+
+		print("Texture sampling [%s]" % (texture_sampling if texture_sampling != "" else "uniform"))
+		for steps, training_time, psnrs in results:
+			print("  Step:%6d Time:%7.1f[sec] %s" % (steps, training_time, " ".join(
+				"%s:%2.3f" % (test_data, psnr) for test_data, psnr in psnrs.items())))
+
+
+def train_until_psnr(model, target_psnr):
+	""" train epochs until the validation PSNR reaches target_psnr or the schedule ends. returns [(epoch, time, PSNR)]. """
+
+	results = []
+	training_time = 0
+	model.init_train_step()
+	model.init_epoch_index()
+
+	while model.lr > FLAGS.end_lr:
+		start = time.time()
+		while model.training_step * model.batch_num < model.training_images:
+			model.build_input_batch()
+			model.train_batch()
+		training_time += time.time() - start
+
+		model.epochs_completed += 1
+		_, psnr = model.evaluate_validation_set()
+		results.append((model.epochs_completed, training_time, psnr))
+		if 0 < target_psnr <= psnr:
+			break
+
+		model.update_epoch_and_lr()
+		model.init_epoch_index()
+	return results
+
+
+def benchmark_curriculum():
+	""" Train with fixed batch_image_size and with the patch curriculum and compare the time to reach the same PSNR. """
+
+	FLAGS.save_loss = FLAGS.save_weights = FLAGS.save_images = False
+	curriculum = FLAGS.patch_curriculum if FLAGS.patch_curriculum != "" else "24,32,40"
+	test_filenames = image_index.get_image_files(FLAGS.data_dir + "/" + FLAGS.test_dataset)
+	target_psnr = FLAGS.benchmark_target_psnr
+
+	for patch_curriculum in ["", curriculum]:
+		FLAGS.patch_curriculum = patch_curriculum
+		random.seed(0)
+		np.random.seed(0)
+
+		model = build_training_model(FLAGS)
+		model.build_validation_set(test_filenames)
+		results = train_until_psnr(model, target_psnr)
+		model.sess.close()
+
+		if target_psnr <= 0:
+			# the fixed patch size training runs first and sets the target
+			target_psnr = results[-1][2]
+
+		print("Patch curriculum [%s] target PSNR:%2.3f on [%s]" % (
+			patch_curriculum if patch_curriculum != "" else "fixed %d" % FLAGS.batch_image_size, target_psnr,
+			FLAGS.test_dataset))
+		for epoch, training_time, psnr in results:
+			print("  Epoch:%3d Time:%7.1f[sec] PSNR:%2.3f" % (epoch, training_time, psnr))
+		reached = [training_time for _, training_time, psnr in results if psnr >= target_psnr]
+		if len(reached) > 0:
+			print("  Time to target: %2.1f[sec]" % reached[0])
+		else:
+			print("  Target not reached.")
+
+
+def benchmark_precision():
+	""" Evaluate the trained model (--load_model_name) in fp32 and each precision and compare PSNR and time. """
+
+	FLAGS.save_loss = FLAGS.save_weights = FLAGS.save_images = False
+	precisions = ["fp32"] + [precision for precision in FLAGS.benchmark_precisions.split(",") if precision != "fp32"]
+	test_filenames = {test_data: image_index.get_image_files(FLAGS.data_dir + "/" + test_data)
+	                  for test_data in ["set5", "set14", "bsd100"]}
+
+	results = {}
+	for precision in precisions:
+		FLAGS.precision = precision
+		model = DCSCN.create_model(FLAGS, model_name=FLAGS.model_name)
+		model.build_graph()
+		model.build_summary_saver()
+		model.init_all_variables()
+		model.load_model(FLAGS.load_model_name)
+
+		for test_data, filenames in test_filenames.items():
+			start = time.time()
+			_, psnr = model.evaluate(filenames)
+			results[precision, test_data] = (psnr, time.time() - start)
+		weight_bytes = sum(int(np.prod(w.get_shape().as_list())) for w in model.Weights) * model.compute_dtype.size
+		model.sess.close()
+
+		print("Precision [%s] conv weights read by each pass: %s bytes" % (precision, "{:,}".format(weight_bytes)))
+		for test_data in test_filenames:
+			psnr, evaluation_time = results[precision, test_data]
+			base_psnr, base_time = results["fp32", test_data]
+			print("  %-7s PSNR:%2.3f (%+2.3f) Time:%2.2f[sec] (x%2.2f)" % (
+				test_data, psnr, psnr - base_psnr, evaluation_time, base_time / evaluation_time))
+
+
+def measure_peak_rss(func):
+	""" returns (result of func(), peak RSS increase during func() in bytes) """
+
+	memory_planner.reset_peak_rss()
+	rss = memory_planner.get_rss()
+	result = func()
+	return result, memory_planner.get_peak_rss() - rss
+
+
+def print_memory(title, predicted, measured):
+	print("  %-36s predicted:%9s[MB] measured:%9s[MB] (x%2.2f)" % (
+		title, "{:,.1f}".format(predicted / memory_planner.MB), "{:,.1f}".format(measured / memory_planner.MB),
+		predicted / max(measured, 1)))
+
+
+def benchmark_memory():
+	"""
+	Measure peak RSS increase of loading the patch store, training steps and inference of each image size and compare
+	them with the predictions. Whole images are processed from the smallest since freed memory is kept by the allocator.
+	"""
+
+	FLAGS.save_loss = FLAGS.save_weights = FLAGS.save_images = False
+	if not memory_planner.reset_peak_rss():
+		print("Peak RSS can't be reset on this platform. Increases of the peak are measured.")
+
+	model = DCSCN.SuperResolution(FLAGS, model_name=FLAGS.model_name)
+	planner = model.memory_planner
+
+	print("Training: batch %d x %dx%d, optimizer:%s, precision:%s" % (
+		FLAGS.batch_num, FLAGS.batch_image_size, FLAGS.batch_image_size, FLAGS.optimizer, FLAGS.precision))
+	if FLAGS.build_batch:
+		_, measured = measure_peak_rss(lambda: model.load_datasets(
+			FLAGS.data_dir + "/" + FLAGS.dataset, FLAGS.batch_dir + "/" + FLAGS.dataset, FLAGS.batch_image_size,
+			FLAGS.stride_size))
+		print_memory("patch store (%s patches)" % "{:,}".format(model.train.count),
+		             planner.get_patch_store_bytes(model.train.count, FLAGS.batch_image_size), measured)
+	else:
+		model.load_dynamic_datasets(FLAGS.data_dir + "/" + FLAGS.dataset, FLAGS.batch_image_size)
+
+	def train():
+		model.build_graph()
+		model.build_optimizer()
+		model.init_all_variables()
+		model.init_epoch_index()
+		measure_training_steps(model, FLAGS.benchmark_iterations)
+
+	_, measured = measure_peak_rss(train)
+	print_memory("graph, weights and training steps",
+	             planner.get_weight_bytes(training=True) + planner.get_training_step_bytes(FLAGS.batch_num,
+	                                                                                      FLAGS.batch_image_size),
+	             measured)
+
+	print("Inference: scale:%d, self ensemble:%d" % (model.scale, model.self_ensemble))
+	sizes = sorted(int(size) for size in FLAGS.benchmark_image_sizes.split(","))
+
+	# tiled inference of the largest size first (before larger whole-image passes are allocated)
+	size = sizes[-1]
+	tile_size = max(sizes[0] - 2 * model.get_tile_margin(), memory_planner.MIN_TILE_SIZE)
+	image = np.random.rand(size, size, model.channels) * 255
+	_, measured = measure_peak_rss(lambda: model.do(image, tile_size=tile_size))
+	predictions = planner.predict_inference(size, size, tile_size, model.get_tile_margin())
+	print_memory("%dx%d by %dx%d tiles" % (size, size, tile_size, tile_size),
+	             predictions["host images"] + predictions["pass"], measured)
+
+	for size in sizes:
+		image = np.random.rand(size, size, model.channels) * 255
+		_, measured = measure_peak_rss(lambda: model.do(image, tile_size=0))
+		predictions = planner.predict_inference(size, size)
+		print_memory("%dx%d" % (size, size), predictions["host images"] + predictions["pass"], measured)
+
+	tiled = model.do(image[:sizes[0], :sizes[0]], tile_size=tile_size)
+	whole = model.do(image[:sizes[0], :sizes[0]], tile_size=0)
+	print("  Max diff of tiled and whole image output: %f" % np.max(np.abs(tiled - whole.reshape(tiled.shape))))
+
+
+if __name__ == '__main__':
+	tf.app.run()
@@ -3,41 +3,35 @@ Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connectio
 Author: Jin Yamanaka
 Github: https://github.com/jiny2001/dcscn-image-super-resolution
 
-Convert RGB(A)-(PNG or Jpeg) Image to Y-BMP images
+Convert RGB(A)-(PNG or Jpeg) Images to a packed Y-channel image store
 
 Put your images under data/[your dataset name]/ and specify [your dataset name] for --dataset.
-
+Images are converted by --processes worker processes and written to data/[your dataset name]_y/ as
+one uint8 arena file and its index. Specify [your dataset name]_y for --dataset of train.py to use it.
 
 """
+import argparse
 import os
-import tensorflow as tf
-from helper import args, utilty as util
 
-FLAGS = args.get()
+from helper import image_store
 
 
-def main(not_parsed_args):
-	if len(not_parsed_args) > 1:
-		print("Unknown args:%s" % not_parsed_args)
-		exit()
+def main():
+	parser = argparse.ArgumentParser(description="Convert dataset images to a packed Y-channel image store")
+	parser.add_argument("--dataset", default="bsd200", help="Dataset directory name under data_dir")
+	parser.add_argument("--data_dir", default="data", help="Directory for original images")
+	parser.add_argument("--processes", type=int, default=0, help="Number of worker processes. 0: number of CPUs")
+	flags = parser.parse_args()
 
 	print("Building Y channel data...")
 
-	training_filenames = util.get_files_in_directory(FLAGS.data_dir + "/" + FLAGS.dataset + "/")
-	target_dir = FLAGS.data_dir + "/" + FLAGS.dataset + "_y/"
-	util.make_dir(target_dir)
-
-	for file_path in training_filenames:
-		org_image = util.load_image(file_path)
-		if org_image.shape[2] == 3:
-			org_image = util.convert_rgb_to_y(org_image)
-
-		filename = os.path.basename(file_path)
-		filename, extension = os.path.splitext(filename)
+	source_dir = flags.data_dir + "/" + flags.dataset + "/"
+	target_dir = flags.data_dir + "/" + flags.dataset + "_y/"
 
-		new_filename = target_dir + filename
-		util.save_image(new_filename + ".bmp", org_image)
+	filenames = sorted(source_dir + f for f in os.listdir(source_dir)
+	                   if os.path.isfile(source_dir + f) and not f.startswith('.'))
+	image_store.build_image_store(filenames, target_dir, processes=flags.processes)
 
 
 if __name__ == '__main__':
-	tf.app.run()
+	main()
@@ -19,10 +19,13 @@ python3 evaluate.py --layers 4  --filters 24 --dataset new_test_data
 """
 
 import logging
+import os
+import time
+
 import tensorflow as tf
 
 import DCSCN
-from helper import args, utilty as util
+from helper import args, image_index, metrics, profiler, tracer, utilty as util
 
 args.flags.DEFINE_boolean("save_results", True, "Save result, bicubic and loss images")
 
@@ -34,7 +37,7 @@ def main(not_parsed_args):
 		print("Unknown args:%s" % not_parsed_args)
 		exit()
 
-	model = DCSCN.SuperResolution(FLAGS, model_name=FLAGS.model_name)
+	model = DCSCN.create_model(FLAGS, model_name=FLAGS.model_name)
 	model.build_graph()
 	model.build_summary_saver()
 	model.init_all_variables()
@@ -47,23 +50,50 @@ def main(not_parsed_args):
 	for i in range(FLAGS.tests):
 		model.load_model(FLAGS.load_model_name, trial=i, output_log=True if FLAGS.tests > 1 else False)
 		for test_data in test_list:
-			test(model, test_data)
+			with profiler.scope("evaluate"):
+				test(model, test_data)
+
+	profiler.log_summary()
+	tracer.save()
+	metrics.close()
 
 
 def test(model, test_data):
-	test_filenames = util.get_files_in_directory(FLAGS.data_dir + "/" + test_data)
+	""" evaluate test_data for each scale of the model. results of multi-scale model are saved in x[scale]/ """
+
+	for scale in model.for_each_scale():
+		test_scale(model, test_data, scale)
+
+
+def test_scale(model, test_data, scale):
+	test_filenames = image_index.get_image_files(FLAGS.data_dir + "/" + test_data)
 	total_psnr = total_mse = 0
+	start_time = time.time()
+
+	if FLAGS.save_results:
+		# result images are saved in background while next images are evaluated
+		writer = util.BackgroundWorker(max_pending=64, threads=FLAGS.eval_threads)
+		output_directory = FLAGS.output_dir if FLAGS.scales == "" else FLAGS.output_dir + "/x%d" % scale
+		mse_list = model.evaluate_files(test_filenames, output_directory=output_directory, writer=writer)
+	else:
+		writer = None
+		mse_list = model.evaluate_files(test_filenames)
 
-	for filename in test_filenames:
+	for filename, mse in zip(test_filenames, mse_list):
 		if FLAGS.save_results:
-			mse = model.do_for_evaluate_with_output(filename, output_directory=FLAGS.output_dir, print_console=True)
-		else:
-			mse = model.do_for_evaluate(filename, print_console=False)
+			print("[%s] MSE:%f, PSNR:%f" % (os.path.splitext(filename)[0], mse, util.get_psnr(mse)))
 		total_mse += mse
 		total_psnr += util.get_psnr(mse, max_value=FLAGS.max_value)
 
-	logging.info("\n=== Average [%s] MSE:%f, PSNR:%f ===" % (
-		test_data, total_mse / len(test_filenames), total_psnr / len(test_filenames)))
+	if writer is not None:
+		writer.close()
+
+	logging.info("\n=== Average [%s x%d] MSE:%f, PSNR:%f ===" % (
+		test_data, scale, total_mse / len(test_filenames), total_psnr / len(test_filenames)))
+	metrics.record("evaluation", {"mse": total_mse / len(test_filenames), "psnr": total_psnr / len(test_filenames),
+	                              "images": len(test_filenames), "seconds": time.time() - start_time},
+	               {"dataset": test_data, "scale": scale})
+	metrics.flush()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,130 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Ver: 2.0
+
+Evaluate epoch checkpoints in a separate process while training
+
+Run train.py with --save_epoch_checkpoints True (and --epoch_evaluation False not to evaluate in training)
+then run this script with the same model args. It polls checkpoint_dir for new [model name]_E[epoch].ckpt,
+evaluates each of them on --watch_datasets and writes PSNR to tensorboard log (tf_log_dir/test).
+It finishes when the final model of the last trial ([model name](_[tests - 1]).ckpt) is saved and all the epoch
+checkpoints are evaluated.
+
+python train.py --save_epoch_checkpoints True --epoch_evaluation False
+python evaluate_watcher.py --intra_op_threads 2 --watch_datasets set5,set14,bsd100
+"""
+
+import logging
+import os
+import re
+import time
+
+import tensorflow as tf
+
+import DCSCN
+from helper import args, image_index, utilty as util
+
+args.flags.DEFINE_string("watch_datasets", "set5,set14,bsd100", "Test datasets to evaluate each checkpoint")
+args.flags.DEFINE_integer("watch_interval", 30, "Interval (sec) to check new checkpoints")
+args.flags.DEFINE_integer("watch_timeout", 0, "Finish if no new checkpoint is found for this time (sec). 0: no timeout")
+
+FLAGS = args.get()
+
+
+def main(not_parsed_args):
+	if len(not_parsed_args) > 1:
+		print("Unknown args:%s" % not_parsed_args)
+		exit()
+
+	# watcher shouldn't clear or duplicate logs of the training
+	FLAGS.initialize_tf_log = False
+	FLAGS.save_loss = FLAGS.save_weights = FLAGS.save_images = FLAGS.save_meta_data = False
+	FLAGS.log_filename = os.path.splitext(FLAGS.log_filename)[0] + "_watcher.txt"
+
+	model = DCSCN.create_model(FLAGS, model_name=FLAGS.model_name)
+	model.build_graph()
+	model.build_summary_saver()
+	writer = tf.summary.FileWriter(FLAGS.tf_log_dir + "/test")
+
+	test_filenames = {test_data: image_index.get_image_files(FLAGS.data_dir + "/" + test_data)
+	                  for test_data in FLAGS.watch_datasets.split(",")}
+
+	evaluated = set()
+	last_found_time = time.time()
+
+	while True:
+		all_checkpoints = find_epoch_checkpoints(model.checkpoint_dir, model.name)
+		checkpoints = [checkpoint for checkpoint in all_checkpoints if checkpoint[2] not in evaluated]
+
+		if len(checkpoints) == 0:
+			if is_training_finished(model.checkpoint_dir, model.name, FLAGS.tests - 1, all_checkpoints):
+				break
+			if 0 < FLAGS.watch_timeout < time.time() - last_found_time:
+				logging.info("No new checkpoint for %d sec. Finished." % FLAGS.watch_timeout)
+				break
+			time.sleep(FLAGS.watch_interval)
+			continue
+
+		for epoch, trial, filename in checkpoints:
+			try:
+				model.saver.restore(model.sess, filename)
+			except (tf.errors.OpError, ValueError) as error:
+				# checkpoint may be still being written. retry at the next check.
+				logging.warning("Can't restore [%s]: %s" % (filename, error))
+				time.sleep(FLAGS.watch_interval)
+				break
+
+			evaluate(model, writer, test_filenames, epoch, trial)
+			evaluated.add(filename)
+		last_found_time = time.time()
+
+
+def find_epoch_checkpoints(checkpoint_dir, name):
+	""" returns (epoch, trial, checkpoint filename) of epoch checkpoints sorted by epoch. """
+
+	pattern = re.compile("^" + re.escape(name) + r"_E(\d+)(?:_(\d+))?\.ckpt\.index$")
+	checkpoints = []
+
+	for filename in os.listdir(checkpoint_dir):
+		match = pattern.match(filename)
+		if match:
+			checkpoints.append((int(match.group(1)), int(match.group(2) or 0),
+			                    checkpoint_dir + "/" + filename[:-len(".index")]))
+
+	return sorted(checkpoints)
+
+
+def is_training_finished(checkpoint_dir, name, last_trial, checkpoints):
+	"""
+	train.py saves the final model of each trial after its epoch checkpoints. returns True if the final model of the
+	last trial is saved. (old final model of other training is ignored)
+	"""
+
+	if last_trial > 0:
+		final_model_filename = checkpoint_dir + "/" + name + "_" + str(last_trial) + ".ckpt"
+	else:
+		final_model_filename = checkpoint_dir + "/" + name + ".ckpt"
+
+	checkpoints = [checkpoint for checkpoint in checkpoints if checkpoint[1] == last_trial]
+	if len(checkpoints) == 0 or not os.path.isfile(final_model_filename + ".index"):
+		return False
+	last_checkpoint_time = max(os.path.getmtime(filename + ".index") for _, _, filename in checkpoints)
+	return os.path.getmtime(final_model_filename + ".index") >= last_checkpoint_time
+
+
+def evaluate(model, writer, test_filenames, epoch, trial):
+
+	for test_data, filenames in test_filenames.items():
+		mse, psnr = model.evaluate(filenames)
+
+		tag = "PSNR" if test_data == FLAGS.test_dataset else "PSNR_" + test_data
+		if trial > 0:
+			tag += "_%d" % trial
+		util.log_scalar_value(writer, tag, psnr, epoch)
+		logging.info("Epoch:%d Trial:%d [%s] MSE:%f, PSNR:%f" % (epoch, trial, test_data, mse, psnr))
+
+	writer.flush()
+
+
+if __name__ == '__main__':
+	tf.app.run()
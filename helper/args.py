@@ -15,6 +15,7 @@ FLAGS = flags.FLAGS
 
 # Model (network) Parameters
 flags.DEFINE_integer("scale", 2, "Scale factor for Super Resolution (should be 2 or more)")
+flags.DEFINE_string("scales", "", "Scale factors of multi-scale model which shares feature extraction like '2,3,4'. If empty, use [scale].")
 flags.DEFINE_integer("layers", 12, "Number of layers of feature xxtraction CNNs")
 flags.DEFINE_integer("filters", 196, "Number of filters of first feature-extraction CNNs")
 flags.DEFINE_integer("min_filters", 48, "Number of filters of last feature-extraction CNNs")
@@ -30,9 +31,11 @@ flags.DEFINE_string("activator", "prelu", "Activator can be [relu, leaky_relu, p
 flags.DEFINE_boolean("pixel_shuffler", True, "Use Pixel Shuffler instead of transposed CNN")
 flags.DEFINE_integer("self_ensemble", 8, "Number of using self ensemble method. [1 - 8]")
 flags.DEFINE_boolean("batch_norm", False, "use batch normalization after each CNNs")
+flags.DEFINE_string("precision", "fp32", "Compute precision of CNNs [fp32, fp16, bf16]. Weights are kept in float32.")
 
 # Training Parameters
 flags.DEFINE_boolean("bicubic_init", True, "make bicubic interpolation values as initial input for x2")
+flags.DEFINE_float("loss_scale", 128, "Loss scaling factor for fp16 precision training")
 flags.DEFINE_float("clipping_norm", 5, "Norm for gradient clipping. If it's <= 0 we don't use gradient clipping.")
 flags.DEFINE_string("initializer", "he", "Initializer for weights can be [uniform, stddev, xavier, he, identity, zero]")
 flags.DEFINE_float("weight_dev", 0.01, "Initial weight stddev (won't be used when you use he or xavier initializer)")
@@ -42,9 +45,16 @@ flags.DEFINE_float("beta1", 0.1, "Beta1 for adam optimizer")
 flags.DEFINE_float("beta2", 0.1, "Beta2 for adam optimizer")
 flags.DEFINE_float("momentum", 0.9, "Momentum for momentum optimizer and rmsprop optimizer")
 flags.DEFINE_integer("batch_num", 20, "Number of mini-batch images for training")
+flags.DEFINE_integer("gradient_accumulation", 1, "Accumulate gradients of this number of mini-batches and apply them at once. Effective batch size will be batch_num x this.")
 flags.DEFINE_integer("batch_image_size", 48, "Image size for mini-batch")
+flags.DEFINE_string("patch_curriculum", "", "Patch sizes for the first learning rate stages like '24,32,40'. Later stages use batch_image_size. batch_num is not changed.")
 flags.DEFINE_integer("stride_size", 0, "Stride size for mini-batch. If it is 0, use half of batch_image_size")
 flags.DEFINE_integer("training_images", 24000, "Number of training on each epoch")
+flags.DEFINE_boolean("area_weighted_sampling", False, "Sample training images in proportion to their area when loading dynamically")
+flags.DEFINE_string("texture_sampling", "", "Sample patches by texture score (gradient energy) [weighted, threshold]. If empty, sample uniformly.")
+flags.DEFINE_float("texture_threshold", 0.3, "Ratio of the flattest patches skipped by threshold texture sampling")
+flags.DEFINE_integer("hard_example_half_life", 0, "Sample patches in proportion to their recent training loss. Old losses decay toward the mean loss with this half life (steps). 0: disabled")
+flags.DEFINE_integer("batch_augment", 1, "Number of flip / rotate patterns [1-8] randomly applied to each mini-batch image. 1: no augmentation")
 
 # Learning Rate Control for Training
 flags.DEFINE_float("initial_lr", 0.002, "Initial learning rate")
@@ -57,12 +67,21 @@ flags.DEFINE_string("dataset", "bsd200", "Training dataset dir. [yang91, general
 flags.DEFINE_string("test_dataset", "set5", "Directory for test dataset [set5, set14, bsd100, urban100, all]")
 flags.DEFINE_integer("tests", 1, "Number of training sets")
 flags.DEFINE_boolean("do_benchmark", False, "Evaluate the performance for set5, set14 and bsd100 after the training.")
+flags.DEFINE_integer("validation_ensemble", 0, "Number of self ensemble for per-epoch validation. If 0, use self_ensemble. Full evaluation with [self_ensemble] is done at each LR decay.")
+flags.DEFINE_integer("validation_images", 0, "Number of test images used for per-epoch validation. If 0, use all images.")
+flags.DEFINE_integer("validation_crop", 0, "Center-crop test images to this size for per-epoch validation. If 0, use whole images.")
+flags.DEFINE_integer("validation_batch_num", 8, "Number of same-sized validation images processed in one batch")
+flags.DEFINE_boolean("epoch_evaluation", True, "Evaluate test dataset after each epoch. Set False when evaluate_watcher.py evaluates epoch checkpoints.")
+flags.DEFINE_boolean("save_epoch_checkpoints", False, "Save model as [model name]_E[epoch].ckpt after each epoch for evaluate_watcher.py")
 
 # Image Processing
 flags.DEFINE_float("max_value", 255, "For normalize image pixel value")
 flags.DEFINE_integer("channels", 1, "Number of image channels used. Now it should be 1. using only Y from YCbCr.")
 flags.DEFINE_integer("psnr_calc_border_size", -1, "Cropping border size for calculating PSNR. if < 0, use 2 + scale for default.")
 flags.DEFINE_boolean("build_batch", False, "Build pre-processed input batch. Makes training significantly faster but the patches are limited to be on the grid.")
+flags.DEFINE_boolean("use_tf_data", False, "Feed training batches by tf.data pipeline instead of feed_dict")
+flags.DEFINE_integer("input_threads", 4, "Number of parallel threads to build training batches in tf.data pipeline")
+flags.DEFINE_integer("fused_steps", 1, "With tf.data pipeline, run this number of training steps by one session call of an in-graph training loop which returns their MSE / PSNR sums.")
 
 # Environment (all directory name should not contain '/' after )
 flags.DEFINE_string("checkpoint_dir", "models", "Directory for checkpoints")
@@ -74,6 +93,15 @@ flags.DEFINE_string("tf_log_dir", "tf_log", "Directory for tensorboard log")
 flags.DEFINE_string("log_filename", "log.txt", "log filename")
 flags.DEFINE_string("model_name", "", "model name for save files and tensorboard log")
 flags.DEFINE_string("load_model_name", "", "Filename of model loading before start [filename or 'default']")
+flags.DEFINE_boolean("export_half_precision", False, "Also save float16 weights as [model name]_fp16.ckpt for inference after the training")
+flags.DEFINE_boolean("resume", False, "Resume the training from the last saved training state")
+flags.DEFINE_integer("checkpoint_epochs", 1, "Save training state to resume every this epochs. If 0, don't save.")
+flags.DEFINE_integer("checkpoint_steps", 0, "Also save training state every this steps. If 0, don't save.")
+
+# Session
+flags.DEFINE_integer("intra_op_threads", 0, "Number of threads used inside each operation. 0: tensorflow default")
+flags.DEFINE_integer("inter_op_threads", 0, "Number of operations executed in parallel. 0: tensorflow default")
+flags.DEFINE_integer("eval_threads", 4, "Number of threads to evaluate test images concurrently. 1: evaluate one by one")
 
 # Debugging or Logging
 flags.DEFINE_boolean("initialize_tf_log", True, "Clear all tensorboard log before start")
@@ -82,6 +110,18 @@ flags.DEFINE_boolean("save_weights", True, "Save weights and biases")
 flags.DEFINE_boolean("save_images", True, "Save CNN weights as images")
 flags.DEFINE_integer("save_images_num", 20, "Number of CNN images saved")
 flags.DEFINE_boolean("save_meta_data", False, "")
+flags.DEFINE_string("telemetry", "full", "Summaries for tensorboard [full, scalar, background]. scalar: no histogram / image summaries. background: scalar + weight histograms computed in background thread.")
+flags.DEFINE_integer("summary_interval", 1, "Run summaries every this epochs. PSNR and LR are logged every epoch.")
+flags.DEFINE_boolean("profile", False, "Measure time of training / inference stages and log the summary")
+flags.DEFINE_integer("profile_interval", 0, "Log profiler summary every this epochs. 0: only at the end of the training")
+flags.DEFINE_integer("memory_budget_mb", 0, "Exit if training doesn't fit this memory (suggests batch_num) and tile inference to fit. 0: no budget")
+flags.DEFINE_boolean("ignore_memory_budget", False, "Only warn (don't exit) if training doesn't fit memory_budget_mb")
+flags.DEFINE_integer("inference_tile_size", 0, "Apply SR to tiles of this LR size. 0: tiles only when the image doesn't fit memory_budget_mb")
+flags.DEFINE_string("metrics_jsonl", "", "Append training / evaluation / inference metrics to this JSONL file")
+flags.DEFINE_string("metrics_prometheus", "", "Write metrics to this Prometheus text format file (for textfile collector)")
+flags.DEFINE_string("trace_file", "", "Write chrome://tracing JSON of stages and sampled sess.run to this file")
+flags.DEFINE_integer("trace_interval", 100, "Trace every this sess.run of training / inference with full trace")
+flags.DEFINE_integer("trace_max_steps", 10, "Max number of traced sess.run of training / inference")
 
 
 def get():
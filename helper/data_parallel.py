@@ -0,0 +1,284 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Ver: 2
+
+synchronous data parallel training with local worker processes.
+
+Each worker process builds the same model and computes gradients for its own shard of the mini-batch.
+All workers take the same permutations of the patch index (by a shared seed) and each of them uses its own share
+of every global mini-batch, so the global mini-batch is taken from one index as in a single process.
+Patches of the patch store are read-only memory maps shared by the workers (built once by prepare_batch()).
+Gradients are all-reduced over shared memory (each worker averages one chunk of the flattened gradients)
+and then every worker applies the same mean gradients, so all the replicas keep identical weights.
+"""
+
+import argparse
+import ctypes
+import logging
+import multiprocessing
+import os
+import random
+import time
+
+import numpy as np
+
+from helper import image_index, loader
+
+
+class SharedAllReduce:
+	""" all-reduce (mean) of float32 vectors between local processes by shared memory and barriers. """
+
+	def __init__(self, workers, size, context):
+		self.workers = workers
+		self.size = size
+		self.slots = context.RawArray(ctypes.c_float, workers * size)
+		self.result = context.RawArray(ctypes.c_float, size)
+		self.barrier = context.Barrier(workers)
+
+	def get_chunk(self, rank):
+		chunk_size = (self.size + self.workers - 1) // self.workers
+		return min(rank * chunk_size, self.size), min((rank + 1) * chunk_size, self.size)
+
+	def all_reduce(self, rank, values):
+		slots = np.frombuffer(self.slots, dtype=np.float32).reshape(self.workers, self.size)
+		result = np.frombuffer(self.result, dtype=np.float32)
+
+		slots[rank] = values
+		self.barrier.wait()
+
+		start, end = self.get_chunk(rank)
+		result[start:end] = np.mean(slots[:, start:end], axis=0)
+		self.barrier.wait()
+
+		# result is not overwritten until every worker passes the first barrier of the next call
+		return result.copy()
+
+	def broadcast(self, rank, values=None):
+		result = np.frombuffer(self.result, dtype=np.float32)
+
+		if rank == 0:
+			result[:len(values)] = values
+		self.barrier.wait()
+		values = result.copy()
+		self.barrier.wait()
+
+		return values
+
+
+def check_flags(flags_dict, workers):
+	""" exit if the model can't be trained in data parallel. warn if the mini-batch is not divided evenly. """
+
+	if flags_dict["scales"] != "":
+		logging.error("Data parallel training is not supported for multi-scale model (--scales).")
+		exit(-1)
+
+	if flags_dict["hard_example_half_life"] > 0:
+		logging.warning("Hard example mining doesn't update losses in data parallel training.")
+
+	if flags_dict["batch_num"] % workers != 0:
+		logging.warning("batch_num %d is not divisible by %d workers. Global mini-batch is %d." % (
+			flags_dict["batch_num"], workers, max(flags_dict["batch_num"] // workers, 1) * workers))
+
+
+def get_worker_flags(flags_dict, rank, workers):
+
+	flags = argparse.Namespace(**flags_dict)
+	flags.batch_num = max(flags.batch_num // workers, 1)
+	if rank > 0:
+		# only the first worker writes logs and summaries
+		flags.log_filename = os.devnull
+		flags.initialize_tf_log = False
+		flags.save_loss = flags.save_weights = flags.save_images = flags.save_meta_data = False
+	return flags
+
+
+def build_worker_model(flags, rank, workers, all_reduce, index_seed):
+	import DCSCN
+
+	# random states of the augmentation (and dropout) are different for each worker
+	random.seed(rank)
+	np.random.seed(rank)
+
+	model = DCSCN.SuperResolution(flags, model_name=flags.model_name)
+	if flags.build_batch:
+		model.load_datasets(flags.data_dir + "/" + flags.dataset, flags.batch_dir + "/" + flags.dataset,
+		                    flags.batch_image_size, flags.stride_size, memory_map=True)
+	else:
+		model.load_dynamic_datasets(flags.data_dir + "/" + flags.dataset, flags.batch_image_size)
+	model.train.set_shard(rank, workers, index_seed)
+	if flags.use_tf_data:
+		model.build_input_pipeline(threads=flags.input_threads)
+	model.build_graph()
+	model.build_optimizer(data_parallel=True)
+	model.build_summary_saver()
+
+	model.init_all_variables()
+	if rank == 0 and flags.load_model_name != "":
+		model.load_model(flags.load_model_name, output_log=True)
+
+	# start from the same weights
+	model.set_trainable_values(all_reduce.broadcast(rank, model.get_trainable_values() if rank == 0 else None))
+	return model
+
+
+def run_training_worker(rank, workers, flags_dict, all_reduce, index_seed):
+
+	flags = get_worker_flags(flags_dict, rank, workers)
+	model = build_worker_model(flags, rank, workers, all_reduce, index_seed)
+
+	# each worker trains its share of training_images for one epoch
+	model.training_images = int(np.ceil(flags_dict["training_images"] / (flags.batch_num * workers)) * flags.batch_num)
+	test_filenames = image_index.get_image_files(flags.data_dir + "/" + flags.test_dataset)
+	if rank == 0:
+		model.build_validation_set(test_filenames)
+
+	model.init_train_step()
+	model.init_epoch_index()
+	model_updated = True
+
+	while model.lr > flags.end_lr:
+
+		model.build_input_batch()
+		model.train_batch_with_all_reduce(lambda values: all_reduce.all_reduce(rank, values))
+
+		if model.training_step * model.batch_num >= model.training_images:
+
+			model.epochs_completed += 1
+			if rank == 0:
+				full_evaluation = model.is_lr_decay_epoch()
+				if full_evaluation:
+					mse, psnr = model.evaluate(test_filenames)
+				else:
+					mse, psnr = model.evaluate_validation_set()
+				model.print_status(mse, psnr, log=model_updated)
+				model.log_to_tensorboard(test_filenames[0], psnr, save_meta_data=model_updated,
+				                         full_evaluation=full_evaluation)
+
+			model_updated = model.update_epoch_and_lr()
+			model.init_epoch_index()
+
+	model.end_train_step()
+	if rank == 0:
+		model.print_steps_completed(output_to_logging=True)
+		model.save_model(output_log=True)
+
+
+def run_benchmark_worker(rank, workers, flags_dict, all_reduce, steps, results):
+
+	flags = get_worker_flags(flags_dict, rank, workers)
+	model = build_worker_model(flags, rank, workers, all_reduce, 0)
+	model.init_epoch_index()
+
+	for i in range(steps + 2):
+		if i == 2:
+			# first steps are warm up
+			start = time.time()
+		model.build_input_batch()
+		model.train_batch_with_all_reduce(lambda values: all_reduce.all_reduce(rank, values))
+
+	if rank == 0:
+		results.put(steps / (time.time() - start))
+
+
+def run_parameter_counter(flags_dict, results):
+	import tensorflow as tf
+	import DCSCN
+
+	flags = argparse.Namespace(**dict(flags_dict, log_filename=os.devnull, initialize_tf_log=False))
+	model = DCSCN.SuperResolution(flags, model_name=flags.model_name)
+	model.build_graph()
+	results.put(sum(int(np.prod(var.get_shape().as_list())) for var in tf.trainable_variables()))
+
+
+def count_parameters(flags_dict):
+	""" count trainable parameters by building the model in a child process (parent keeps no tf session). """
+
+	return run_processes(run_parameter_counter, [(flags_dict,)], with_results=True)[0]
+
+
+def run_processes(target, args_list, with_results=False):
+	""" run target(*args[, results]) in processes. If a process fails, the others are terminated. """
+
+	context = multiprocessing.get_context("spawn")
+	results = context.Queue() if with_results else None
+
+	processes = [context.Process(target=target, args=args + ((results,) if with_results else ()))
+	             for args in args_list]
+	for process in processes:
+		process.start()
+
+	values = []
+	while any(process.is_alive() for process in processes):
+		if with_results:
+			while not results.empty():
+				values.append(results.get())
+		if any(process.exitcode not in (None, 0) for process in processes):
+			logging.error("Worker process failed. Terminating all workers.")
+			for process in processes:
+				process.terminate()
+			break
+		time.sleep(0.5)
+
+	for process in processes:
+		process.join()
+	if with_results:
+		while not results.empty():
+			values.append(results.get())
+	return values
+
+
+def create_all_reduce(flags_dict, workers):
+
+	# gradients of all trainable variables + 1 for MSE
+	size = count_parameters(flags_dict) + 1
+	return SharedAllReduce(workers, size, multiprocessing.get_context("spawn"))
+
+
+def prepare_batch(flags_dict):
+	""" build batch images before starting workers so that workers don't build them at the same time. """
+
+	if not flags_dict["build_batch"]:
+		return
+
+	batch_dir = flags_dict["batch_dir"] + "/" + flags_dict["dataset"] + "/scale%d" % flags_dict["scale"]
+	batch = loader.BatchDataSets(flags_dict["scale"], batch_dir, flags_dict["batch_image_size"],
+	                             flags_dict["stride_size"], channels=flags_dict["channels"])
+	if not batch.is_batch_exist():
+		batch.build_batch(flags_dict["data_dir"] + "/" + flags_dict["dataset"])
+
+
+def train(flags_dict, workers):
+
+	check_flags(flags_dict, workers)
+	prepare_batch(flags_dict)
+	all_reduce = create_all_reduce(flags_dict, workers)
+
+	index_seed = random.randrange(2 ** 31)
+	run_processes(run_training_worker,
+	              [(rank, workers, flags_dict, all_reduce, index_seed) for rank in range(workers)])
+
+
+def benchmark(flags_dict, worker_counts, steps):
+	""" measure steps/sec of the same global mini-batch with each number of workers. """
+
+	for workers in worker_counts:
+		check_flags(flags_dict, workers)
+	prepare_batch(flags_dict)
+	results = []
+
+	for workers in worker_counts:
+		all_reduce = create_all_reduce(flags_dict, workers)
+		values = run_processes(run_benchmark_worker,
+		                       [(rank, workers, flags_dict, all_reduce, steps) for rank in range(workers)],
+		                       with_results=True)
+		if len(values) > 0:
+			results.append((workers, values[0]))
+
+	print("Data parallel training: global batch %d x %dx%d, %d steps" % (
+		flags_dict["batch_num"], flags_dict["batch_image_size"], flags_dict["batch_image_size"], steps))
+	for workers, steps_per_sec in results:
+		print("  %d workers: %2.3f steps/sec, %s patches/sec (x%2.2f)" % (
+			workers, steps_per_sec, "{:,.0f}".format(steps_per_sec * flags_dict["batch_num"]),
+			steps_per_sec / results[0][1]))
+
+	return results
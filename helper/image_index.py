@@ -0,0 +1,101 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Ver: 2
+
+metadata index of the image files in a dataset directory.
+
+Width, height and mode are read from the file header only (PIL opens images lazily) and cached
+in the directory with the file's mtime, so files which can't be used are filtered out without decoding.
+"""
+
+import json
+import os
+
+from PIL import Image
+
+INDEX_FILENAME = ".image_index.json"
+USABLE_MODES = ("L", "P", "RGB", "RGBA")
+
+
+def read_image_info(file_path):
+	""" returns (width, height, mode) from the image header or None if it's not an image. """
+
+	try:
+		with Image.open(file_path) as image:
+			return image.width, image.height, image.mode
+	except OSError:
+		return None
+
+
+class ImageIndex:
+	def __init__(self, directory, use_cache=True):
+
+		if not directory.endswith('/'):
+			directory = directory + "/"
+		self.directory = directory
+		self.use_cache = use_cache
+		self.entries = []
+
+		self.build()
+
+	def load_cache(self):
+
+		if not self.use_cache:
+			return {}
+		try:
+			with open(self.directory + INDEX_FILENAME) as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return {}
+
+	def save_cache(self, cache):
+
+		if not self.use_cache:
+			return
+		try:
+			with open(self.directory + INDEX_FILENAME + ".tmp", "w") as f:
+				json.dump(cache, f)
+			os.replace(self.directory + INDEX_FILENAME + ".tmp", self.directory + INDEX_FILENAME)
+		except OSError as error:
+			print("Can't save image index: {0}".format(error))
+
+	def build(self):
+		""" read headers of new or modified files only. non-image files are also cached with mode None. """
+
+		cache = self.load_cache()
+		new_cache = {}
+		updated = False
+
+		for filename in sorted(os.listdir(self.directory)):
+			path = self.directory + filename
+			if filename.startswith('.') or not os.path.isfile(path):
+				continue
+
+			mtime = os.path.getmtime(path)
+			entry = cache.get(filename)
+			if entry is None or entry["mtime"] != mtime:
+				info = read_image_info(path)
+				width, height, mode = info if info is not None else (0, 0, None)
+				entry = {"width": width, "height": height, "mode": mode, "mtime": mtime}
+				updated = True
+			new_cache[filename] = entry
+
+			if entry["mode"] in USABLE_MODES:
+				self.entries.append(dict(entry, path=path))
+
+		if updated or len(new_cache) != len(cache):
+			self.save_cache(new_cache)
+
+	def get_entries(self, min_width=0, min_height=0):
+		""" returns entries (path, width, height, mode, mtime) of the usable images which are large enough. """
+
+		return [entry for entry in self.entries if entry["width"] >= min_width and entry["height"] >= min_height]
+
+	def get_filenames(self, min_width=0, min_height=0):
+		return [entry["path"] for entry in self.get_entries(min_width, min_height)]
+
+
+def get_image_files(directory, min_width=0, min_height=0):
+	""" returns image file paths in the directory. other files are excluded without decoding. """
+
+	return ImageIndex(directory).get_filenames(min_width, min_height)
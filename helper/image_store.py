@@ -0,0 +1,113 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Ver: 2
+
+packed Y-channel image store.
+
+All images are concatenated into one uint8 arena file and indexed by [offset, height, width],
+so the training loaders can read images with no per-file decoding.
+This module doesn't depend on tensorflow to be usable from pre-processing tools.
+"""
+
+import multiprocessing
+import os
+
+import numpy as np
+from PIL import Image
+
+ARENA_FILENAME = "images.bin"
+INDEX_FILENAME = "index.npy"
+NAMES_FILENAME = "names.txt"
+
+# same transform as utilty.convert_rgb_to_y()
+Y_XFORM = np.array([65.738 / 256.0, 129.057 / 256.0, 25.064 / 256.0])
+
+
+def is_image_store(directory):
+	return os.path.isfile(os.path.join(directory, INDEX_FILENAME)) and \
+	       os.path.isfile(os.path.join(directory, ARENA_FILENAME))
+
+
+def load_y_image(file_path):
+	""" decode image file and returns Y channel as [H, W] uint8 image. returns None if it's not an image. """
+
+	try:
+		image = Image.open(file_path)
+		if image.mode == "L":
+			return np.asarray(image, dtype=np.uint8)
+
+		rgb_image = np.asarray(image.convert("RGB"), dtype=np.float64)
+	except OSError:
+		return None
+
+	y_image = rgb_image.dot(Y_XFORM) + 16.0
+	return np.clip(np.round(y_image), 0, 255).astype(np.uint8)
+
+
+def build_image_store(filenames, store_dir, processes=0):
+	"""
+	Convert images to Y channel with worker processes and write them as a packed store.
+	Images are stored in the order of filenames. Files which can't be decoded are skipped.
+	"""
+
+	if processes <= 0:
+		processes = os.cpu_count() or 1
+
+	if not os.path.exists(store_dir):
+		os.makedirs(store_dir)
+
+	index = []
+	names = []
+	offset = 0
+	arena_filename = os.path.join(store_dir, ARENA_FILENAME)
+
+	with multiprocessing.Pool(processes) as pool, open(arena_filename + ".tmp", "wb") as arena:
+		for file_path, image in zip(filenames, pool.imap(load_y_image, filenames, chunksize=4)):
+			if image is None:
+				print("Skipped [%s]" % file_path)
+				continue
+
+			arena.write(np.ascontiguousarray(image).tobytes())
+			index.append([offset, image.shape[0], image.shape[1]])
+			names.append(os.path.basename(file_path))
+			offset += image.size
+
+			if len(index) % 100 == 0:
+				print('.', end='', flush=True)
+
+	os.replace(arena_filename + ".tmp", arena_filename)
+	np.save(os.path.join(store_dir, INDEX_FILENAME), np.array(index, dtype=np.int64).reshape([-1, 3]))
+	with open(os.path.join(store_dir, NAMES_FILENAME), "w") as f:
+		f.write("\n".join(names))
+
+	print("\n%d images (%s bytes) are stored in [%s]." % (len(index), "{:,}".format(offset), store_dir))
+	return len(index)
+
+
+class ImageStore:
+	def __init__(self, store_dir):
+
+		self.store_dir = store_dir
+		self.index = np.load(os.path.join(store_dir, INDEX_FILENAME))
+		self.count = self.index.shape[0]
+
+		if os.path.getsize(os.path.join(store_dir, ARENA_FILENAME)) > 0:
+			self.arena = np.memmap(os.path.join(store_dir, ARENA_FILENAME), dtype=np.uint8, mode="r")
+		else:
+			self.arena = np.zeros([0], dtype=np.uint8)
+
+		names_filename = os.path.join(store_dir, NAMES_FILENAME)
+		if os.path.isfile(names_filename):
+			with open(names_filename) as f:
+				self.names = f.read().splitlines()
+		else:
+			self.names = [str(i) for i in range(self.count)]
+
+	def get_size(self, image_no):
+		""" returns (height, width) without touching the arena. """
+		return int(self.index[image_no][1]), int(self.index[image_no][2])
+
+	def get_image(self, image_no):
+		""" returns [H, W, 1] uint8 read-only view of the image. """
+		offset, height, width = self.index[image_no]
+		return self.arena[offset:offset + height * width].reshape(height, width, 1)
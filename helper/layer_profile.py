@@ -0,0 +1,100 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Ver: 2
+
+aggregate measured time and memory of each layer from RunMetadata of a traced step
+
+Ops are mapped to layers by their names. Forward ops are in the name scope of the layer ([layer]/...), backward ops
+in gradients/[layer]/... and optimizer updates in [optimizer]/update_[layer]/... Other ops (input, loss, optimizer
+slots...) are counted as "(other)". Times are durations of each op recorded by tensorflow, so their sum can be
+larger than the wall time when ops run in parallel.
+"""
+
+import re
+
+OTHER_LAYER = "(other)"
+GRADIENTS_PATTERN = re.compile(r"^gradients(_\d+)?/")
+
+
+class LayerCost:
+	def __init__(self, name, complexity=0):
+		self.name = name
+		self.complexity = complexity
+		self.ops = 0
+		self.forward_micros = 0
+		self.backward_micros = 0
+		self.output_bytes = 0
+
+	def get_total_micros(self):
+		return self.forward_micros + self.backward_micros
+
+
+def get_layer(node_name, layers):
+	""" returns (layer, True if it's a backward / update op). layers should be sorted from the longest name. """
+
+	name = node_name.split(":")[0]
+	backward = False
+
+	match = GRADIENTS_PATTERN.match(name)
+	if match:
+		name = name[match.end():]
+		backward = True
+	elif "/update_" in name:
+		name = name.split("/update_", 1)[1]
+		backward = True
+
+	for layer in layers:
+		if name == layer or name.startswith(layer + "/"):
+			return layer, backward
+	return OTHER_LAYER, backward
+
+
+def aggregate_run_metadata(run_metadata, layer_complexities):
+	""" returns [LayerCost] of each layer of layer_complexities {layer name: multiply-adds per input pixel} """
+
+	layers = sorted(layer_complexities, key=len, reverse=True)
+	costs = {layer: LayerCost(layer, complexity) for layer, complexity in layer_complexities.items()}
+	costs[OTHER_LAYER] = LayerCost(OTHER_LAYER)
+
+	for device_stats in run_metadata.step_stats.dev_stats:
+		if "/stream:" in device_stats.device or "/memcpy" in device_stats.device:
+			# GPU stream timings are duplicates of the ops on the device
+			continue
+
+		for node_stats in device_stats.node_stats:
+			if node_stats.node_name in ("_SOURCE", "_SINK"):
+				continue
+
+			layer, backward = get_layer(node_stats.node_name, layers)
+			cost = costs[layer]
+			cost.ops += 1
+			if backward:
+				cost.backward_micros += node_stats.all_end_rel_micros
+			else:
+				cost.forward_micros += node_stats.all_end_rel_micros
+			cost.output_bytes += sum(output.tensor_description.allocation_description.requested_bytes
+			                         for output in node_stats.output)
+
+	return [cost for cost in costs.values() if cost.ops > 0]
+
+
+def format_hotspot_table(costs, input_pixels, title=""):
+	"""
+	returns lines of the table ranked by measured time. GFLOPs are analytic (2 x multiply-adds of the forward pass
+	for input_pixels LR pixels) and GFLOP/s is measured against the forward time.
+	"""
+
+	total_micros = max(sum(cost.get_total_micros() for cost in costs), 1)
+	lines = ["%s (total %2.3f[ms] of ops)" % (title, total_micros / 1000),
+	         "%4s %-20s %5s %12s %12s %7s %10s %9s %9s" % (
+		         "rank", "layer", "ops", "forward[ms]", "backward[ms]", "time%", "output[MB]", "GFLOPs", "GFLOP/s")]
+
+	for rank, cost in enumerate(sorted(costs, key=lambda cost: cost.get_total_micros(), reverse=True)):
+		gflops = 2.0 * cost.complexity * input_pixels / 1e9
+		gflops_per_sec = "%9.2f" % (gflops / (cost.forward_micros / 1e6)) if gflops > 0 and cost.forward_micros > 0 \
+			else "%9s" % "-"
+		lines.append("%4d %-20s %5d %12.3f %12.3f %6.1f%% %10.2f %9.3f %s" % (
+			rank + 1, cost.name, cost.ops, cost.forward_micros / 1000, cost.backward_micros / 1000,
+			100.0 * cost.get_total_micros() / total_micros, cost.output_bytes / 1024 / 1024, gflops, gflops_per_sec))
+
+	return lines
@@ -5,24 +5,36 @@ Ver: 2
 functions for loading/converting data
 """
 
+import collections
 import configparser
 import logging
 import os
 import random
 
 import numpy as np
-from scipy import misc
 
-from helper import utilty as util
+from helper import image_index, image_store, utilty as util
 
-INPUT_IMAGE_DIR = "input"
-INTERPOLATED_IMAGE_DIR = "interpolated"
-TRUE_IMAGE_DIR = "true"
+# patches of the patch store are saved as uint8 [count, size, size, channels] arrays
+INPUT_PATCHES_FILENAME = "input.bin"
+INTERPOLATED_PATCHES_FILENAME = "interpolated.bin"
+TRUE_PATCHES_FILENAME = "true.bin"
+TEXTURE_SCORES_FILENAME = "texture_scores.npy"
+
+# for texture sampling
+FLAT_PATCH_WEIGHT = 0.1
+TEXTURE_HISTORY_SIZE = 1000
+TEXTURE_MAX_RETRIES = 8
 
 
 def build_image_set(file_path, channels=1, scale=1, convert_ycbcr=True, resampling_method="bicubic",
                     print_console=True):
-	true_image = util.set_image_alignment(util.load_image(file_path, print_console=print_console), scale)
+	true_image = util.load_image(file_path, print_console=print_console)
+	return build_image_set_from_image(true_image, channels, scale, convert_ycbcr, resampling_method)
+
+
+def build_image_set_from_image(true_image, channels=1, scale=1, convert_ycbcr=True, resampling_method="bicubic"):
+	true_image = util.set_image_alignment(true_image, scale)
 
 	if channels == 1 and true_image.shape[2] == 3 and convert_ycbcr:
 		true_image = util.convert_rgb_to_y(true_image)
@@ -67,68 +79,181 @@ def build_input_image(image, width=0, height=0, channels=1, scale=1, alignment=0
 	return image
 
 
+def get_texture_weights(scores, texture_sampling, texture_threshold):
+	"""
+	returns sampling weights of patches from their texture scores.
+	weighted: in proportion to the score (flat patches still have FLAT_PATCH_WEIGHT of the mean score).
+	threshold: skip [texture_threshold] ratio of the flattest patches.
+	"""
+
+	if texture_sampling == "weighted":
+		weights = scores + FLAT_PATCH_WEIGHT * np.mean(scores)
+	elif texture_sampling == "threshold":
+		weights = (scores >= np.percentile(scores, texture_threshold * 100)).astype(np.float64)
+	else:
+		weights = np.ones(len(scores))
+	return weights / np.sum(weights)
+
+
+class LossTable:
+	"""
+	recent training loss of each patch (or image) for hard example mining. Items are sampled in proportion to their
+	estimated loss. Since the model is updated after a loss is measured, an old loss decays toward the mean loss
+	with half_life steps (staleness correction) and items which are not trained yet have the mean loss.
+	"""
+
+	def __init__(self, count, half_life):
+		self.half_life = half_life
+		self.losses = np.zeros(count, dtype=np.float32)
+		self.steps = np.full(count, -1, dtype=np.int64)
+		self.step = 0
+
+	def update(self, numbers, losses, step):
+		self.losses[numbers] = losses
+		self.steps[numbers] = step
+		self.step = max(self.step, step)
+
+	def get_weights(self):
+
+		trained = self.steps >= 0
+		if not np.any(trained):
+			return np.full(len(self.losses), 1.0 / len(self.losses))
+
+		mean_loss = np.mean(self.losses[trained])
+		decay = np.where(trained, np.power(0.5, (self.step - self.steps) / self.half_life), 0.0)
+		estimated_losses = decay * self.losses + (1 - decay) * mean_loss
+		return estimated_losses / np.sum(estimated_losses)
+
+	def get_state(self):
+		return {"losses": self.losses.copy(), "steps": self.steps.copy(), "step": self.step}
+
+	def set_state(self, state):
+		self.losses = np.array(state["losses"], dtype=np.float32)
+		self.steps = np.array(state["steps"], dtype=np.int64)
+		self.step = state["step"]
+
+
+def get_random_flip_types(count, augment_level):
+	""" returns random flip_type (see util.flip) for each patch. augment_level <= 1 means no augmentation. """
+
+	if augment_level <= 1:
+		return np.zeros(count, dtype=np.int32)
+	return np.random.randint(min(augment_level, 8), size=count)
+
+
+def get_random_index(count, weights=None, index_random=None):
+	"""
+	returns a shuffled index of [count] numbers, or [count] numbers sampled by weights (normalized).
+	index_random (np.random.RandomState) is used instead of the global random states if given.
+	"""
+
+	if weights is not None:
+		return (index_random or np.random).choice(count, count, p=weights).tolist()
+	if index_random is not None:
+		return index_random.permutation(count).tolist()
+	return random.sample(range(0, count), count)
+
+
+def get_patches(windows, ys, xs):
+	""" returns [len(ys) * len(xs), size, size, channels] patches of the windows (see util.get_patch_windows) """
+
+	patches = windows[ys, xs]
+	return patches.reshape([-1] + list(patches.shape[2:]))
+
+
+def to_uint8(images):
+	""" round and clip images to uint8 in the same way as util.save_image() """
+
+	if images.dtype == np.uint8:
+		return images
+	return np.clip(np.floor(images + 0.5), 0, 255).astype(np.uint8)
+
+
 class BatchDataSets:
-	def __init__(self, scale, batch_dir, batch_image_size, stride_size=0, channels=1, resampling_method="bicubic"):
+	def __init__(self, scale, batch_dir, batch_image_size, stride_size=0, channels=1, resampling_method="bicubic",
+	             augment_level=1, texture_sampling="", texture_threshold=0.3, hard_example_half_life=0):
 
 		self.scale = scale
 		self.batch_image_size = batch_image_size
+		self.patch_size = batch_image_size
 		if stride_size == 0:
 			self.stride = batch_image_size // 2
 		else:
 			self.stride = stride_size
 		self.channels = channels
 		self.resampling_method = resampling_method
+		self.augment_level = augment_level
+		self.texture_sampling = texture_sampling
+		self.texture_threshold = texture_threshold
+		self.texture_scores = None
+		self.hard_example_half_life = hard_example_half_life
+		self.loss_table = None
+		self.last_numbers = []
 		self.count = 0
 		self.batch_dir = batch_dir
 		self.batch_index = None
+		self.shard_rank = 0
+		self.shard_count = 1
+		self.index_random = None
 
 	def build_batch(self, data_dir):
 		""" Build batch images and. """
 
 		print("Building batch images for %s..." % self.batch_dir)
-		filenames = util.get_files_in_directory(data_dir)
+		# images smaller than the batch image size are excluded before decoding
+		min_size = self.batch_image_size * self.scale
+		if image_store.is_image_store(data_dir):
+			store = image_store.ImageStore(data_dir)
+			images = (store.get_image(i) for i in range(store.count) if min(store.get_size(i)) >= min_size)
+		else:
+			images = (util.load_image(filename, print_console=False)
+			          for filename in image_index.get_image_files(data_dir, min_size, min_size))
 		images_count = 0
 
 		util.make_dir(self.batch_dir)
 		util.clean_dir(self.batch_dir)
-		util.make_dir(self.batch_dir + "/" + INPUT_IMAGE_DIR)
-		util.make_dir(self.batch_dir + "/" + INTERPOLATED_IMAGE_DIR)
-		util.make_dir(self.batch_dir + "/" + TRUE_IMAGE_DIR)
 
 		processed_images = 0
-		for filename in filenames:
+		texture_scores = []
+		files = [open(self.get_patches_filename(filename), "wb") for filename in
+		         [INPUT_PATCHES_FILENAME, INTERPOLATED_PATCHES_FILENAME, TRUE_PATCHES_FILENAME]]
+		for image in images:
 			output_window_size = self.batch_image_size * self.scale
 			output_window_stride = self.stride * self.scale
 
 			input_image, input_interpolated_image, true_image = \
-				build_image_set(filename, channels=self.channels, resampling_method=self.resampling_method,
-				                scale=self.scale, print_console=False)
-
-			# split into batch images
-			input_batch_images = util.get_split_images(input_image, self.batch_image_size, stride=self.stride)
-			input_interpolated_batch_images = util.get_split_images(input_interpolated_image, output_window_size,
-			                                                        stride=output_window_stride)
+				build_image_set_from_image(image, channels=self.channels, resampling_method=self.resampling_method,
+				                           scale=self.scale)
 
-			if input_batch_images is None or input_interpolated_batch_images is None:
+			# split into batch images. all patches of the image are gathered from zero-copy views of the windows
+			input_windows, ys, xs = util.get_patch_windows(input_image, self.batch_image_size, stride=self.stride)
+			if input_windows is None:
 				# if the original image size * scale is less than batch image size
 				continue
-			input_count = input_batch_images.shape[0]
 
-			true_batch_images = util.get_split_images(true_image, output_window_size, stride=output_window_stride)
-
-			for i in range(input_count):
-				self.save_input_batch_image(images_count, input_batch_images[i])
-				self.save_interpolated_batch_image(images_count, input_interpolated_batch_images[i])
-				self.save_true_batch_image(images_count, true_batch_images[i])
-				images_count += 1
+			interpolated_windows, _, _ = util.get_patch_windows(input_interpolated_image, output_window_size,
+			                                                     stride=output_window_stride)
+			true_windows, _, _ = util.get_patch_windows(true_image, output_window_size, stride=output_window_stride)
+
+			ys, xs = ys[:, np.newaxis], xs[np.newaxis, :]
+			true_patches = get_patches(true_windows, ys * self.scale, xs * self.scale)
+			for file, patches in zip(files, [get_patches(input_windows, ys, xs),
+			                                 get_patches(interpolated_windows, ys * self.scale, xs * self.scale),
+			                                 true_patches]):
+				file.write(to_uint8(patches).tobytes())
+			images_count += len(true_patches)
+			texture_scores.extend(util.get_texture_scores(true_patches))
 			processed_images += 1
 			if processed_images % 10 == 0:
 				print('.', end='', flush=True)
+		for file in files:
+			file.close()
 
 		print("Finished")
 		self.count = images_count
 
 		print("%d mini-batch images are built(saved)." % images_count)
+		np.save(self.batch_dir + "/" + TEXTURE_SCORES_FILENAME, np.array(texture_scores, dtype=np.float32))
 
 		config = configparser.ConfigParser()
 		config.add_section("batch")
@@ -158,27 +283,45 @@ class BatchDataSets:
 			self.count = 0
 			return
 
-	def load_all_batch_images(self):
-
-		print("Allocating memory for all batch images.")
-		self.input_images = np.zeros(shape=[self.count, self.batch_image_size, self.batch_image_size, 1],
-		                             dtype=np.uint8)  # type: np.ndarray
-		self.input_interpolated_images = np.zeros(
-			shape=[self.count, self.batch_image_size * self.scale, self.batch_image_size * self.scale, 1],
-			dtype=np.uint8)  # type: np.ndarray
-		self.true_images = np.zeros(
-			shape=[self.count, self.batch_image_size * self.scale, self.batch_image_size * self.scale, 1],
-			dtype=np.uint8)  # type: np.ndarray
+	def load_all_batch_images(self, memory_map=False):
+		""" if memory_map, patches are read-only memory maps of the files which processes share by the page cache. """
 
 		print("Loading all batch images.")
-		for i in range(self.count):
-			self.input_images[i] = self.load_input_batch_image(i)
-			self.input_interpolated_images[i] = self.load_interpolated_batch_image(i)
-			self.true_images[i] = self.load_true_batch_image(i)
-			if i % 1000 == 0:
-				print('.', end='', flush=True)
+		self.input_images = self.load_patches(INPUT_PATCHES_FILENAME, self.batch_image_size,
+		                                      memory_map)  # type: np.ndarray
+		self.input_interpolated_images = self.load_patches(INTERPOLATED_PATCHES_FILENAME,
+		                                                   self.batch_image_size * self.scale,
+		                                                   memory_map)  # type: np.ndarray
+		self.true_images = self.load_patches(TRUE_PATCHES_FILENAME, self.batch_image_size * self.scale,
+		                                     memory_map)  # type: np.ndarray
 		print("Load finished.")
 
+		self.load_texture_scores()
+
+	def get_patches_filename(self, filename):
+		return self.batch_dir + "/" + filename
+
+	def load_patches(self, filename, size, memory_map=False):
+		""" returns [count, size, size, channels] uint8 patches saved by build_batch() """
+
+		shape = [self.count, size, size, self.channels]
+		if memory_map:
+			return np.memmap(self.get_patches_filename(filename), dtype=np.uint8, mode="r", shape=tuple(shape))
+		return np.fromfile(self.get_patches_filename(filename), dtype=np.uint8).reshape(shape)
+
+	def load_texture_scores(self):
+		""" load texture score of each patch saved by build_batch(). computed from true images if not saved. """
+
+		filename = self.batch_dir + "/" + TEXTURE_SCORES_FILENAME
+		if os.path.isfile(filename):
+			self.texture_scores = np.load(filename)
+			if len(self.texture_scores) == self.count:
+				return
+
+		self.texture_scores = np.concatenate([util.get_texture_scores(self.true_images[i:i + 1000])
+		                                      for i in range(0, self.count, 1000)] + [np.zeros(0)])
+		np.save(filename, self.texture_scores.astype(np.float32))
+
 	def release_batch_images(self):
 
 		if hasattr(self, 'input_images'):
@@ -213,6 +356,9 @@ class BatchDataSets:
 				return False
 			if config.getint("batch", "channels") != self.channels:
 				return False
+			if not os.path.isfile(self.get_patches_filename(TRUE_PATCHES_FILENAME)):
+				# patch store of one image file for each patch
+				return False
 
 			return True
 
@@ -220,9 +366,27 @@ class BatchDataSets:
 			return False
 
 	def init_batch_index(self):
-		self.batch_index = random.sample(range(0, self.count), self.count)
+		if self.hard_example_half_life > 0 and self.loss_table is None:
+			self.loss_table = LossTable(self.count, self.hard_example_half_life)
+
+		weights = None
+		if self.texture_sampling != "" and self.texture_scores is not None:
+			# patches with more texture are sampled more often
+			weights = get_texture_weights(self.texture_scores, self.texture_sampling, self.texture_threshold)
+		if self.loss_table is not None:
+			# patches with larger loss are sampled more often
+			weights = self.loss_table.get_weights() * (weights if weights is not None else 1.0)
+			weights /= np.sum(weights)
+
+		self.batch_index = get_random_index(self.count, weights, self.index_random)
 		self.index = 0
 
+	def update_losses(self, losses, step):
+		""" update the loss table by the per-sample losses of the last batch from load_batch_images() """
+
+		if self.loss_table is not None:
+			self.loss_table.update(self.last_numbers, losses, step)
+
 	def get_next_image_no(self):
 
 		if self.index >= self.count:
@@ -232,66 +396,165 @@ class BatchDataSets:
 		self.index += 1
 		return image_no
 
-	def load_batch_image_from_disk(self, image_number):
+	def set_shard(self, rank, count, seed):
+		"""
+		for data parallel training. All [count] workers take the same permutations of the index (by the seed), and
+		each worker uses the [rank]-th share of every global mini-batch.
+		"""
+
+		self.shard_rank = rank
+		self.shard_count = count
+		self.index_random = np.random.RandomState(seed)
+
+	def get_next_image_numbers(self, batch_num):
+		""" returns numbers of the next mini-batch (this worker's share of the global mini-batch with set_shard()) """
 
-		image_number = image_number % self.count
+		numbers = [self.get_next_image_no() for _ in range(batch_num * self.shard_count)]
+		return numbers[self.shard_rank * batch_num:(self.shard_rank + 1) * batch_num]
 
-		input_image = self.load_input_batch_image(image_number)
-		input_interpolated = self.load_interpolated_batch_image(image_number)
-		true = self.load_true_batch_image(image_number)
+	def get_position(self):
+		""" returns (batch_index, index). batch_index is not modified in place, so the position is not a copy. """
+		return self.batch_index, self.index
 
-		return input_image, input_interpolated, true
+	def set_position(self, position):
+		self.batch_index, self.index = position
+
+	def get_state(self, position=None):
+		""" position (see get_position()) is saved instead of the current index if given. """
+
+		batch_index, index = self.get_position() if position is None else position
+		state = {"batch_index": list(batch_index), "index": index}
+		if self.loss_table is not None:
+			state["loss_table"] = self.loss_table.get_state()
+		return state
+
+	def set_state(self, state):
+		self.batch_index = list(state["batch_index"])
+		self.index = state["index"]
+		if self.loss_table is not None and "loss_table" in state:
+			self.loss_table.set_state(state["loss_table"])
+
+	def set_patch_size(self, patch_size):
+		""" patches smaller than batch_image_size are cropped from random positions of the built patches """
+		self.patch_size = min(patch_size, self.batch_image_size)
 
 	def load_batch_image(self):
 
 		number = self.get_next_image_no()
 		return self.input_images[number], self.input_interpolated_images[number], self.true_images[number]
 
-	def load_input_batch_image(self, image_number):
-		image = misc.imread(self.batch_dir + "/" + INPUT_IMAGE_DIR + "/%06d.bmp" % image_number)
-		return image.reshape(image.shape[0], image.shape[1], 1)
+	def load_batch_images(self, batch_num):
+
+		self.last_numbers = self.get_next_image_numbers(batch_num)
+		return self.build_batch_images(self.last_numbers)
 
-	def load_interpolated_batch_image(self, image_number):
-		image = misc.imread(self.batch_dir + "/" + INTERPOLATED_IMAGE_DIR + "/%06d.bmp" % image_number)
-		return image.reshape(image.shape[0], image.shape[1], 1)
+	def build_batch_images(self, numbers, patch_size=0):
+		""" returns (input, interpolated, true) images of the patch numbers. thread safe.
+		patches are cropped to patch_size (0: the current patch size).
+		"""
 
-	def load_true_batch_image(self, image_number):
-		image = misc.imread(self.batch_dir + "/" + TRUE_IMAGE_DIR + "/%06d.bmp" % image_number)
-		return image.reshape(image.shape[0], image.shape[1], 1)
+		batch_num = len(numbers)
+		patch_size = patch_size if patch_size > 0 else self.patch_size
+		input_images = self.input_images[numbers]
+		input_interpolated_images = self.input_interpolated_images[numbers]
+		true_images = self.true_images[numbers]
 
-	def save_input_batch_image(self, image_number, image):
-		return util.save_image(self.batch_dir + "/" + INPUT_IMAGE_DIR + "/%06d.bmp" % image_number, image)
+		if patch_size < self.batch_image_size:
+			input_images, input_interpolated_images, true_images = self.crop_batch_images(
+				input_images, input_interpolated_images, true_images, patch_size)
 
-	def save_interpolated_batch_image(self, image_number, image):
-		return util.save_image(self.batch_dir + "/" + INTERPOLATED_IMAGE_DIR + "/%06d.bmp" % image_number, image)
+		if self.augment_level > 1:
+			flip_types = get_random_flip_types(batch_num, self.augment_level)
+			input_images = util.flip_images(input_images, flip_types)
+			input_interpolated_images = util.flip_images(input_interpolated_images, flip_types)
+			true_images = util.flip_images(true_images, flip_types)
 
-	def save_true_batch_image(self, image_number, image):
-		return util.save_image(self.batch_dir + "/" + TRUE_IMAGE_DIR + "/%06d.bmp" % image_number, image)
+		return input_images, input_interpolated_images, true_images
+
+	def crop_batch_images(self, input_images, input_interpolated_images, true_images, size):
+
+		true_size = size * self.scale
+		offsets = [(random.randrange(self.batch_image_size - size + 1), random.randrange(self.batch_image_size - size + 1))
+		           for _ in range(len(input_images))]
+
+		input_images = np.stack([image[y:y + size, x:x + size] for image, (y, x) in zip(input_images, offsets)])
+		input_interpolated_images = np.stack(
+			[image[y * self.scale:y * self.scale + true_size, x * self.scale:x * self.scale + true_size]
+			 for image, (y, x) in zip(input_interpolated_images, offsets)])
+		true_images = np.stack([image[y * self.scale:y * self.scale + true_size, x * self.scale:x * self.scale + true_size]
+		                        for image, (y, x) in zip(true_images, offsets)])
+		return input_images, input_interpolated_images, true_images
 
 
 class DynamicDataSets:
-	def __init__(self, scale, batch_image_size, channels=1, resampling_method="bicubic"):
+	def __init__(self, scale, batch_image_size, channels=1, resampling_method="bicubic", augment_level=1,
+	             area_weighted=False, texture_sampling="", texture_threshold=0.3, hard_example_half_life=0):
 
 		self.scale = scale
 		self.batch_image_size = batch_image_size
+		self.patch_size = batch_image_size
 		self.channels = channels
 		self.resampling_method = resampling_method
+		self.augment_level = augment_level
+		self.area_weighted = area_weighted
+		self.texture_sampling = texture_sampling
+		self.texture_threshold = texture_threshold
+		self.texture_history = collections.deque(maxlen=TEXTURE_HISTORY_SIZE)
+		self.hard_example_half_life = hard_example_half_life
+		self.loss_table = None
+		self.last_numbers = []
 
 		self.filenames = []
+		self.store = None
+		self.store_numbers = []
+		self.areas = None
 		self.count = 0
 		self.batch_index = None
+		self.shard_rank = 0
+		self.shard_count = 1
+		self.index_random = None
 
 	def set_data_dir(self, data_dir):
-		self.filenames = util.get_files_in_directory(data_dir)
-		self.count = len(self.filenames)
+		""" index usable images. images smaller than the patch are excluded by their headers (or store index). """
+
+		min_size = self.batch_image_size * self.scale
+		if image_store.is_image_store(data_dir):
+			self.store = image_store.ImageStore(data_dir)
+			sizes = [self.store.get_size(i) for i in range(self.store.count)]
+			self.store_numbers = [i for i, size in enumerate(sizes) if min(size) >= min_size]
+			areas = [sizes[i][0] * sizes[i][1] for i in self.store_numbers]
+		else:
+			entries = image_index.ImageIndex(data_dir).get_entries(min_size, min_size)
+			self.filenames = [entry["path"] for entry in entries]
+			areas = [entry["width"] * entry["height"] for entry in entries]
+
+		self.count = len(areas)
 		if self.count <= 0:
-			logging.error("Data Directory is empty.")
+			logging.error("Data Directory has no image larger than %dx%d." % (min_size, min_size))
 			exit(-1)
+		self.areas = np.array(areas, dtype=np.float64)
 
 	def init_batch_index(self):
-		self.batch_index = random.sample(range(0, self.count), self.count)
+		if self.hard_example_half_life > 0 and self.loss_table is None:
+			# losses are kept for each image since patches are taken from random positions
+			self.loss_table = LossTable(self.count, self.hard_example_half_life)
+
+		if self.area_weighted or self.loss_table is not None:
+			# larger images are sampled more often so that each pixel has the same chance to be a patch
+			weights = self.areas / np.sum(self.areas) if self.area_weighted else 1.0
+			if self.loss_table is not None:
+				weights = weights * self.loss_table.get_weights()
+			self.batch_index = get_random_index(self.count, weights / np.sum(weights), self.index_random)
+		else:
+			self.batch_index = get_random_index(self.count, index_random=self.index_random)
 		self.index = 0
 
+	def update_losses(self, losses, step):
+		""" update the loss table by the per-sample losses of the last batch from load_batch_images() """
+
+		if self.loss_table is not None:
+			self.loss_table.update(self.last_numbers, losses, step)
+
 	def get_next_image_no(self):
 
 		if self.index >= self.count:
@@ -301,32 +564,113 @@ class DynamicDataSets:
 		self.index += 1
 		return image_no
 
+	def set_shard(self, rank, count, seed):
+		"""
+		for data parallel training. All [count] workers take the same permutations of the index (by the seed), and
+		each worker uses the [rank]-th share of every global mini-batch.
+		"""
+
+		self.shard_rank = rank
+		self.shard_count = count
+		self.index_random = np.random.RandomState(seed)
+
+	def get_next_image_numbers(self, batch_num):
+		""" returns numbers of the next mini-batch (this worker's share of the global mini-batch with set_shard()) """
+
+		numbers = [self.get_next_image_no() for _ in range(batch_num * self.shard_count)]
+		return numbers[self.shard_rank * batch_num:(self.shard_rank + 1) * batch_num]
+
+	def get_position(self):
+		""" returns (batch_index, index). batch_index is not modified in place, so the position is not a copy. """
+		return self.batch_index, self.index
+
+	def set_position(self, position):
+		self.batch_index, self.index = position
+
+	def get_state(self, position=None):
+		""" position (see get_position()) is saved instead of the current index if given. """
+
+		batch_index, index = self.get_position() if position is None else position
+		state = {"batch_index": list(batch_index), "index": index}
+		if self.loss_table is not None:
+			state["loss_table"] = self.loss_table.get_state()
+		return state
+
+	def set_state(self, state):
+		self.batch_index = list(state["batch_index"])
+		self.index = state["index"]
+		if self.loss_table is not None and "loss_table" in state:
+			self.loss_table.set_state(state["loss_table"])
+
+	def set_patch_size(self, patch_size):
+		""" images are indexed by batch_image_size, so patch_size should not be larger than it """
+		self.patch_size = min(patch_size, self.batch_image_size)
+
 	def load_batch_image(self):
 		""" index won't be used. """
 
-		image = None
-		while image is None:
-			image = self.load_random_patch(self.filenames[self.get_next_image_no()])
+		input_images, input_bicubic_images, true_images = self.load_batch_images(1)
+		return input_images[0], input_bicubic_images[0], true_images[0]
 
-		if random.randrange(2) == 0:
-			image = np.fliplr(image)
+	def load_batch_images(self, batch_num):
+		""" load batch_num patches and build input / bicubic images for all of them at once. """
 
-		input_image = util.resize_image_by_pil(image, 1 / self.scale)
-		input_bicubic_image = util.resize_image_by_pil(input_image, self.scale)
-		return input_image, input_bicubic_image, image
+		self.last_numbers = self.get_next_image_numbers(batch_num)
+		return self.build_batch_images(self.last_numbers)
 
-	def load_random_patch(self, filename):
+	def build_batch_images(self, numbers, patch_size=0):
+		""" returns (input, bicubic, true) images of random patches from the image numbers. thread safe.
+		patch_size 0 means the current patch size.
+		"""
 
-		image = util.load_image(filename, print_console=False)
-		height, width = image.shape[0:2]
+		batch_num = len(numbers)
+		patch_size = patch_size if patch_size > 0 else self.patch_size
+		true_images = np.stack([self.load_random_patch(image_no, patch_size) for image_no in numbers])
+		if self.augment_level > 1:
+			true_images = util.flip_images(true_images, get_random_flip_types(batch_num, self.augment_level))
+		else:
+			# same as before batch_augment: flip left and right randomly
+			true_images = util.flip_images(true_images, np.random.randint(2, size=batch_num) * 2)
 
-		load_batch_size = self.batch_image_size * self.scale
-		if height < load_batch_size or width < load_batch_size:
-			return None
+		input_images = util.resize_images_by_bicubic(true_images, 1 / self.scale)
+		input_bicubic_images = util.resize_images_by_bicubic(input_images, self.scale)
+		return input_images, input_bicubic_images, true_images
 
-		y = random.randrange(height - load_batch_size)
-		x = random.randrange(width - load_batch_size)
-		image = image[y:y + load_batch_size, x:x + load_batch_size, :]
-		image = build_input_image(image, channels=self.channels, convert_ycbcr=True)
+	def load_image(self, image_no):
+
+		if self.store is not None:
+			return self.store.get_image(self.store_numbers[image_no])
+		return util.load_image(self.filenames[image_no], print_console=False)
+
+	def load_random_patch(self, image_no, patch_size):
+
+		image = self.load_image(image_no)
+		height, width = image.shape[0:2]
+		load_batch_size = patch_size * self.scale
+
+		for _ in range(TEXTURE_MAX_RETRIES if self.texture_sampling != "" else 1):
+			y = random.randrange(height - load_batch_size + 1)
+			x = random.randrange(width - load_batch_size + 1)
+			patch = build_input_image(image[y:y + load_batch_size, x:x + load_batch_size, :], channels=self.channels,
+			                          convert_ycbcr=True)
+			if self.texture_sampling == "" or self.accept_patch(patch):
+				break
+
+		return patch
+
+	def accept_patch(self, patch):
+		"""
+		rejection sampling by texture score. Scores of recent candidates are used as the distribution of the dataset.
+		weighted: accepted in proportion to the score (at least FLAT_PATCH_WEIGHT) relative to the mean score.
+		threshold: rejected if the score is in the [texture_threshold] ratio of the flattest patches.
+		"""
+
+		score = util.get_texture_scores([patch])[0]
+		history = np.array(self.texture_history)
+		self.texture_history.append(score)
+		if len(history) < TEXTURE_HISTORY_SIZE // 10:
+			return True
 
-		return image
+		if self.texture_sampling == "weighted":
+			return random.random() < max(FLAT_PATCH_WEIGHT, score / max(np.mean(history), 1e-6))
+		return score >= np.percentile(history, self.texture_threshold * 100)
@@ -0,0 +1,258 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Ver: 2
+
+memory planner which predicts peak memory of training and inference from the model args
+
+Training: patch store of BatchDataSets (uint8), fed mini-batch, outputs of every layer kept for the backward pass and
+weights with their gradients and optimizer slots.
+Inference: outputs of every layer for the input resolution (feature extraction outputs are all alive until they are
+concatenated), a temporary of the largest layer and whole-image host buffers (input, bicubic and output images).
+
+TRAINING_ACTIVATION_COPIES is the number of tensors of each layer output size kept for the backward pass (conv, bias
+add, activation, dropout and their gradients which are alive at the peak). It's calibrated by the measured peak RSS of
+the default model (fp32, adam, 48x48 patches: about 2.8 copies). Check the predictions with
+"python benchmark.py --benchmark=memory".
+"""
+
+import math
+import os
+import resource
+
+from helper import utilty as util
+
+PRECISION_BYTES = {"fp32": 4, "fp16": 2, "bf16": 2}
+OPTIMIZER_SLOTS = {"gd": 0, "momentum": 1, "adadelta": 2, "adagrad": 1, "adam": 2, "rmsprop": 2}
+TRAINING_ACTIVATION_COPIES = 3
+HOST_IMAGE_BYTES = 8  # images on the host are float64
+MIN_TILE_SIZE = 16
+TILE_SIZE_STEP = 8
+MB = 1024 * 1024
+
+
+def get_rss():
+	""" returns current resident set size of this process in bytes """
+
+	try:
+		with open("/proc/self/statm") as file:
+			return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+	except (IOError, ValueError):
+		return get_peak_rss()
+
+
+def get_peak_rss():
+	""" returns peak resident set size of this process in bytes (since the last reset_peak_rss() on linux) """
+
+	try:
+		with open("/proc/self/status") as file:
+			for line in file:
+				if line.startswith("VmHWM:"):
+					return int(line.split()[1]) * 1024
+	except IOError:
+		pass
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss():
+	""" reset the peak RSS to the current RSS. returns False if it's not supported. """
+
+	try:
+		with open("/proc/self/clear_refs", "w") as file:
+			file.write("5")
+		return True
+	except IOError:
+		return False
+
+
+class LayerShape:
+	def __init__(self, name, cnn_size, input_channels, output_channels, resolution=1, prelu=False):
+		""" resolution is the ratio of the output width to the LR input. cnn_size 0 means no weights (concat...). """
+
+		self.name = name
+		self.cnn_size = cnn_size
+		self.input_channels = input_channels
+		self.output_channels = output_channels
+		self.resolution = resolution
+		self.prelu = prelu
+
+	def get_parameters(self):
+		if self.cnn_size == 0:
+			return 0
+		return self.cnn_size * self.cnn_size * self.input_channels * self.output_channels + self.output_channels * (
+			2 if self.prelu else 1)
+
+	def get_output_elements(self):
+		""" returns elements of the output for each LR input pixel """
+
+		return self.output_channels * self.resolution * self.resolution
+
+
+class MemoryPlanner:
+	def __init__(self, model, budget_mb=0):
+		""" model is SuperResolution (before or after build_graph()). budget_mb 0 means no budget. """
+
+		self.model = model
+		self.budget = int(budget_mb * MB)
+		self.compute_bytes = PRECISION_BYTES[model.precision]
+
+	def get_layer_shapes(self, scale):
+		""" returns [LayerShape] of the network built by SuperResolution.build_graph() for the scale """
+
+		model = self.model
+		prelu = model.activator == "prelu"
+		layers = []
+
+		output_feature_num = model.filters
+		input_feature_num = model.channels
+		total_output_feature_num = 0
+		for i in range(model.layers):
+			if model.min_filters != 0 and i > 0:
+				x1 = i / float(model.layers - 1)
+				y1 = pow(x1, 1.0 / model.filters_decay_gamma)
+				output_feature_num = int((model.filters - model.min_filters) * (1 - y1) + model.min_filters)
+			layers.append(LayerShape("CNN%d" % (i + 1), model.cnn_size, input_feature_num, output_feature_num,
+			                         prelu=prelu))
+			input_feature_num = output_feature_num
+			total_output_feature_num += output_feature_num
+		layers.append(LayerShape("Concat", 0, 0, total_output_feature_num))
+
+		if model.use_nin:
+			layers.append(LayerShape("A1", 1, total_output_feature_num, model.nin_filters, prelu=prelu))
+			layers.append(LayerShape("B1", 1, total_output_feature_num, model.nin_filters2, prelu=prelu))
+			layers.append(LayerShape("B2", 3, model.nin_filters2, model.nin_filters2, prelu=prelu))
+			channels = model.nin_filters + model.nin_filters2
+			layers.append(LayerShape("Concat2", 0, 0, channels))
+		else:
+			channels = total_output_feature_num
+
+		if model.pixel_shuffler:
+			steps = [2, 2] if scale == 4 else [scale]
+			resolution = 1
+			for i, step in enumerate(steps):
+				name = "Up-PS" if i == 0 else "Up-PS%d" % (i + 1)
+				layers.append(LayerShape(name + "_CNN", model.cnn_size, channels, step * step * channels, resolution))
+				resolution *= step
+				layers.append(LayerShape(name, 0, 0, channels, resolution))
+		else:
+			layers.append(LayerShape("Up-TCNN", util.get_upscale_filter_size(scale), channels, channels, scale))
+
+		input_channels = channels
+		for i in range(model.reconstruct_layers - 1):
+			layers.append(LayerShape("R-CNN%d" % (i + 1), model.cnn_size, input_channels, model.reconstruct_filters,
+			                         scale, prelu=prelu))
+			input_channels = model.reconstruct_filters
+		layers.append(LayerShape("R-CNN%d" % model.reconstruct_layers, model.cnn_size, input_channels,
+		                         model.output_channels, scale))
+		return layers
+
+	def get_parameters(self):
+		return sum(layer.get_parameters() for layer in self.get_layer_shapes(self.model.scale))
+
+	def get_weight_bytes(self, training):
+		""" float32 weights, their optimizer slots and (for training) gradients and accumulation buffers """
+
+		copies = 1 + OPTIMIZER_SLOTS.get(self.model.optimizer, 2)
+		if training:
+			copies += 1
+			if self.model.gradient_accumulation > 1:
+				copies += 1
+		if self.compute_bytes != 4:
+			# weights cast to the compute dtype
+			copies += self.compute_bytes / 4
+		return int(self.get_parameters() * 4 * copies)
+
+	def get_activation_bytes(self, pixels, copies):
+		""" layer outputs for [pixels] LR input pixels """
+
+		elements = sum(layer.get_output_elements() for layer in self.get_layer_shapes(self.model.scale))
+		return int(pixels * elements * self.compute_bytes * copies)
+
+	def get_patch_store_bytes(self, count, patch_size):
+		""" uint8 input, bicubic and true images of BatchDataSets.load_all_batch_images() """
+
+		scale = self.model.scale
+		return count * (patch_size * patch_size + 2 * (patch_size * scale) * (patch_size * scale))
+
+	def get_training_step_bytes(self, batch_num, patch_size):
+		""" memory for one training step excluding weights and the patch store """
+
+		scale = self.model.scale
+		pixels = batch_num * patch_size * patch_size
+		# float32 input, bicubic and true mini-batch on the host and in the graph
+		batch_bytes = 2 * 4 * pixels * (self.model.channels + 2 * scale * scale * self.model.output_channels)
+		return batch_bytes + self.get_activation_bytes(pixels, TRAINING_ACTIVATION_COPIES)
+
+	def predict_training(self, count, batch_num, patch_size):
+		""" returns {item: bytes} of the training. count is number of patches in the patch store (0: dynamic loader) """
+
+		return {"patch store": self.get_patch_store_bytes(count, patch_size),
+		        "weights": self.get_weight_bytes(training=True),
+		        "step": self.get_training_step_bytes(batch_num, patch_size)}
+
+	def get_host_image_bytes(self, height, width):
+		""" whole-image input, bicubic, output and self ensemble images of do() on the host """
+
+		scale = self.model.scale
+		ensemble_copies = 2 if self.model.self_ensemble > 1 else 0
+		return height * width * HOST_IMAGE_BYTES * (
+			self.model.channels + (3 + ensemble_copies) * scale * scale * self.model.output_channels)
+
+	def get_inference_pass_bytes(self, height, width):
+		""" memory of one sess.run of the [height, width] LR input """
+
+		scale = self.model.scale
+		io_bytes = 4 * height * width * (self.model.channels + 2 * scale * scale * self.model.output_channels)
+		largest_elements = max(layer.get_output_elements() for layer in self.get_layer_shapes(scale))
+		return io_bytes + self.get_activation_bytes(height * width, 1) + \
+		       height * width * largest_elements * self.compute_bytes
+
+	def predict_inference(self, height, width, tile_size=0, margin=0):
+		""" returns {item: bytes} of do() for [height, width] LR image. if tile_size > 0, tiles have margins. """
+
+		if tile_size > 0:
+			pass_height = min(height, tile_size + 2 * margin)
+			pass_width = min(width, tile_size + 2 * margin)
+		else:
+			pass_height, pass_width = height, width
+
+		return {"host images": self.get_host_image_bytes(height, width),
+		        "weights": self.get_weight_bytes(training=False),
+		        "pass": self.get_inference_pass_bytes(pass_height, pass_width)}
+
+	def get_available_bytes(self):
+		""" budget left for the prediction. (current RSS is already used by python, tensorflow and loaded data) """
+
+		return self.budget - get_rss()
+
+	def get_max_batch_num(self, count, patch_size):
+		""" returns max batch_num which fits the budget or 0 if the patch store and weights don't fit """
+
+		fixed_bytes = self.get_patch_store_bytes(count, patch_size) + self.get_weight_bytes(training=True)
+		available_bytes = self.get_available_bytes() - fixed_bytes
+		return max(available_bytes // max(self.get_training_step_bytes(1, patch_size), 1), 0)
+
+	def get_tile_size(self, height, width, margin):
+		"""
+		returns 0 if whole image fits the budget. otherwise the largest tile size (multiple of TILE_SIZE_STEP) which
+		fits, or -1 if even MIN_TILE_SIZE doesn't fit.
+		"""
+
+		if self.budget <= 0 or sum(self.predict_inference(height, width).values()) <= self.get_available_bytes():
+			return 0
+
+		available_bytes = self.get_available_bytes() - self.get_host_image_bytes(height, width) - \
+		                  self.get_weight_bytes(training=False)
+		bytes_per_pixel = self.get_inference_pass_bytes(1, 1)
+		if available_bytes <= 0:
+			return -1
+
+		tile_size = int(math.sqrt(available_bytes / bytes_per_pixel)) - 2 * margin
+		tile_size -= tile_size % TILE_SIZE_STEP
+		return tile_size if tile_size >= MIN_TILE_SIZE else -1
+
+
+def format_bytes(predictions):
+	""" returns "item1:N[MB] item2:N[MB] total:N[MB]" """
+
+	items = ["%s:%s[MB]" % (item, "{:,.1f}".format(size / MB)) for item, size in predictions.items()]
+	return " ".join(items + ["total:%s[MB]" % "{:,.1f}".format(sum(predictions.values()) / MB)])
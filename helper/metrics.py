@@ -0,0 +1,192 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Ver: 2
+
+metrics sink which writes records to a JSONL file and gauges / histograms to a Prometheus text format file
+
+metrics.record("epoch", {"steps_per_second": 12.3, "psnr": 37.1})
+	-> JSONL: {"time": ..., "event": "epoch", "model": ..., "steps_per_second": 12.3, "psnr": 37.1}
+	-> Prometheus: dcscn_epoch_steps_per_second{model="..."} 12.3 ...
+metrics.flush()
+
+Durations of profiler scopes in SCOPE_HISTOGRAMS (loader wait, inference of each image, evaluation) are observed as
+histograms through a profiler listener. The Prometheus file is replaced atomically on each flush() so it can be read
+by the node exporter textfile collector at any time.
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from helper import memory_planner, profiler
+
+PREFIX = "dcscn_"
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+SCOPE_HISTOGRAMS = {"batch": ("loader_wait_seconds", "Time waiting for a training mini-batch from the loader"),
+                    "inference": ("inference_latency_seconds", "Latency of SR of one image including load and save"),
+                    "evaluate": ("evaluation_seconds", "Duration of each evaluation")}
+
+
+class Histogram:
+	def __init__(self, buckets=DEFAULT_BUCKETS):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+
+def format_labels(labels):
+	if len(labels) == 0:
+		return ""
+	return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+	                         for key, value in labels)
+
+
+class MetricsSink:
+	def __init__(self):
+		self.jsonl_filename = ""
+		self.prometheus_filename = ""
+		self.labels = {}
+		self.gauges = {}
+		self.histograms = {}
+		self.helps = {}
+		self.jsonl_file = None
+		self.lock = threading.Lock()
+
+	def is_enabled(self):
+		return self.jsonl_filename != "" or self.prometheus_filename != ""
+
+	def configure(self, jsonl_filename="", prometheus_filename="", labels=None):
+		""" labels (like {"model": name}) are added to all records and metrics """
+
+		self.jsonl_filename = jsonl_filename
+		self.prometheus_filename = prometheus_filename
+		self.labels = {} if labels is None else labels
+		if self.is_enabled():
+			profiler.default_profiler.add_listener(self.add_span)
+
+	def get_key(self, labels):
+		return tuple(sorted(dict(self.labels, **({} if labels is None else labels)).items()))
+
+	def set_gauge(self, name, value, labels=None, help_text=""):
+		with self.lock:
+			self.gauges.setdefault(PREFIX + name, {})[self.get_key(labels)] = value
+			if help_text != "":
+				self.helps[PREFIX + name] = help_text
+
+	def observe(self, name, value, labels=None, help_text=""):
+		with self.lock:
+			histograms = self.histograms.setdefault(PREFIX + name, {})
+			key = self.get_key(labels)
+			if key not in histograms:
+				histograms[key] = Histogram()
+			histograms[key].observe(value)
+			if help_text != "":
+				self.helps[PREFIX + name] = help_text
+
+	def add_span(self, path, start, elapsed):
+		""" profiler listener. observes durations of SCOPE_HISTOGRAMS scopes. """
+
+		name = path.rsplit("/", 1)[-1]
+		if name in SCOPE_HISTOGRAMS:
+			metric, help_text = SCOPE_HISTOGRAMS[name]
+			self.observe(metric, elapsed, help_text=help_text)
+
+	def record(self, event, values, labels=None):
+		"""
+		append {time, event, labels, values} to the JSONL file and set numeric values as gauges [event]_[key].
+		labels are added to the labels of the gauges (like {"dataset": "set5"}).
+		"""
+
+		if not self.is_enabled():
+			return
+
+		# numpy scalars (like float32 fetched by sess.run) are converted so that they are JSON serializable
+		values = {key: value.item() if isinstance(value, np.generic) else value for key, value in values.items()}
+		for key, value in values.items():
+			if isinstance(value, (int, float)) and not isinstance(value, bool):
+				self.set_gauge("%s_%s" % (event, key), value, labels)
+
+		if self.jsonl_filename != "":
+			line = dict(self.labels, **({} if labels is None else labels))
+			line.update(values)
+			line = dict({"time": time.time(), "event": event}, **line)
+			with self.lock:
+				if self.jsonl_file is None:
+					self.jsonl_file = open(self.jsonl_filename, "a")
+				self.jsonl_file.write(json.dumps(line) + "\n")
+				self.jsonl_file.flush()
+
+	def get_prometheus_lines(self):
+
+		lines = []
+		with self.lock:
+			for name in sorted(self.gauges):
+				if name in self.helps:
+					lines.append("# HELP %s %s" % (name, self.helps[name]))
+				lines.append("# TYPE %s gauge" % name)
+				for key, value in sorted(self.gauges[name].items()):
+					lines.append("%s%s %s" % (name, format_labels(key), repr(float(value))))
+
+			for name in sorted(self.histograms):
+				if name in self.helps:
+					lines.append("# HELP %s %s" % (name, self.helps[name]))
+				lines.append("# TYPE %s histogram" % name)
+				for key, histogram in sorted(self.histograms[name].items()):
+					count = 0
+					for bucket, bucket_count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+						count += bucket_count
+						lines.append("%s_bucket%s %d" % (name, format_labels(key + (("le", bucket),)), count))
+					lines.append("%s_sum%s %s" % (name, format_labels(key), repr(histogram.sum)))
+					lines.append("%s_count%s %d" % (name, format_labels(key), histogram.count))
+		return lines
+
+	def flush(self):
+		""" update peak RSS and replace the Prometheus file """
+
+		if not self.is_enabled():
+			return
+
+		self.set_gauge("peak_rss_bytes", memory_planner.get_peak_rss(), help_text="Peak resident set size")
+		if self.prometheus_filename != "":
+			temp_filename = self.prometheus_filename + ".tmp"
+			with open(temp_filename, "w") as file:
+				file.write("\n".join(self.get_prometheus_lines()) + "\n")
+			os.replace(temp_filename, self.prometheus_filename)
+
+	def close(self):
+
+		self.flush()
+		with self.lock:
+			if self.jsonl_file is not None:
+				self.jsonl_file.close()
+				self.jsonl_file = None
+
+
+# metrics sink shared by the model and the scripts
+default_sink = MetricsSink()
+
+
+def configure(jsonl_filename="", prometheus_filename="", labels=None):
+	default_sink.configure(jsonl_filename, prometheus_filename, labels)
+
+
+def record(event, values, labels=None):
+	default_sink.record(event, values, labels)
+
+
+def flush():
+	default_sink.flush()
+
+
+def close():
+	default_sink.close()
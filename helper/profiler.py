@@ -0,0 +1,163 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Ver: 2
+
+hierarchical profiler with named nested scopes
+
+with profiler.scope("train"):
+	with profiler.scope("batch"):    # recorded as "train/batch"
+		...
+
+@profiler.profile("inference")
+def do_for_file(...):
+
+Scopes are nested per thread. Count, total, mean and max are exact. p50 / p95 / p99 are computed from the latest
+MAX_SAMPLES durations of each scope. Listeners (like helper/tracer.py) are called with (path, start, elapsed) of each
+scope even if the statistics are disabled.
+"""
+
+import collections
+import contextlib
+import functools
+import logging
+import threading
+import time
+
+import numpy as np
+
+MAX_SAMPLES = 10000
+
+
+class ScopeStats:
+	def __init__(self, max_samples=MAX_SAMPLES):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.samples = collections.deque(maxlen=max_samples)
+
+	def add(self, elapsed):
+		self.count += 1
+		self.total += elapsed
+		self.max = max(self.max, elapsed)
+		self.samples.append(elapsed)
+
+	def get_percentiles(self):
+		return np.percentile(np.array(self.samples), [50, 95, 99])
+
+
+class Profiler:
+	def __init__(self, enabled=True, max_samples=MAX_SAMPLES):
+		self.enabled = enabled
+		self.max_samples = max_samples
+		self.stats = {}
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.listeners = []
+
+	def get_stack(self):
+		if not hasattr(self.local, "stack"):
+			self.local.stack = []
+		return self.local.stack
+
+	@contextlib.contextmanager
+	def scope(self, name):
+		""" measure the block as [parent scopes]/name """
+
+		if not self.enabled and len(self.listeners) == 0:
+			yield
+			return
+
+		stack = self.get_stack()
+		stack.append(name)
+		path = "/".join(stack)
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			elapsed = time.perf_counter() - start
+			if self.enabled:
+				self.add(path, elapsed)
+			for listener in self.listeners:
+				listener(path, start, elapsed)
+			stack.pop()
+
+	def profile(self, name=None):
+		""" decorator to measure the function as a scope. name is the function name if omitted. """
+
+		def decorator(func):
+			scope_name = func.__name__ if name is None else name
+
+			@functools.wraps(func)
+			def wrapper(*args, **kwargs):
+				with self.scope(scope_name):
+					return func(*args, **kwargs)
+
+			return wrapper
+
+		return decorator
+
+	def add(self, path, elapsed):
+		with self.lock:
+			if path not in self.stats:
+				self.stats[path] = ScopeStats(self.max_samples)
+			self.stats[path].add(elapsed)
+
+	def add_listener(self, listener):
+		""" listener(path, start, elapsed) is called at the end of each scope. start is time.perf_counter(). """
+
+		if listener not in self.listeners:
+			self.listeners.append(listener)
+
+	def reset(self):
+		with self.lock:
+			self.stats = {}
+
+	def get_summary(self):
+		""" returns [(path, count, total, mean, p50, p95, p99, max)] sorted by path. times are in seconds. """
+
+		with self.lock:
+			items = sorted(self.stats.items())
+			summary = []
+			for path, stats in items:
+				p50, p95, p99 = stats.get_percentiles()
+				summary.append((path, stats.count, stats.total, stats.total / stats.count, p50, p95, p99, stats.max))
+		return summary
+
+	def log_summary(self, title="Profile", reset=False):
+		""" log a table of all scopes (children are indented under their parents) to logging.info """
+
+		summary = self.get_summary()
+		if reset:
+			self.reset()
+		if len(summary) == 0:
+			return
+
+		lines = ["%s: %-32s %9s %10s %9s %9s %9s %9s %9s" % (
+			title, "scope", "count", "total[s]", "mean[ms]", "p50[ms]", "p95[ms]", "p99[ms]", "max[ms]")]
+		for path, count, total, mean, p50, p95, p99, max_time in summary:
+			depth = path.count("/")
+			name = "  " * depth + path.split("/")[-1]
+			lines.append("%s  %-32s %9s %10.3f %9.3f %9.3f %9.3f %9.3f %9.3f" % (
+				" " * len(title), name, "{:,}".format(count), total, mean * 1000, p50 * 1000, p95 * 1000, p99 * 1000,
+				max_time * 1000))
+		logging.info("\n".join(lines))
+
+
+# profiler shared by the model and the scripts
+default_profiler = Profiler()
+
+
+def scope(name):
+	return default_profiler.scope(name)
+
+
+def profile(name=None):
+	return default_profiler.profile(name)
+
+
+def set_enabled(enabled):
+	default_profiler.enabled = enabled
+
+
+def log_summary(title="Profile", reset=False):
+	default_profiler.log_summary(title, reset)
@@ -5,14 +5,20 @@ Ver: 2
 functions for building tensorflow graph
 """
 
+import contextlib
 import logging
 import os
 import shutil
 
+import numpy as np
 import tensorflow as tf
 
 from helper import utilty as util
 
+# compute dtypes of each precision. variables (master weights) are always float32.
+PRECISION_DTYPES = {"fp32": tf.float32, "fp16": tf.float16, "bf16": tf.bfloat16}
+HALF_PRECISION_POSTFIX = "_fp16"
+
 
 class TensorflowGraph:
 
@@ -28,6 +34,12 @@ class TensorflowGraph:
 		self.cnn_stride = 1
 		self.initializer = flags.initializer
 		self.weight_dev = flags.weight_dev
+		self.intra_op_threads = flags.intra_op_threads
+		self.inter_op_threads = flags.inter_op_threads
+		if flags.precision not in PRECISION_DTYPES:
+			raise NameError('Not implemented precision:%s' % flags.precision)
+		self.precision = flags.precision
+		self.compute_dtype = PRECISION_DTYPES[flags.precision]
 
 		# graph placeholders / objects
 		self.is_training = None
@@ -44,6 +56,10 @@ class TensorflowGraph:
 		self.save_images_num = flags.save_images_num
 		self.save_meta_data = flags.save_meta_data
 		self.log_weight_image_num = 32
+		self.telemetry = flags.telemetry
+		self.summary_interval = max(flags.summary_interval, 1)
+		self.telemetry_times = {}
+		self.telemetry_worker = None
 
 		# Environment (all directory name should not contain '/' after )
 		self.checkpoint_dir = flags.checkpoint_dir
@@ -56,21 +72,35 @@ class TensorflowGraph:
 		self.H = []
 		self.receptive_fields = 0
 		self.complexity = 0
+		self.layer_complexities = {}
+		self.current_layer = None
 		self.pix_per_input = 1
+		self.layer_variables = {}
+		self.reuse_variables = False
 
 		self.init_session()
 
 	def init_session(self):
 		config = tf.ConfigProto()
 		config.gpu_options.allow_growth = False
+		if self.intra_op_threads > 0:
+			config.intra_op_parallelism_threads = self.intra_op_threads
+		if self.inter_op_threads > 0:
+			config.inter_op_parallelism_threads = self.inter_op_threads
 
 		print("Session and graph initialized.")
 		self.sess = tf.InteractiveSession(config=config, graph=tf.Graph())
 
 	def init_all_variables(self):
-		self.sess.run(tf.global_variables_initializer())
+		self.sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
 		print("Model initialized.")
 
+	def to_compute_dtype(self, tensor):
+		return tensor if tensor.dtype.base_dtype == self.compute_dtype else tf.cast(tensor, self.compute_dtype)
+
+	def to_float32(self, tensor):
+		return tensor if tensor.dtype.base_dtype == tf.float32 else tf.cast(tensor, tf.float32)
+
 	def build_activator(self, input_tensor, features: int, activator="", leaky_relu_alpha=0.1, base_name=""):
 
 		features = int(features)
@@ -86,56 +116,124 @@ class TensorflowGraph:
 			output = tf.maximum(input_tensor, leaky_relu_alpha * input_tensor, name=base_name + "_leaky")
 		elif activator == "prelu":
 			with tf.variable_scope("prelu"):
-				alphas = tf.Variable(tf.constant(0.1, shape=[features]), name=base_name + "_prelu")
+				alphas = self.get_layer_variable(base_name + "_prelu", lambda: tf.Variable(
+					tf.constant(0.1, shape=[features]), name=base_name + "_prelu"))
 				if self.save_weights:
-					util.add_summaries("prelu_alpha", self.name, alphas, save_stddev=False, save_mean=False)
-				output = tf.nn.relu(input_tensor) + tf.multiply(alphas, (input_tensor - tf.abs(input_tensor))) * 0.5
+					util.add_summaries("prelu_alpha", self.name, alphas, save_stddev=False, save_mean=False,
+					                   save_histogram=self.telemetry == "full")
+				output = tf.nn.relu(input_tensor) + tf.multiply(self.to_compute_dtype(alphas),
+				                                                (input_tensor - tf.abs(input_tensor))) * 0.5
 		else:
 			raise NameError('Not implemented activator:%s' % activator)
 
-		self.complexity += (self.pix_per_input * features)
+		self.add_complexity(self.pix_per_input * features)
 
 		return output
 
+	def get_layer_variable(self, name, create_variable):
+		"""
+		returns the variable [variable scope]/name created by create_variable(). In reuse_layers(), the variable created
+		before is returned instead.
+		"""
+
+		key = tf.get_variable_scope().name + "/" + name
+		if not self.reuse_variables:
+			self.layer_variables[key] = create_variable()
+		return self.layer_variables[key]
+
+	@contextlib.contextmanager
+	def reuse_layers(self):
+		"""
+		Layers built in this block use the variables of the layers built before with the same names, so that the
+		network can be built again on other input tensors (like in the fused training loop). Status of the model (H,
+		Weights, complexity...) is restored at the end and no summary is added.
+		"""
+
+		status = (self.H, self.Weights, self.Biases, self.features, self.receptive_fields, self.complexity,
+		          dict(self.layer_complexities), self.pix_per_input, self.save_loss, self.save_weights, self.save_images)
+		self.H, self.Weights, self.Biases = [], [], []
+		self.save_loss = self.save_weights = self.save_images = False
+		self.reuse_variables = True
+		try:
+			yield
+		finally:
+			self.reuse_variables = False
+			(self.H, self.Weights, self.Biases, self.features, self.receptive_fields, self.complexity,
+			 self.layer_complexities, self.pix_per_input, self.save_loss, self.save_weights, self.save_images) = status
+
+	@contextlib.contextmanager
+	def layer(self, name):
+		"""
+		complexity added in the block is counted for the layer [variable scope]/name, which is also the name scope of
+		its ops. A layer inside another layer (CNN of pixel shuffler) is counted for the outer one.
+		"""
+
+		if self.current_layer is not None:
+			yield
+			return
+
+		scope = tf.get_variable_scope().name
+		self.current_layer = scope + "/" + name if scope != "" else name
+		self.layer_complexities.setdefault(self.current_layer, 0)
+		try:
+			yield
+		finally:
+			self.current_layer = None
+
+	def add_complexity(self, complexity):
+		""" complexity is multiply-adds for each input (LR) pixel """
+
+		self.complexity += complexity
+		if self.current_layer is not None:
+			self.layer_complexities[self.current_layer] += complexity
+
 	def conv2d(self, input_tensor, w, stride, bias=None, use_batch_norm=False, name=""):
 
-		output = tf.nn.conv2d(input_tensor, w, strides=[1, stride, stride, 1], padding="SAME", name=name + "_conv")
-		self.complexity += self.pix_per_input * int(w.shape[0] * w.shape[1] * w.shape[2] * w.shape[3])
+		# weights are cast to the compute dtype (no-op in fp32) and their gradients are cast back to float32
+		output = tf.nn.conv2d(input_tensor, self.to_compute_dtype(w), strides=[1, stride, stride, 1], padding="SAME",
+		                      name=name + "_conv")
+		self.add_complexity(self.pix_per_input * int(w.shape[0] * w.shape[1] * w.shape[2] * w.shape[3]))
 
 		if bias is not None:
-			output = tf.add(output, bias, name=name + "_add")
-			self.complexity += self.pix_per_input * int(bias.shape[0])
+			output = tf.add(output, self.to_compute_dtype(bias), name=name + "_add")
+			self.add_complexity(self.pix_per_input * int(bias.shape[0]))
 
 		if use_batch_norm:
-			output = tf.layers.batch_normalization(output, training=self.is_training, name='BN')
+			output = tf.layers.batch_normalization(output, training=self.is_training, name='BN',
+			                                       reuse=True if self.reuse_variables else None)
 
 		return output
 
 	def build_conv(self, name, input_tensor, cnn_size, input_feature_num, output_feature_num, use_bias=False,
 	               activator=None, use_batch_norm=False, dropout_rate=1.0):
 
-		with tf.variable_scope(name):
-			w = util.weight([cnn_size, cnn_size, input_feature_num, output_feature_num],
-			                stddev=self.weight_dev, name="conv_W", initializer=self.initializer)
+		with self.layer(name), tf.variable_scope(name):
+			w = self.get_layer_variable("conv_W", lambda: util.weight(
+				[cnn_size, cnn_size, input_feature_num, output_feature_num], stddev=self.weight_dev, name="conv_W",
+				initializer=self.initializer))
 
-			b = util.bias([output_feature_num], name="conv_B") if use_bias else None
+			b = self.get_layer_variable("conv_B", lambda: util.bias([output_feature_num], name="conv_B")) \
+				if use_bias else None
 			h = self.conv2d(input_tensor, w, self.cnn_stride, bias=b, use_batch_norm=use_batch_norm, name=name)
 
 			if activator is not None:
 				h = self.build_activator(h, output_feature_num, activator, base_name=name)
 
 			if dropout_rate < 1.0:
-				h = tf.nn.dropout(h, self.dropout, name="dropout")
+				h = tf.nn.dropout(h, self.to_compute_dtype(self.dropout), name="dropout")
 
 			self.H.append(h)
 
 			if self.save_weights:
-				util.add_summaries("weight", self.name, w, save_stddev=True, save_mean=True)
-				util.add_summaries("output", self.name, h, save_stddev=True, save_mean=True)
+				save_histogram = self.telemetry == "full"
+				util.add_summaries("weight", self.name, w, save_stddev=True, save_mean=True, save_histogram=save_histogram)
+				util.add_summaries("output", self.name, self.to_float32(h), save_stddev=True, save_mean=True,
+				                   save_histogram=save_histogram)
 				if use_bias:
-					util.add_summaries("bias", self.name, b, save_stddev=True, save_mean=True)
+					util.add_summaries("bias", self.name, b, save_stddev=True, save_mean=True,
+					                   save_histogram=save_histogram)
 
-			if self.save_images:
+			if self.save_images and self.telemetry == "full":
 				util.log_cnn_weights_as_images(self.name, w, max_outputs=self.save_images_num)
 
 		if self.receptive_fields == 0:
@@ -151,19 +249,22 @@ class TensorflowGraph:
 		return h
 
 	def build_transposed_conv(self, name, input_tensor, scale, channels):
-		with tf.variable_scope(name):
-			w = util.upscale_weight(scale=scale, channels=channels, name="Tconv_W")
-
-			batch_size = tf.shape(input_tensor)[0]
-			height = tf.shape(input_tensor)[1] * scale
-			width = tf.shape(input_tensor)[2] * scale
-
-			h = tf.nn.conv2d_transpose(input_tensor, w, output_shape=[batch_size, height, width, channels],
-			                           strides=[1, scale, scale, 1], name=name)
-
-		self.pix_per_input *= scale * scale
-		self.complexity += self.pix_per_input * util.get_upscale_filter_size(scale) * util.get_upscale_filter_size(
-			scale) * channels * channels
+		with self.layer(name):
+			with tf.variable_scope(name):
+				w = self.get_layer_variable("Tconv_W", lambda: util.upscale_weight(scale=scale, channels=channels,
+				                                                                   name="Tconv_W"))
+
+				batch_size = tf.shape(input_tensor)[0]
+				height = tf.shape(input_tensor)[1] * scale
+				width = tf.shape(input_tensor)[2] * scale
+
+				h = tf.nn.conv2d_transpose(input_tensor, self.to_compute_dtype(w),
+				                           output_shape=[batch_size, height, width, channels],
+				                           strides=[1, scale, scale, 1], name=name)
+
+			self.pix_per_input *= scale * scale
+			self.add_complexity(self.pix_per_input * util.get_upscale_filter_size(scale) *
+			                    util.get_upscale_filter_size(scale) * channels * channels)
 		self.receptive_fields += 1
 
 		self.Weights.append(w)
@@ -171,7 +272,7 @@ class TensorflowGraph:
 
 	def build_pixel_shuffler_layer(self, name, h, scale, filters, activator=None):
 
-		with tf.variable_scope(name):
+		with self.layer(name), tf.variable_scope(name):
 			self.build_conv(name+"_CNN", h, self.cnn_size, filters, scale * scale * filters, use_batch_norm=False, use_bias=True)
 			self.H.append(tf.depth_to_space(self.H[-1], scale))
 			self.build_activator(self.H[-1], filters, activator, base_name=name)
@@ -203,7 +304,10 @@ class TensorflowGraph:
 			print("Error. [%s] is not exist!" % filename)
 			exit(-1)
 
-		self.saver.restore(self.sess, filename)
+		if self.is_half_precision_checkpoint(filename):
+			self.restore_half_precision_model(filename)
+		else:
+			self.saver.restore(self.sess, filename)
 		if output_log:
 			logging.info("Model restored [ %s ]." % filename)
 		else:
@@ -225,10 +329,131 @@ class TensorflowGraph:
 		else:
 			print("Model saved [%s]." % filename)
 
+	def save_half_precision_model(self, name="", trial=0, output_log=False):
+		"""
+		Export weights (and batch norm statistics) as float16 to [name]_fp16.ckpt for inference. Optimizer slots are
+		not saved, so it's much smaller than the training checkpoint. load_model() restores it into any precision.
+		"""
+
+		if name == "" or name == "default":
+			name = self.name
+		name += HALF_PRECISION_POSTFIX
+
+		if trial > 0:
+			filename = self.checkpoint_dir + "/" + name + "_" + str(trial) + ".ckpt"
+		else:
+			filename = self.checkpoint_dir + "/" + name + ".ckpt"
+
+		variables = tf.trainable_variables() + [var for var in tf.global_variables() if "moving_" in var.op.name]
+		values = self.sess.run(variables)
+
+		with tf.Graph().as_default():
+			half_variables = [tf.Variable(value.astype(np.float16), name=var.op.name)
+			                  for var, value in zip(variables, values)]
+			with tf.Session() as sess:
+				sess.run(tf.variables_initializer(half_variables))
+				tf.train.Saver(half_variables).save(sess, filename)
+
+		if output_log:
+			logging.info("Half precision model saved [%s]." % filename)
+		else:
+			print("Half precision model saved [%s]." % filename)
+
+	def is_half_precision_checkpoint(self, filename):
+		dtypes = tf.train.NewCheckpointReader(filename).get_variable_to_dtype_map()
+		return any(dtype == tf.float16 for dtype in dtypes.values())
+
+	def restore_half_precision_model(self, filename):
+		""" restore variables from a checkpoint saved by save_half_precision_model() """
+
+		reader = tf.train.NewCheckpointReader(filename)
+		dtypes = reader.get_variable_to_dtype_map()
+		for var in tf.global_variables():
+			if var.op.name in dtypes:
+				var.load(reader.get_tensor(var.op.name).astype(var.dtype.base_dtype.as_numpy_dtype), self.sess)
+
+	def save_epoch_model(self, epoch, trial=0):
+		""" save model as [name]_E[epoch](_[trial]).ckpt to be evaluated by evaluate_watcher.py """
+
+		self.save_model(name="%s_E%d" % (self.name, epoch), trial=trial)
+
+	def get_state_filename(self, name="", trial=0):
+
+		if name == "" or name == "default":
+			name = self.name
+		if trial > 0:
+			name += "_" + str(trial)
+		return self.checkpoint_dir + "/" + name + "_state.pkl"
+
+	def save_state(self, state, name="", trial=0, writer=None):
+		"""
+		Save values of all variables (weights and optimizer slots) with state dict to resume the training.
+		Variables are snapshotted here and the file is written by writer (util.BackgroundWorker) if it's given.
+		"""
+
+		variables = tf.global_variables()
+		values = self.sess.run(variables)
+		data = {"variables": {var.name: value for var, value in zip(variables, values)}, "state": state}
+
+		filename = self.get_state_filename(name, trial)
+		if writer is None:
+			util.save_pickle(filename, data)
+		else:
+			writer.submit(util.save_pickle, filename, data)
+
+	def load_state(self, name="", trial=0):
+		""" restore all variables saved by save_state() and returns the state dict. returns None if not saved. """
+
+		filename = self.get_state_filename(name, trial)
+		if not os.path.isfile(filename):
+			return None
+
+		data = util.load_pickle(filename)
+		for var in tf.global_variables():
+			if var.name in data["variables"]:
+				var.load(data["variables"][var.name], self.sess)
+			else:
+				logging.warning("Variable [%s] is not in the state file." % var.name)
+
+		logging.info("Training state restored [%s]." % filename)
+		return data["state"]
+
 	def build_summary_saver(self):
 		if self.save_loss or self.save_weights or self.save_meta_data:
 			self.summary_op = tf.summary.merge_all()
 			self.train_writer = tf.summary.FileWriter(self.tf_log_dir + "/train")
 			self.test_writer = tf.summary.FileWriter(self.tf_log_dir + "/test", graph=self.sess.graph)
 
+			if self.telemetry == "background" and self.save_weights:
+				self.telemetry_worker = util.BackgroundWorker(max_pending=2)
+
 		self.saver = tf.train.Saver(max_to_keep=None)
+
+	def is_summary_epoch(self, epoch):
+		return epoch % self.summary_interval == 0
+
+	def add_telemetry_time(self, category, elapsed):
+		total, count = self.telemetry_times.get(category, (0, 0))
+		self.telemetry_times[category] = (total + elapsed, count + 1)
+
+	def log_telemetry_times(self):
+		""" log time spent for each category of summaries in the training thread """
+
+		for category, (total, count) in sorted(self.telemetry_times.items()):
+			logging.info("Telemetry [%s]: %2.3f sec total, %2.1f ms x %d" % (category, total, total * 1000 / count, count))
+
+	def log_weight_histograms_in_background(self, step):
+		"""
+		fetch values of weights and biases by one sess.run and write their histograms by the background worker.
+		No histogram op is needed in the graph.
+		"""
+
+		variables = self.Weights + self.Biases
+		values = self.sess.run(variables)
+		self.telemetry_worker.submit(self.write_weight_histograms, [var.op.name for var in variables], values, step)
+
+	def write_weight_histograms(self, names, values, step):
+
+		for name, value in zip(names, values):
+			util.log_histogram_value(self.train_writer, name + "/" + self.name, value, step)
+		self.train_writer.flush()
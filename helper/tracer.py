@@ -0,0 +1,150 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Ver: 2
+
+timeline tracer which writes chrome://tracing (or https://ui.perfetto.dev) compatible JSON
+
+Spans of the profiler scopes (batch, run, forward, colour, save, tensorboard...) are recorded as the "python" process
+with one row for each thread, and ops of sampled sess.run with RunOptions.FULL_TRACE are recorded as one process for
+each device. Both use wall clock micro seconds so that they are shown on the same time axis.
+
+tracer.configure("trace.json", interval=100, max_steps=10)
+if tracer.sample("train"):
+	(run with FULL_TRACE)
+	tracer.add_run_metadata(run_metadata, "train")
+tracer.save()
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from helper import profiler
+
+MAX_EVENTS = 1000000
+PYTHON_PID = 0
+
+
+class Tracer:
+	def __init__(self):
+		self.filename = ""
+		self.interval = 1
+		self.max_steps = 0
+		self.events = []
+		self.dropped_events = 0
+		self.run_counts = {}
+		self.traced_counts = {}
+		self.device_pids = {}
+		self.thread_ids = {}
+		self.lock = threading.Lock()
+		# offset to convert time.perf_counter() of the profiler to wall clock of RunMetadata
+		self.clock_offset = time.time() - time.perf_counter()
+
+	def is_enabled(self):
+		return self.filename != ""
+
+	def configure(self, filename, interval=100, max_steps=10):
+		""" enable the tracer. Every [interval]th sess.run of each kind is traced up to [max_steps] runs. """
+
+		self.filename = filename
+		self.interval = max(interval, 1)
+		self.max_steps = max_steps
+		if self.is_enabled():
+			profiler.default_profiler.add_listener(self.add_span)
+
+	def sample(self, kind):
+		""" returns True if this sess.run of the kind ("train", "inference"...) should be run with full trace """
+
+		if not self.is_enabled():
+			return False
+
+		with self.lock:
+			count = self.run_counts.get(kind, 0)
+			self.run_counts[kind] = count + 1
+			if count % self.interval != 0 or self.traced_counts.get(kind, 0) >= self.max_steps:
+				return False
+			self.traced_counts[kind] = self.traced_counts.get(kind, 0) + 1
+			return True
+
+	def add_event(self, event):
+		if len(self.events) >= MAX_EVENTS:
+			self.dropped_events += 1
+		else:
+			self.events.append(event)
+
+	def add_span(self, path, start, elapsed):
+		""" profiler listener. records the scope as a complete event of the current thread. """
+
+		if not self.is_enabled():
+			return
+
+		thread = threading.current_thread()
+		with self.lock:
+			if thread.ident not in self.thread_ids:
+				self.thread_ids[thread.ident] = len(self.thread_ids)
+				self.events.append({"name": "thread_name", "ph": "M", "pid": PYTHON_PID,
+				                    "tid": self.thread_ids[thread.ident], "args": {"name": thread.name}})
+			self.add_event({"name": path.split("/")[-1], "cat": "python", "ph": "X", "pid": PYTHON_PID,
+			                "tid": self.thread_ids[thread.ident], "ts": (start + self.clock_offset) * 1e6,
+			                "dur": elapsed * 1e6, "args": {"scope": path}})
+
+	def add_run_metadata(self, run_metadata, kind):
+		""" records ops in step_stats of the traced sess.run """
+
+		with self.lock:
+			for device_stats in run_metadata.step_stats.dev_stats:
+				if device_stats.device not in self.device_pids:
+					self.device_pids[device_stats.device] = len(self.device_pids) + PYTHON_PID + 1
+					self.events.append({"name": "process_name", "ph": "M", "pid": self.device_pids[device_stats.device],
+					                    "args": {"name": device_stats.device}})
+				pid = self.device_pids[device_stats.device]
+
+				for node_stats in device_stats.node_stats:
+					self.add_event({"name": node_stats.node_name, "cat": kind, "ph": "X", "pid": pid,
+					                "tid": node_stats.thread_id, "ts": node_stats.all_start_micros,
+					                "dur": max(node_stats.all_end_rel_micros, 1),
+					                "args": {"op": node_stats.timeline_label}})
+
+	def save(self, filename=None):
+		""" write all events recorded so far """
+
+		filename = self.filename if filename is None else filename
+		if filename == "":
+			return
+
+		with self.lock:
+			events = [{"name": "process_name", "ph": "M", "pid": PYTHON_PID, "args": {"name": "python"}}] + self.events
+			dropped_events = self.dropped_events
+
+		directory = os.path.dirname(filename)
+		if directory != "" and not os.path.exists(directory):
+			os.makedirs(directory)
+		with open(filename, "w") as file:
+			json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+		logging.info("Trace [%s] saved. %s events, traced runs:%s" % (filename, "{:,}".format(len(events)),
+		                                                              self.traced_counts))
+		if dropped_events > 0:
+			logging.warning("%s events were dropped over MAX_EVENTS." % "{:,}".format(dropped_events))
+
+
+# tracer shared by the model and the scripts
+default_tracer = Tracer()
+
+
+def configure(filename, interval=100, max_steps=10):
+	default_tracer.configure(filename, interval, max_steps)
+
+
+def sample(kind):
+	return default_tracer.sample(kind)
+
+
+def add_run_metadata(run_metadata, kind):
+	default_tracer.add_run_metadata(run_metadata, kind)
+
+
+def save(filename=None):
+	default_tracer.save(filename)
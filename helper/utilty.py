@@ -5,10 +5,13 @@ utility functions
 """
 
 import datetime
+import functools
 import logging
 import math
 import os
-import time
+import pickle
+import queue
+import threading
 from os import listdir
 
 import numpy as np
@@ -18,27 +21,47 @@ from os.path import isfile, join
 from scipy import misc
 
 
-class Timer:
-	def __init__(self, timer_count=100):
-		self.times = np.zeros(timer_count)
-		self.start_times = np.zeros(timer_count)
-		self.counts = np.zeros(timer_count)
-		self.timer_count = timer_count
+# summary collections for each category. all summaries are also in tf.GraphKeys.SUMMARIES
+SCALAR_SUMMARIES = "scalar_summaries"
+HISTOGRAM_SUMMARIES = "histogram_summaries"
+IMAGE_SUMMARIES = "image_summaries"
 
-	def start(self, timer_id):
-		self.start_times[timer_id] = time.time()
 
-	def end(self, timer_id):
-		self.times[timer_id] += time.time() - self.start_times[timer_id]
-		self.counts[timer_id] += 1
+class BackgroundWorker:
+	""" runs submitted functions on background threads. They are run in order when threads is 1. """
 
-	def print(self):
-		for i in range(self.timer_count):
-			if self.counts[i] > 0:
-				total = 0
-				print("Average of %d: %s[ms]" % (i, "{:,}".format(self.times[i] * 1000 / self.counts[i])))
-				total += self.times[i]
-				print("Total of %d: %s" % (i, "{:,}".format(total)))
+	def __init__(self, max_pending=0, threads=1):
+		self.queue = queue.Queue(maxsize=max_pending)
+		self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(max(threads, 1))]
+		for thread in self.threads:
+			thread.start()
+
+	def run(self):
+		while True:
+			task = self.queue.get()
+			if task is None:
+				self.queue.task_done()
+				return
+			func, args = task
+			try:
+				func(*args)
+			except Exception as error:
+				logging.error("Background task failed: %s" % error)
+			finally:
+				self.queue.task_done()
+
+	def submit(self, func, *args):
+		self.queue.put((func, args))
+
+	def wait(self):
+		self.queue.join()
+
+	def close(self):
+		""" wait for submitted functions and stop the threads. """
+		for _ in self.threads:
+			self.queue.put(None)
+		for thread in self.threads:
+			thread.join()
 
 
 # utilities for save / load
@@ -49,8 +72,7 @@ class LoadError(Exception):
 
 
 def make_dir(directory):
-	if not os.path.exists(directory):
-		os.makedirs(directory)
+	os.makedirs(directory, exist_ok=True)
 
 
 def delete_dir(directory):
@@ -110,8 +132,8 @@ def save_image(filename, image, print_console=False):
 		image = image.reshape(image.shape[0], image.shape[1])
 
 	directory = os.path.dirname(filename)
-	if directory != "" and not os.path.exists(directory):
-		os.makedirs(directory)
+	if directory != "":
+		os.makedirs(directory, exist_ok=True)
 
 	image = misc.toimage(image, cmin=0, cmax=255)  # to avoid range rescaling
 	misc.imsave(filename, image)
@@ -129,6 +151,24 @@ def save_image_data(filename, image):
 	print("Saved [%s]" % filename)
 
 
+def save_pickle(filename, data):
+	""" save data atomically so that a crash while writing doesn't break the previous file. """
+	directory = os.path.dirname(filename)
+	if directory != "" and not os.path.exists(directory):
+		os.makedirs(directory)
+
+	with open(filename + ".tmp", "wb") as f:
+		pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+	os.replace(filename + ".tmp", filename)
+
+
+def load_pickle(filename):
+	if not os.path.isfile(filename):
+		raise LoadError("File not found [%s]" % filename)
+	with open(filename, "rb") as f:
+		return pickle.load(f)
+
+
 def convert_rgb_to_y(image):
 	if len(image.shape) <= 2 or image.shape[2] == 1:
 		return image
@@ -229,6 +269,65 @@ def resize_image_by_pil(image, scale, resampling_method="bicubic"):
 	return image
 
 
+def bicubic_kernel(x, a=-0.5):
+	x = np.abs(x)
+	return np.where(x < 1.0, ((a + 2.0) * x - (a + 3.0)) * x * x + 1.0,
+	                np.where(x < 2.0, (((x - 5.0) * x + 8.0) * x - 4.0) * a, 0.0))
+
+
+@functools.lru_cache(maxsize=64)
+def get_bicubic_weights(in_size, out_size):
+	"""
+	Returns [out_size, in_size] resampling matrix which is the same as PIL's bicubic filter.
+	Kernel support is widened by the scale when downsampling (antialias) and each row is normalized.
+	"""
+	scale = in_size / out_size
+	filter_scale = max(scale, 1.0)
+	support = 2.0 * filter_scale
+
+	centers = (np.arange(out_size) + 0.5) * scale
+	x_min = np.maximum(np.trunc(centers - support + 0.5), 0)
+	x_max = np.minimum(np.trunc(centers + support + 0.5), in_size)
+
+	x = np.arange(in_size)
+	weights = bicubic_kernel((x[np.newaxis, :] - centers[:, np.newaxis] + 0.5) / filter_scale)
+	weights[(x[np.newaxis, :] < x_min[:, np.newaxis]) | (x[np.newaxis, :] >= x_max[:, np.newaxis])] = 0
+	total = weights.sum(axis=1, keepdims=True)
+	weights = np.divide(weights, total, out=np.zeros_like(weights), where=total != 0)
+
+	weights = weights.astype(np.float32)
+	weights.flags.writeable = False
+	return weights
+
+
+def resize_images_by_bicubic(images, scale):
+	"""
+	Resize [N, H, W, C] image stack at once with separable bicubic kernels.
+	Result is compatible with resize_image_by_pil(image, scale, "bicubic") for each image.
+	uint8 images are rounded and clipped after each pass like PIL does, other types are processed as float32.
+	"""
+	count, height, width, channels = images.shape
+	new_width = int(width * scale)
+	new_height = int(height * scale)
+	is_uint8 = images.dtype == np.uint8
+
+	horizontal = get_bicubic_weights(width, new_width)
+	vertical = get_bicubic_weights(height, new_height)
+
+	# [N, H, W, C] -> [N, C, H, W] so that both passes are simple matrix products
+	image = np.transpose(images, [0, 3, 1, 2]).astype(np.float32)
+
+	image = np.matmul(image, horizontal.T)
+	if is_uint8:
+		image = np.clip(np.floor(image + 0.5), 0, 255)
+
+	image = np.matmul(vertical, image)
+	if is_uint8:
+		image = np.clip(np.floor(image + 0.5), 0, 255).astype(np.uint8)
+
+	return np.ascontiguousarray(np.transpose(image, [0, 2, 3, 1]))
+
+
 def load_image(filename, width=0, height=0, channels=0, alignment=0, print_console=True):
 	if not os.path.isfile(filename):
 		raise LoadError("File not found [%s]" % filename)
@@ -269,48 +368,54 @@ def load_image_data(filename, width=0, height=0, channels=0, alignment=0, print_
 	return image
 
 
-def get_split_images(image, window_size, stride=None, enable_duplicate=False):
-	if len(image.shape) == 3 and image.shape[2] == 1:
-		image = image.reshape(image.shape[0], image.shape[1])
+def get_patch_positions(length, window_size, stride, enable_duplicate=False):
+	"""
+	Returns start positions of windows on the stride grid. If enable_duplicate, an edge-aligned window is added
+	when the grid doesn't reach the end so that every pixel is covered. Returns None if length < window_size.
+	"""
+	if length < window_size:
+		return None
 
-	window_size = int(window_size)
-	size = image.itemsize  # byte size of each value
-	height, width = image.shape
-	if stride is None:
-		stride = window_size
-	else:
-		stride = int(stride)
+	positions = np.arange(0, length - window_size + 1, stride)
+	if enable_duplicate and positions[-1] != length - window_size:
+		positions = np.append(positions, length - window_size)
+	return positions
 
-	if height < window_size or width < window_size:
-		return None
 
-	new_height = 1 + (height - window_size) // stride
-	new_width = 1 + (width - window_size) // stride
+def get_patch_windows(image, window_size, stride=None, enable_duplicate=False):
+	"""
+	Returns (windows, ys, xs) for [H, W] or [H, W, C] image.
+	windows is a read-only zero-copy view [H - window_size + 1, W - window_size + 1, window_size, window_size, C]
+	of all window positions, so windows[y, x] is the patch at (y, x) without copying.
+	ys and xs are the patch positions (see get_patch_positions). Returns (None, None, None) for a too small image.
+	"""
+	if len(image.shape) == 2:
+		image = image.reshape(image.shape[0], image.shape[1], 1)
+
+	window_size = int(window_size)
+	stride = window_size if stride is None else int(stride)
+	height, width, channels = image.shape
+
+	ys = get_patch_positions(height, window_size, stride, enable_duplicate)
+	xs = get_patch_positions(width, window_size, stride, enable_duplicate)
+	if ys is None or xs is None:
+		return None, None, None
 
-	shape = (new_height, new_width, window_size, window_size)
-	strides = size * np.array([width * stride, stride, width, 1])
-	windows = np.lib.stride_tricks.as_strided(image, shape=shape, strides=strides)
-	windows = windows.reshape(windows.shape[0] * windows.shape[1], windows.shape[2], windows.shape[3], 1)
+	strides = image.strides
+	windows = np.lib.stride_tricks.as_strided(
+		image, shape=(height - window_size + 1, width - window_size + 1, window_size, window_size, channels),
+		strides=(strides[0], strides[1], strides[0], strides[1], strides[2]), writeable=False)
 
-	if enable_duplicate:
-		extra_windows = []
-		if (height - window_size) % stride != 0:
-			for x in range(0, width - window_size, stride):
-				extra_windows.append(image[height - window_size - 1:height - 1, x:x + window_size:])
+	return windows, ys, xs
 
-		if (width - window_size) % stride != 0:
-			for y in range(0, height - window_size, stride):
-				extra_windows.append(image[y: y + window_size, width - window_size - 1:width - 1])
 
-		if len(extra_windows) > 0:
-			org_size = windows.shape[0]
-			windows = np.resize(windows,
-			                    [org_size + len(extra_windows), windows.shape[1], windows.shape[2], windows.shape[3]])
-			for i in range(len(extra_windows)):
-				extra_windows[i] = extra_windows[i].reshape([extra_windows[i].shape[0], extra_windows[i].shape[1], 1])
-				windows[org_size + i] = extra_windows[i]
+def get_texture_scores(images):
+	""" returns gradient energy (mean of squared horizontal / vertical differences) of each image of [N, H, W, C]. """
 
-	return windows
+	images = np.asarray(images, dtype=np.float32)
+	dy = np.diff(images, axis=1)
+	dx = np.diff(images, axis=2)
+	return np.mean(np.square(dy), axis=(1, 2, 3)) + np.mean(np.square(dx), axis=(1, 2, 3))
 
 
 # divide images with given stride. note return image size may not equal to window size.
@@ -410,22 +515,27 @@ def bias(shape, initial_value=0.0, name=None):
 
 # utilities for logging -----
 
-def add_summaries(scope_name, model_name, var, save_stddev=True, save_mean=False, save_max=False, save_min=False):
+def add_summaries(scope_name, model_name, var, save_stddev=True, save_mean=False, save_max=False, save_min=False,
+                  save_histogram=True):
+	scalar_collections = [tf.GraphKeys.SUMMARIES, SCALAR_SUMMARIES]
+
 	with tf.name_scope(scope_name):
 		mean_var = tf.reduce_mean(var)
 		if save_mean:
-			tf.summary.scalar("mean/" + model_name, mean_var)
+			tf.summary.scalar("mean/" + model_name, mean_var, collections=scalar_collections)
 
 		if save_stddev:
 			stddev_var = tf.sqrt(tf.reduce_mean(tf.square(var - mean_var)))
-			tf.summary.scalar("stddev/" + model_name, stddev_var)
+			tf.summary.scalar("stddev/" + model_name, stddev_var, collections=scalar_collections)
 
 		if save_max:
-			tf.summary.scalar("max/" + model_name, tf.reduce_max(var))
+			tf.summary.scalar("max/" + model_name, tf.reduce_max(var), collections=scalar_collections)
 
 		if save_min:
-			tf.summary.scalar("min/" + model_name, tf.reduce_min(var))
-		tf.summary.histogram(model_name, var)
+			tf.summary.scalar("min/" + model_name, tf.reduce_min(var), collections=scalar_collections)
+
+		if save_histogram:
+			tf.summary.histogram(model_name, var, collections=[tf.GraphKeys.SUMMARIES, HISTOGRAM_SUMMARIES])
 
 
 def log_scalar_value(writer, name, value, step):
@@ -433,6 +543,19 @@ def log_scalar_value(writer, name, value, step):
 	writer.add_summary(summary, step)
 
 
+def log_histogram_value(writer, name, values, step, bins=30):
+	""" log histogram of numpy values (computed without tensorflow ops) """
+
+	values = np.asarray(values, dtype=np.float64).ravel()
+	counts, edges = np.histogram(values, bins=bins)
+
+	histogram = tf.HistogramProto(min=float(values.min()), max=float(values.max()), num=values.size,
+	                              sum=float(values.sum()), sum_squares=float(np.dot(values, values)),
+	                              bucket_limit=edges[1:].tolist(), bucket=counts.tolist())
+	summary = tf.Summary(value=[tf.Summary.Value(tag=name, histo=histogram)])
+	writer.add_summary(summary, step)
+
+
 def log_fcn_output_as_images(image, width, height, filters, model_name, max_outputs=20):
 	"""
 	input tensor should be [ N, H * W * C ]
@@ -451,7 +574,8 @@ def log_cnn_weights_as_images(model_name, weights, max_outputs=20):
 	weights = tf.reshape(weights, [shapes[0], shapes[1], shapes[2] * shapes[3]])
 	weights_transposed = tf.transpose(weights, [2, 0, 1])
 	weights_transposed = tf.reshape(weights_transposed, [shapes[2] * shapes[3], shapes[0], shapes[1], 1])
-	tf.summary.image(model_name, weights_transposed, max_outputs=max_outputs)
+	tf.summary.image(model_name, weights_transposed, max_outputs=max_outputs,
+	                 collections=[tf.GraphKeys.SUMMARIES, IMAGE_SUMMARIES])
 
 
 def get_shapes(input_tensor):
@@ -591,3 +715,33 @@ def flip(image, flip_type, invert=False):
 			return np.flipud(np.rot90(image, -1))
 		else:
 			return np.rot90(np.flipud(image), 1)
+
+
+def flip_images(images, flip_types):
+	"""
+	Apply flip() to [N, H, W, C] square image stack. flip_types is flip_type for each image.
+	Images which have the same flip_type are flipped / rotated at once.
+	"""
+	flip_types = np.asarray(flip_types)
+	flipped = np.empty_like(images)
+
+	for flip_type in np.unique(flip_types):
+		indexes = np.flatnonzero(flip_types == flip_type)
+		image = images[indexes]
+		if flip_type == 1:
+			image = np.flip(image, 1)
+		elif flip_type == 2:
+			image = np.flip(image, 2)
+		elif flip_type == 3:
+			image = np.flip(np.flip(image, 2), 1)
+		elif flip_type == 4:
+			image = np.rot90(image, 1, axes=(1, 2))
+		elif flip_type == 5:
+			image = np.rot90(image, -1, axes=(1, 2))
+		elif flip_type == 6:
+			image = np.flip(np.rot90(image, 1, axes=(1, 2)), 1)
+		elif flip_type == 7:
+			image = np.flip(np.rot90(image, -1, axes=(1, 2)), 1)
+		flipped[indexes] = image
+
+	return flipped
@@ -0,0 +1,74 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Author: Jin Yamanaka
+Github: https://github.com/jiny2001/dcscn-image-super-resolution
+Ver: 2.0
+
+Trace one training step and one inference step and log measured time and memory of each layer
+(CNN1.., A1, B1, B2, Up-PS, R-CNN..) next to their analytic GFLOPs, ranked by the time.
+
+Use the same model args as the training. Weights are initialized (or loaded by --load_model_name) and
+--profile_warmup_steps steps are trained before the traced step. Traces are also written to tensorboard log.
+
+python profile_model.py --dataset bsd200 --test_dataset set5 --load_model_name default
+"""
+
+import tensorflow as tf
+
+import DCSCN
+from helper import args, image_index
+
+args.flags.DEFINE_integer("profile_warmup_steps", 3, "Training steps (and inference runs) before the traced one")
+
+FLAGS = args.get()
+
+
+def main(not_parsed_args):
+	if len(not_parsed_args) > 1:
+		print("Unknown args:%s" % not_parsed_args)
+		exit()
+
+	FLAGS.initialize_tf_log = False
+	FLAGS.save_loss = FLAGS.save_weights = FLAGS.save_images = False
+	FLAGS.save_meta_data = True
+
+	model = DCSCN.create_model(FLAGS, model_name=FLAGS.model_name)
+	if FLAGS.build_batch:
+		model.load_datasets(FLAGS.data_dir + "/" + FLAGS.dataset, FLAGS.batch_dir + "/" + FLAGS.dataset,
+		                    FLAGS.batch_image_size, FLAGS.stride_size)
+	else:
+		model.load_dynamic_datasets(FLAGS.data_dir + "/" + FLAGS.dataset, FLAGS.batch_image_size)
+	model.build_graph()
+	model.build_optimizer()
+	model.build_summary_saver()
+
+	model.init_all_variables()
+	if FLAGS.load_model_name != "":
+		model.load_model(FLAGS.load_model_name, output_log=True)
+	model.init_epoch_index()
+
+	# training step
+	for _ in range(FLAGS.profile_warmup_steps):
+		model.build_input_batch()
+		model.train_batch()
+	model.build_input_batch()
+	run_metadata = model.trace_training_step()
+	model.train_writer.add_run_metadata(run_metadata, "training_step")
+	model.log_model_analysis(run_metadata, model.batch_input.shape, "Training step: batch %d x %dx%d" % (
+		model.batch_num, model.patch_size, model.patch_size))
+
+	# inference step
+	test_filename = image_index.get_image_files(FLAGS.data_dir + "/" + FLAGS.test_dataset)[0]
+	for _ in range(FLAGS.profile_warmup_steps):
+		model.trace_inference(test_filename)
+	run_metadata, input_shape = model.trace_inference(test_filename)
+	model.test_writer.add_run_metadata(run_metadata, "inference")
+	model.log_model_analysis(run_metadata, input_shape, "Inference: [%s] %dx%d" % (
+		test_filename, input_shape[2], input_shape[1]))
+
+	model.train_writer.flush()
+	model.test_writer.flush()
+
+
+if __name__ == '__main__':
+	tf.app.run()
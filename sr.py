@@ -17,25 +17,32 @@ Then you must run evaluate.py like below.
 python3 evaluate.py --layers 4 --filters 24 --file your_image_file_path
 """
 
+import time
+
 import tensorflow as tf
 
 import DCSCN
-from helper import args
+from helper import args, metrics, profiler, tracer
 
 args.flags.DEFINE_string("file", "image.jpg", "Target filename")
 FLAGS = args.get()
 
 
 def main(_):
-	model = DCSCN.SuperResolution(FLAGS, model_name=FLAGS.model_name)
+	model = DCSCN.create_model(FLAGS, model_name=FLAGS.model_name)
 	model.build_graph()
 	model.build_optimizer()
 	model.build_summary_saver()
 
 	model.init_all_variables()
-	model.load_model()
+	model.load_model(FLAGS.load_model_name)
 
+	start_time = time.time()
 	model.do_for_file(FLAGS.file, FLAGS.output_dir)
+	metrics.record("inference", {"seconds": time.time() - start_time}, {"file": FLAGS.file})
+	profiler.log_summary()
+	tracer.save()
+	metrics.close()
 
 
 if __name__ == '__main__':
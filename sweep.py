@@ -0,0 +1,217 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Author: Jin Yamanaka
+Github: https://github.com/jiny2001/dcscn-image-super-resolution
+Ver: 2.0
+
+Hyperparameter sweep with successive halving in one process.
+
+Training dataset and validation set are loaded once and shared by all configurations. Each configuration of
+the --sweep grid is trained for --sweep_epochs epochs, then only the better 1 / --sweep_halving_rate of them
+(by validation PSNR) continue for --sweep_halving_rate times more epochs and so on. The last configuration
+is trained until its learning rate schedule finishes. Each configuration is resumed from its training
+state file, so only one model is in memory at a time. Results are printed and saved to --sweep_output as CSV.
+
+Parameters of the training dataset and its sampling (scale, batch_image_size, stride_size, channels, build_batch,
+dataset, texture_sampling, hard_example_half_life, patch_curriculum...) can't be swept since the dataset is shared.
+Patch size and hard example losses of the shared loader are reset for each configuration.
+
+python sweep.py --sweep "layers=8,12;filters=96,196;initial_lr=0.002,0.001" --dataset bsd200
+"""
+
+import argparse
+import csv
+import itertools
+import logging
+import math
+import time
+
+import tensorflow as tf
+
+import DCSCN
+from helper import args, image_index
+
+args.flags.DEFINE_string("sweep", "layers=8,12;filters=96,196", "Grid of parameters. [name]=[value],[value];...")
+args.flags.DEFINE_integer("sweep_epochs", 2, "Epochs trained by all configurations before the first halving")
+args.flags.DEFINE_integer("sweep_halving_rate", 2, "Keep best 1 / this configurations on each halving")
+args.flags.DEFINE_string("sweep_output", "sweep_results.csv", "CSV filename for the results")
+
+FLAGS = args.get()
+
+DATASET_FLAGS = ["dataset", "data_dir", "batch_dir", "build_batch", "scale", "batch_image_size", "stride_size",
+                 "channels", "batch_augment", "area_weighted_sampling", "texture_sampling", "texture_threshold",
+                 "hard_example_half_life", "patch_curriculum", "test_dataset", "validation_images",
+                 "validation_crop"]
+
+
+def main(not_parsed_args):
+	if len(not_parsed_args) > 1:
+		print("Unknown args:%s" % not_parsed_args)
+		exit()
+
+	FLAGS.initialize_tf_log = False
+	FLAGS.save_loss = FLAGS.save_weights = FLAGS.save_images = FLAGS.save_meta_data = False
+
+	configs = parse_sweep(FLAGS.sweep, FLAGS.flag_values_dict())
+	if configs is None:
+		exit(-1)
+
+	results = sweep(configs)
+	print_results(results)
+	save_results(FLAGS.sweep_output, results)
+
+
+def parse_sweep(sweep_text, flags_dict):
+	""" returns list of parameter dicts of all combinations in the grid. values are converted to the flag's type. """
+
+	names = []
+	values_list = []
+
+	for item in sweep_text.split(";"):
+		if item.strip() == "":
+			continue
+		name, values = item.split("=", 1)
+		name = name.strip()
+		if name not in flags_dict:
+			print("Unknown parameter [%s] in sweep." % name)
+			return None
+		if name in DATASET_FLAGS:
+			print("Parameter [%s] can't be swept since the dataset is shared." % name)
+			return None
+
+		default = flags_dict[name]
+		if isinstance(default, bool):
+			values = [value.strip().lower() in ("true", "1") for value in values.split(",")]
+		else:
+			values = [type(default)(value.strip()) for value in values.split(",")]
+		names.append(name)
+		values_list.append(values)
+
+	return [dict(zip(names, values)) for values in itertools.product(*values_list)]
+
+
+def build_model(config_no, params, train=None, validation_set=None):
+	""" build model with the flags overwritten by params. train (loader) and validation_set are shared if given. """
+
+	flags = argparse.Namespace(**dict(FLAGS.flag_values_dict(), **params))
+	model = DCSCN.SuperResolution(flags, model_name="sweep%d" % config_no)
+
+	if train is not None:
+		# the patch size and the loss table are restored by load_training_state() if the configuration is resumed
+		train.set_patch_size(flags.batch_image_size)
+		train.loss_table = None
+		model.train = train
+	elif flags.build_batch:
+		model.load_datasets(flags.data_dir + "/" + flags.dataset, flags.batch_dir + "/" + flags.dataset,
+		                    flags.batch_image_size, flags.stride_size)
+	else:
+		model.load_dynamic_datasets(flags.data_dir + "/" + flags.dataset, flags.batch_image_size)
+
+	if validation_set is not None:
+		model.validation_set = validation_set
+	else:
+		model.build_validation_set(image_index.get_image_files(flags.data_dir + "/" + flags.test_dataset))
+
+	model.build_graph()
+	model.build_optimizer()
+	model.build_summary_saver()
+	return model, flags
+
+
+def train_epochs(model, flags, epochs):
+	""" train epochs (or until the learning rate schedule ends) and returns True if the schedule has ended. """
+
+	completed = 0
+	while model.lr > flags.end_lr and completed < epochs:
+
+		model.build_input_batch()
+		model.train_batch()
+
+		if model.training_step * model.batch_num >= model.training_images:
+			model.epochs_completed += 1
+			completed += 1
+			model.update_epoch_and_lr()
+			model.init_epoch_index()
+
+	return model.lr <= flags.end_lr
+
+
+def sweep(configs):
+
+	results = [{"no": i, "params": params, "epochs": 0, "steps": 0, "mse": 0, "psnr": 0, "time": 0,
+	            "status": "running"} for i, params in enumerate(configs)]
+	train = validation_set = None
+	alive = list(range(len(configs)))
+	epochs = FLAGS.sweep_epochs
+
+	while True:
+		for config_no in alive:
+			result = results[config_no]
+			start_time = time.time()
+
+			model, flags = build_model(config_no, result["params"], train, validation_set)
+			train, validation_set = model.train, model.validation_set
+
+			model.init_all_variables()
+			model.init_train_step()
+			model.init_epoch_index()
+			if result["epochs"] > 0:
+				model.load_training_state()
+
+			finished = train_epochs(model, flags, epochs - result["epochs"])
+			model.save_training_state()
+
+			result["mse"], result["psnr"] = model.evaluate_validation_set()
+			result["epochs"], result["steps"] = model.epochs_completed, model.step
+			result["time"] += time.time() - start_time
+			if finished:
+				result["status"] = "finished"
+				model.save_model(output_log=True)
+
+			logging.info("Sweep config %d %s Epoch:%d PSNR:%f (%d sec)" % (
+				config_no, result["params"], result["epochs"], result["psnr"], result["time"]))
+			model.sess.close()
+
+		alive = [config_no for config_no in alive if results[config_no]["status"] == "running"]
+		if len(alive) == 0:
+			break
+		if len(alive) == 1:
+			# the best configuration is trained until its learning rate schedule ends
+			epochs = math.inf
+			continue
+
+		alive.sort(key=lambda config_no: results[config_no]["psnr"], reverse=True)
+		keep = max(1, int(math.ceil(len(alive) / FLAGS.sweep_halving_rate)))
+		for config_no in alive[keep:]:
+			results[config_no]["status"] = "stopped"
+		alive = alive[:keep]
+		epochs *= FLAGS.sweep_halving_rate
+
+	return results
+
+
+def print_results(results):
+
+	results = sorted(results, key=lambda result: result["psnr"], reverse=True)
+	logging.info("\n=== Sweep results [%s] ===" % FLAGS.test_dataset)
+	for result in results:
+		logging.info("%3d %-9s Epoch:%3d Steps:%s PSNR:%2.3f Time:%s sec  %s" % (
+			result["no"], result["status"], result["epochs"], "{:,}".format(result["steps"]), result["psnr"],
+			"{:,.0f}".format(result["time"]), result["params"]))
+
+
+def save_results(filename, results):
+
+	names = sorted(set(name for result in results for name in result["params"]))
+	with open(filename, "w", newline="") as f:
+		writer = csv.writer(f)
+		writer.writerow(["no"] + names + ["status", "epochs", "steps", "mse", "psnr", "time"])
+		for result in results:
+			writer.writerow([result["no"]] + [result["params"].get(name) for name in names] +
+			                [result["status"], result["epochs"], result["steps"], result["mse"], result["psnr"],
+			                 "%0.1f" % result["time"]])
+	print("Sweep results saved [%s]." % filename)
+
+
+if __name__ == '__main__':
+	tf.app.run()
@@ -0,0 +1,59 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Ver: 2
+
+tests for the packed Y-channel image store
+
+python -m unittest discover tests
+"""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from helper import image_store
+
+
+class TestImageStore(unittest.TestCase):
+
+	def setUp(self):
+		self.temp_dir = tempfile.TemporaryDirectory()
+		random_state = np.random.RandomState(0)
+
+		self.gray_image = random_state.randint(256, size=(12, 20)).astype(np.uint8)
+		self.rgb_image = random_state.randint(256, size=(9, 7, 3)).astype(np.uint8)
+		self.filenames = [os.path.join(self.temp_dir.name, name) for name in ["gray.png", "broken.png", "rgb.png"]]
+		Image.fromarray(self.gray_image).save(self.filenames[0])
+		with open(self.filenames[1], "w") as f:
+			f.write("not an image")
+		Image.fromarray(self.rgb_image).save(self.filenames[2])
+
+	def tearDown(self):
+		self.temp_dir.cleanup()
+
+	def test_round_trip(self):
+		store_dir = os.path.join(self.temp_dir.name, "store")
+		self.assertEqual(image_store.build_image_store(self.filenames, store_dir, processes=1), 2)
+		self.assertTrue(image_store.is_image_store(store_dir))
+
+		store = image_store.ImageStore(store_dir)
+		self.assertEqual(store.count, 2)
+		self.assertEqual(store.names, ["gray.png", "rgb.png"])
+		self.assertEqual(store.get_size(0), (12, 20))
+		self.assertEqual(store.get_size(1), (9, 7))
+
+		np.testing.assert_array_equal(store.get_image(0), self.gray_image.reshape(12, 20, 1))
+		y_image = np.clip(np.round(self.rgb_image.astype(np.float64).dot(image_store.Y_XFORM) + 16.0), 0, 255)
+		np.testing.assert_array_equal(store.get_image(1), y_image.reshape(9, 7, 1))
+
+	def test_empty_store(self):
+		store_dir = os.path.join(self.temp_dir.name, "empty")
+		self.assertEqual(image_store.build_image_store(self.filenames[1:2], store_dir, processes=1), 0)
+		self.assertEqual(image_store.ImageStore(store_dir).count, 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,48 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Ver: 2
+
+tests for the loss table of hard example mining
+
+python -m unittest discover tests
+"""
+
+import unittest
+
+import numpy as np
+
+from helper import loader
+
+
+class TestLossTable(unittest.TestCase):
+
+	def test_untrained_items_are_uniform(self):
+		table = loader.LossTable(4, half_life=10)
+		np.testing.assert_allclose(table.get_weights(), [0.25, 0.25, 0.25, 0.25])
+
+	def test_untrained_items_have_mean_loss(self):
+		table = loader.LossTable(4, half_life=10)
+		table.update([0, 1], [4.0, 2.0], step=10)
+
+		np.testing.assert_allclose(table.get_weights(), np.array([4.0, 2.0, 3.0, 3.0]) / 12.0)
+
+	def test_old_losses_decay_toward_mean(self):
+		table = loader.LossTable(4, half_life=10)
+		table.update([0, 1], [4.0, 2.0], step=10)
+		table.update([2], [3.0], step=20)
+
+		# losses of step 10 are half decayed toward the mean loss 3.0 at step 20
+		np.testing.assert_allclose(table.get_weights(), np.array([3.5, 2.5, 3.0, 3.0]) / 12.0)
+
+	def test_state_round_trip(self):
+		table = loader.LossTable(4, half_life=10)
+		table.update([0, 3], [4.0, 1.0], step=5)
+
+		restored = loader.LossTable(4, half_life=10)
+		restored.set_state(table.get_state())
+		np.testing.assert_allclose(restored.get_weights(), table.get_weights())
+		self.assertEqual(restored.step, 5)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,86 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Ver: 2
+
+tests for the arithmetic of the memory planner
+
+python -m unittest discover tests
+"""
+
+import argparse
+import unittest
+from unittest import mock
+
+from helper import memory_planner
+from helper.memory_planner import MB, TRAINING_ACTIVATION_COPIES
+
+# 2 layers of 4 filters, NIN 2 / 2, pixel shuffler x2 and one reconstruction layer
+MODEL_ARGS = {"precision": "fp32", "scale": 2, "activator": "relu", "layers": 2, "filters": 4, "min_filters": 0,
+              "filters_decay_gamma": 1.5, "channels": 1, "output_channels": 1, "cnn_size": 3, "use_nin": True,
+              "nin_filters": 2, "nin_filters2": 2, "pixel_shuffler": True, "reconstruct_layers": 1,
+              "reconstruct_filters": 2, "optimizer": "adam", "gradient_accumulation": 1, "self_ensemble": 1}
+
+# parameters: CNN1 40, CNN2 148, A1 18, B1 18, B2 38, Up-PS_CNN 592, R-CNN1 37
+PARAMETERS = 891
+# output elements for each LR pixel: CNN 4 + 4, Concat 8, A1 2, B1 2, B2 2, Concat2 4, Up-PS_CNN 16, Up-PS 16, R-CNN 4
+ELEMENTS = 62
+# inference pass for each LR pixel: float32 input / bicubic / output, one copy of all outputs and the largest output
+PASS_BYTES_PER_PIXEL = 4 * (1 + 2 * 4) + ELEMENTS * 4 + 16 * 4
+
+
+class TestMemoryPlanner(unittest.TestCase):
+
+	def setUp(self):
+		self.planner = memory_planner.MemoryPlanner(argparse.Namespace(**MODEL_ARGS), budget_mb=1)
+
+	def test_layer_shapes(self):
+		layers = self.planner.get_layer_shapes(2)
+		self.assertEqual([layer.name for layer in layers],
+		                 ["CNN1", "CNN2", "Concat", "A1", "B1", "B2", "Concat2", "Up-PS_CNN", "Up-PS", "R-CNN1"])
+		self.assertEqual(self.planner.get_parameters(), PARAMETERS)
+		self.assertEqual(sum(layer.get_output_elements() for layer in layers), ELEMENTS)
+
+	def test_training(self):
+		# weights, adam slots and gradients
+		self.assertEqual(self.planner.get_weight_bytes(training=True), PARAMETERS * 4 * 4)
+		# uint8 input (8x8) and bicubic / true (16x16) patches
+		self.assertEqual(self.planner.get_patch_store_bytes(10, 8), 10 * (64 + 2 * 256))
+
+		pixels = 2 * 8 * 8
+		batch_bytes = 2 * 4 * pixels * (1 + 2 * 4)
+		self.assertEqual(self.planner.get_training_step_bytes(2, 8),
+		                 batch_bytes + pixels * ELEMENTS * 4 * TRAINING_ACTIVATION_COPIES)
+		self.assertEqual(sum(self.planner.predict_training(10, 2, 8).values()),
+		                 10 * (64 + 2 * 256) + PARAMETERS * 16 + self.planner.get_training_step_bytes(2, 8))
+
+	def test_max_batch_num(self):
+		fixed_bytes = self.planner.get_patch_store_bytes(10, 8) + self.planner.get_weight_bytes(training=True)
+		step_bytes = self.planner.get_training_step_bytes(1, 8)
+
+		with mock.patch.object(self.planner, "get_available_bytes", return_value=fixed_bytes + step_bytes * 3 + 100):
+			self.assertEqual(self.planner.get_max_batch_num(10, 8), 3)
+		with mock.patch.object(self.planner, "get_available_bytes", return_value=fixed_bytes - 1):
+			self.assertEqual(self.planner.get_max_batch_num(10, 8), 0)
+
+	def test_tile_size(self):
+		host_bytes = 100 * 100 * 8 * (1 + 3 * 4)
+		self.assertEqual(self.planner.get_host_image_bytes(100, 100), host_bytes)
+		self.assertEqual(self.planner.get_inference_pass_bytes(1, 1), PASS_BYTES_PER_PIXEL)
+		fixed_bytes = host_bytes + self.planner.get_weight_bytes(training=False)
+
+		with mock.patch.object(self.planner, "get_available_bytes", return_value=100 * MB):
+			self.assertEqual(self.planner.get_tile_size(100, 100, margin=4), 0)
+		# 40x40 pass - 2 x margin = 32
+		with mock.patch.object(self.planner, "get_available_bytes",
+		                       return_value=fixed_bytes + PASS_BYTES_PER_PIXEL * 40 * 40):
+			self.assertEqual(self.planner.get_tile_size(100, 100, margin=4), 32)
+		with mock.patch.object(self.planner, "get_available_bytes",
+		                       return_value=fixed_bytes + PASS_BYTES_PER_PIXEL * 20 * 20):
+			self.assertEqual(self.planner.get_tile_size(100, 100, margin=4), -1)
+
+	def test_format_bytes(self):
+		self.assertEqual(memory_planner.format_bytes({"a": MB, "b": MB // 2}), "a:1.0[MB] b:0.5[MB] total:1.5[MB]")
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,98 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Ver: 2
+
+tests for JSONL records and the Prometheus text format of the metrics sink
+
+python -m unittest discover tests
+"""
+
+import json
+import os
+import re
+import tempfile
+import unittest
+
+import numpy as np
+
+from helper import metrics
+
+SAMPLE_LINE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_][a-zA-Z0-9_]*="([^"\\]|\\.)*",?)*\})? \S+$')
+
+
+class TestMetricsSink(unittest.TestCase):
+
+	def setUp(self):
+		self.temp_dir = tempfile.TemporaryDirectory()
+		self.jsonl_filename = os.path.join(self.temp_dir.name, "metrics.jsonl")
+		self.prometheus_filename = os.path.join(self.temp_dir.name, "metrics.prom")
+		self.sink = metrics.MetricsSink()
+		self.sink.jsonl_filename = self.jsonl_filename
+		self.sink.prometheus_filename = self.prometheus_filename
+		self.sink.labels = {"model": 'dcscn "L12"'}
+
+	def tearDown(self):
+		self.sink.close()
+		self.temp_dir.cleanup()
+
+	def read_prometheus_lines(self):
+		self.sink.flush()
+		with open(self.prometheus_filename) as f:
+			return f.read().splitlines()
+
+	def test_record(self):
+		self.sink.record("epoch", {"steps_per_second": np.float32(2.5), "psnr": 37, "finished": True, "name": "x"},
+		                 labels={"dataset": "set5"})
+
+		with open(self.jsonl_filename) as f:
+			line = json.loads(f.readline())
+		self.assertEqual(line["event"], "epoch")
+		self.assertEqual(line["model"], 'dcscn "L12"')
+		self.assertEqual(line["dataset"], "set5")
+		self.assertEqual((line["steps_per_second"], line["psnr"], line["finished"], line["name"]), (2.5, 37, True, "x"))
+
+		lines = self.read_prometheus_lines()
+		self.assertIn("# TYPE dcscn_epoch_steps_per_second gauge", lines)
+		self.assertIn('dcscn_epoch_steps_per_second{dataset="set5",model="dcscn \\"L12\\""} 2.5', lines)
+		self.assertIn('dcscn_epoch_psnr{dataset="set5",model="dcscn \\"L12\\""} 37.0', lines)
+		# only numbers are gauges
+		self.assertFalse(any(line.startswith("dcscn_epoch_finished") or line.startswith("dcscn_epoch_name")
+		                     for line in lines))
+
+	def test_histogram(self):
+		for value in [0.001, 0.3, 1000.0]:
+			self.sink.observe("latency_seconds", value, help_text="Latency")
+
+		lines = self.read_prometheus_lines()
+		self.assertIn("# HELP dcscn_latency_seconds Latency", lines)
+		self.assertIn("# TYPE dcscn_latency_seconds histogram", lines)
+		labels = 'model="dcscn \\"L12\\""'
+		# buckets are cumulative and include the upper bound
+		self.assertIn('dcscn_latency_seconds_bucket{%s,le="0.001"} 1' % labels, lines)
+		self.assertIn('dcscn_latency_seconds_bucket{%s,le="0.25"} 1' % labels, lines)
+		self.assertIn('dcscn_latency_seconds_bucket{%s,le="0.5"} 2' % labels, lines)
+		self.assertIn('dcscn_latency_seconds_bucket{%s,le="300.0"} 2' % labels, lines)
+		self.assertIn('dcscn_latency_seconds_bucket{%s,le="+Inf"} 3' % labels, lines)
+		self.assertIn('dcscn_latency_seconds_sum{%s} 1000.301' % labels, lines)
+		self.assertIn('dcscn_latency_seconds_count{%s} 3' % labels, lines)
+
+	def test_text_format(self):
+		self.sink.record("epoch", {"psnr": 37.5})
+		self.sink.observe("latency_seconds", 0.01)
+
+		lines = self.read_prometheus_lines()
+		self.assertIn("# TYPE dcscn_peak_rss_bytes gauge", lines)
+		for line in lines:
+			if not line.startswith("# "):
+				self.assertRegex(line, SAMPLE_LINE)
+				float(line.rsplit(" ", 1)[1])
+
+	def test_span_listener(self):
+		self.sink.add_span("train/batch", 0, 0.002)
+		self.sink.add_span("train/run", 0, 0.002)
+
+		self.assertEqual(list(self.sink.histograms), ["dcscn_loader_wait_seconds"])
+
+
+if __name__ == '__main__':
+	unittest.main()
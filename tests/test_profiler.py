@@ -0,0 +1,92 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Ver: 2
+
+tests for nested scopes of the hierarchical profiler
+
+python -m unittest discover tests
+"""
+
+import threading
+import unittest
+
+from helper import profiler
+
+
+class TestProfiler(unittest.TestCase):
+
+	def test_nested_scopes(self):
+		p = profiler.Profiler()
+
+		with p.scope("train"):
+			for _ in range(3):
+				with p.scope("batch"):
+					pass
+			with p.scope("run"):
+				with p.scope("batch"):
+					pass
+
+		counts = {path: count for path, count, *_ in p.get_summary()}
+		self.assertEqual(counts, {"train": 1, "train/batch": 3, "train/run": 1, "train/run/batch": 1})
+
+	def test_decorator_and_exception(self):
+		p = profiler.Profiler()
+
+		@p.profile()
+		def failing():
+			with p.scope("inner"):
+				raise ValueError()
+
+		with p.scope("outer"):
+			with self.assertRaises(ValueError):
+				failing()
+			with p.scope("next"):
+				pass
+
+		# scopes are closed by the exception, so "next" is not nested under "failing"
+		paths = [path for path, *_ in p.get_summary()]
+		self.assertEqual(paths, ["outer", "outer/failing", "outer/failing/inner", "outer/next"])
+
+	def test_statistics(self):
+		stats = profiler.ScopeStats()
+		for elapsed in range(1, 101):
+			stats.add(elapsed / 1000.0)
+
+		self.assertEqual(stats.count, 100)
+		self.assertAlmostEqual(stats.total, 5.05)
+		self.assertAlmostEqual(stats.max, 0.1)
+		p50, p95, p99 = stats.get_percentiles()
+		self.assertAlmostEqual(p50, 0.0505)
+		self.assertAlmostEqual(p95, 0.09505)
+		self.assertAlmostEqual(p99, 0.09901)
+
+	def test_threads_have_own_stacks(self):
+		p = profiler.Profiler()
+
+		def worker():
+			with p.scope("worker"):
+				pass
+
+		with p.scope("main"):
+			thread = threading.Thread(target=worker)
+			thread.start()
+			thread.join()
+
+		paths = [path for path, *_ in p.get_summary()]
+		self.assertEqual(paths, ["main", "worker"])
+
+	def test_listeners_when_disabled(self):
+		p = profiler.Profiler(enabled=False)
+		events = []
+		p.add_listener(lambda path, start, elapsed: events.append(path))
+
+		with p.scope("a"):
+			with p.scope("b"):
+				pass
+
+		self.assertEqual(events, ["a/b", "a"])
+		self.assertEqual(p.get_summary(), [])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,68 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Ver: 2
+
+tests for batched bicubic resampling and flips of image stacks
+
+python -m unittest discover tests
+"""
+
+import unittest
+
+import numpy as np
+
+from helper import utilty as util
+
+SCALES = [1 / 2, 1 / 3, 1 / 4, 2, 3, 4]
+
+
+class TestResizeImagesByBicubic(unittest.TestCase):
+
+	def test_float_images_match_pil(self):
+		images = np.random.RandomState(0).rand(3, 24, 24, 1).astype(np.float32) * 255
+
+		for scale in SCALES:
+			resized = util.resize_images_by_bicubic(images, scale)
+			for image, resized_image in zip(images, resized):
+				expected = util.resize_image_by_pil(image, scale)
+				self.assertEqual(resized_image.shape, expected.shape)
+				self.assertLess(np.max(np.abs(resized_image - expected)), 1e-4, "scale:%f" % scale)
+
+	def test_uint8_images_match_pil(self):
+		images = np.random.RandomState(0).randint(256, size=(3, 24, 24, 1)).astype(np.uint8)
+
+		for scale in SCALES:
+			resized = util.resize_images_by_bicubic(images, scale)
+			self.assertEqual(resized.dtype, np.uint8)
+			for image, resized_image in zip(images, resized):
+				expected = util.resize_image_by_pil(image, scale)
+				self.assertLessEqual(np.max(np.abs(resized_image.astype(np.int32) - expected)), 1, "scale:%f" % scale)
+
+
+class TestFlipImages(unittest.TestCase):
+
+	def test_flip_is_inverted(self):
+		image = np.arange(4 * 4 * 2).reshape(4, 4, 2)
+
+		for flip_type in range(8):
+			flipped = util.flip(image, flip_type)
+			np.testing.assert_array_equal(util.flip(flipped, flip_type, invert=True), image)
+
+	def test_all_flips_are_different(self):
+		image = np.arange(4 * 4).reshape(4, 4, 1)
+
+		flipped = {util.flip(image, flip_type).tobytes() for flip_type in range(8)}
+		self.assertEqual(len(flipped), 8)
+
+	def test_flip_images_match_flip(self):
+		images = np.random.RandomState(0).rand(16, 5, 5, 1)
+		flip_types = np.arange(16) % 8
+
+		flipped = util.flip_images(images, flip_types)
+		for image, flipped_image, flip_type in zip(images, flipped, flip_types):
+			np.testing.assert_array_equal(flipped_image, util.flip(image, flip_type))
+			np.testing.assert_array_equal(util.flip(flipped_image, flip_type, invert=True), image)
+
+
+if __name__ == '__main__':
+	unittest.main()
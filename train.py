@@ -10,10 +10,12 @@ Testing Environment: Python 3.6.1, tensorflow >= 1.3.0
 
 import logging
 import sys
+import time
+
 import tensorflow as tf
 
 import DCSCN
-from helper import args, utilty as util
+from helper import args, image_index, metrics, profiler, tracer, utilty as util
 
 FLAGS = args.get()
 
@@ -22,13 +24,15 @@ def main(not_parsed_args):
 		print("Unknown args:%s" % not_parsed_args)
 		exit()
 
-	model = DCSCN.SuperResolution(FLAGS, model_name=FLAGS.model_name)
+	model = DCSCN.create_model(FLAGS, model_name=FLAGS.model_name)
 
 	if FLAGS.build_batch:
 		model.load_datasets(FLAGS.data_dir + "/" + FLAGS.dataset, FLAGS.batch_dir + "/" + FLAGS.dataset,
 		                    FLAGS.batch_image_size, FLAGS.stride_size)
 	else:
 		model.load_dynamic_datasets(FLAGS.data_dir + "/" + FLAGS.dataset, FLAGS.batch_image_size)
+	if FLAGS.use_tf_data:
+		model.build_input_pipeline(threads=FLAGS.input_threads)
 	model.build_graph()
 	model.build_optimizer()
 	model.build_summary_saver()
@@ -37,6 +41,8 @@ def main(not_parsed_args):
 	logging.info("Test Data:" + FLAGS.test_dataset + " Training Data:" + FLAGS.dataset)
 	util.print_num_of_total_parameters(output_to_logging=True)
 
+	model.build_validation_set(image_index.get_image_files(FLAGS.data_dir + "/" + FLAGS.test_dataset))
+
 	total_psnr = total_mse = 0
 
 	for i in range(FLAGS.tests):
@@ -54,11 +60,12 @@ def main(not_parsed_args):
 		logging.info("\n=== Final Average [%s] MSE:%f, PSNR:%f ===" % (FLAGS.test_dataset, total_mse / FLAGS.tests, total_psnr / FLAGS.tests))
 
 	model.copy_log_to_archive("archive")
+	metrics.close()
 
 
 def train(model, flags, trial):
 
-	test_filenames = util.get_files_in_directory(flags.data_dir + "/" + flags.test_dataset)
+	test_filenames = image_index.get_image_files(flags.data_dir + "/" + flags.test_dataset)
 
 	model.init_all_variables()
 	if flags.load_model_name != "":
@@ -66,27 +73,77 @@ def train(model, flags, trial):
 
 	model.init_train_step()
 	model.init_epoch_index()
+	if flags.resume:
+		model.load_training_state(trial=trial)
 	model_updated = True
 	mse = 0
 
+	# training state is written in background so that the training doesn't wait for the file write
+	state_writer = util.BackgroundWorker(max_pending=1)
+	training_time = validation_time = 0
+	epoch_start_time = time.time()
+
 	while model.lr > flags.end_lr:
 
-		model.build_input_batch()
-		model.train_batch()
+		with profiler.scope("train"):
+			steps = model.train_steps(flags.fused_steps)
+
+		if flags.checkpoint_steps > 0 and model.step % flags.checkpoint_steps < steps:
+			with profiler.scope("save"):
+				model.save_training_state(trial=trial, writer=state_writer)
 
 		if model.training_step * model.batch_num >= model.training_images:
 
 			# training epoch finished
 			model.epochs_completed += 1
-			mse, psnr = model.evaluate(test_filenames)
-			model.print_status(mse, psnr, log=model_updated)
-			model.log_to_tensorboard(test_filenames[0], psnr, save_meta_data=model_updated)
+			if flags.save_epoch_checkpoints:
+				with profiler.scope("save"):
+					model.save_epoch_model(model.epochs_completed, trial=trial)
+
+			validation_start_time = time.time()
+			epoch_training_time = validation_start_time - epoch_start_time
+			training_time += epoch_training_time
+
+			# full evaluation at the end of each learning rate stage, otherwise fast validation
+			full_evaluation = model.is_lr_decay_epoch()
+			with profiler.scope("evaluate"):
+				if not flags.epoch_evaluation:
+					mse = psnr = None
+				elif full_evaluation:
+					mse, psnr = model.evaluate(test_filenames)
+				else:
+					mse, psnr = model.evaluate_validation_set()
+			validation_time += time.time() - validation_start_time
+
+			model.print_status(mse, psnr, log=model_updated or full_evaluation)
+			record_epoch_metrics(model, psnr, epoch_training_time, time.time() - validation_start_time)
+			with profiler.scope("tensorboard"):
+				model.log_to_tensorboard(test_filenames[0], psnr, save_meta_data=model_updated,
+				                         full_evaluation=full_evaluation)
 
 			model_updated = model.update_epoch_and_lr()
 			model.init_epoch_index()
 
+			if flags.checkpoint_epochs > 0 and model.epochs_completed % flags.checkpoint_epochs == 0:
+				with profiler.scope("save"):
+					model.save_training_state(trial=trial, writer=state_writer)
+			if flags.profile_interval > 0 and model.epochs_completed % flags.profile_interval == 0:
+				profiler.log_summary("Profile (Epoch:%d)" % model.epochs_completed)
+
+			epoch_start_time = time.time()
+
+	state_writer.wait()
 	model.end_train_step()
-	model.save_model(trial=trial, output_log=True)
+	logging.info("Training time:%s sec, Validation time:%s sec (%2.1f%%)" % (
+		"{:,.0f}".format(training_time), "{:,.0f}".format(validation_time),
+		100.0 * validation_time / max(training_time + validation_time, 1e-6)))
+	model.log_telemetry_times()
+	with profiler.scope("save"):
+		model.save_model(trial=trial, output_log=True)
+		if flags.export_half_precision:
+			model.save_half_precision_model(trial=trial, output_log=True)
+	if mse is None:
+		mse, _ = model.evaluate(test_filenames)
 
 	# outputs result
 	test(model, flags.test_dataset)
@@ -96,20 +153,50 @@ def train(model, flags, trial):
 			if test_data != flags.test_dataset:
 				test(model, test_data)
 
+	metrics.record("trial", {"trial": trial, "mse": mse, "psnr": util.get_psnr(mse, max_value=flags.max_value),
+	                         "training_seconds": training_time, "validation_seconds": validation_time})
+	metrics.flush()
+	profiler.log_summary("Profile (Trial:%d)" % trial, reset=True)
+	tracer.save()
 	return mse
 
 
 def test(model, test_data):
-	test_filenames = util.get_files_in_directory(FLAGS.data_dir + "/" + test_data)
+	""" evaluate test_data for each scale of the model. results of multi-scale model are saved in x[scale]/ """
+
+	for scale in model.for_each_scale():
+		test_scale(model, test_data, scale)
+
+
+def test_scale(model, test_data, scale):
+	test_filenames = image_index.get_image_files(FLAGS.data_dir + "/" + test_data)
 	total_psnr = total_mse = 0
+	output_directory = FLAGS.output_dir if FLAGS.scales == "" else FLAGS.output_dir + "/x%d" % scale
 
-	for filename in test_filenames:
-		mse = model.do_for_evaluate_with_output(filename, output_directory=FLAGS.output_dir, print_console=False)
+	writer = util.BackgroundWorker(max_pending=64, threads=FLAGS.eval_threads)
+	for mse in model.evaluate_files(test_filenames, output_directory=output_directory, writer=writer):
 		total_mse += mse
 		total_psnr += util.get_psnr(mse, max_value=FLAGS.max_value)
-
-	logging.info("\n=== [%s] MSE:%f, PSNR:%f ===" % (
-		test_data, total_mse / len(test_filenames), total_psnr / len(test_filenames)))
+	writer.close()
+
+	logging.info("\n=== [%s x%d] MSE:%f, PSNR:%f ===" % (
+		test_data, scale, total_mse / len(test_filenames), total_psnr / len(test_filenames)))
+	metrics.record("test", {"mse": total_mse / len(test_filenames), "psnr": total_psnr / len(test_filenames),
+	                        "images": len(test_filenames)}, {"dataset": test_data, "scale": scale})
+
+
+def record_epoch_metrics(model, psnr, epoch_training_time, validation_time):
+	""" training throughput of the epoch. loader wait and evaluation time are observed from profiler scopes. """
+
+	values = {"epoch": model.epochs_completed, "step": model.step, "learning_rate": model.lr,
+	          "steps_per_second": model.training_step / max(epoch_training_time, 1e-6),
+	          "patches_per_second": model.training_step * model.batch_num / max(epoch_training_time, 1e-6),
+	          "training_psnr": model.training_psnr_sum / max(model.training_step, 1),
+	          "validation_seconds": validation_time}
+	if psnr is not None:
+		values["psnr"] = psnr
+	metrics.record("epoch", values)
+	metrics.flush()
 
 
 if __name__ == '__main__':
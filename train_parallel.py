@@ -0,0 +1,34 @@
+"""
+Paper: "Fast and Accurate Image Super Resolution by Deep CNN with Skip Connection and Network in Network"
+Author: Jin Yamanaka
+Github: https://github.com/jiny2001/dcscn-image-super-resolution
+Ver: 2.0
+
+Synchronous data parallel training on a many-core CPU machine.
+
+--workers N: N worker processes train the model. Each worker computes gradients for batch_num / N images of
+the mini-batch, the gradients are averaged over shared memory and applied (with clipping_norm) by all workers.
+Use --intra_op_threads to split CPU cores between the workers.
+
+python train_parallel.py --workers=4 --intra_op_threads=4 --dataset=bsd200
+"""
+
+import tensorflow as tf
+
+from helper import args, data_parallel
+
+args.flags.DEFINE_integer("workers", 2, "Number of worker processes")
+
+FLAGS = args.get()
+
+
+def main(not_parsed_args):
+	if len(not_parsed_args) > 1:
+		print("Unknown args:%s" % not_parsed_args)
+		exit()
+
+	data_parallel.train(FLAGS.flag_values_dict(), FLAGS.workers)
+
+
+if __name__ == '__main__':
+	tf.app.run()